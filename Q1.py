@@ -7,14 +7,29 @@
 #Ensure error handling for file I/O operations, socket connections, and pickling/unpickling.
 
 import socket
-import pickle
 import os
-import sys
 import threading
+import argparse
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from framing import send_frame, recv_frame, send_body, recv_body, CHUNK_SIZE
+from manifest import Manifest, file_digest, new_digest, is_manifest
+from resumable import send_files_resumable, PartialRegistry, is_partial, file_mode
+from compression import available_codecs, negotiate, send_compressed, recv_compressed, CompressionStats
+from serializers import PERMISSIVE, STRICT, negotiate_serializer
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
 
 port = 25565
 address = 'localhost'
         
+exit_event = threading.Event() # Create an event for exiting the server
+
 def directory_selector(str_type):
     """ Selects directory
 
@@ -59,140 +74,636 @@ def list_files(directory):
         
     return files_dict
              
-def run_client(address, port):
-    """Runs the client.
+def collect_files(paths):
+    """ Expands files and directory trees into the list of files to send.
+
+    Args:
+        paths (list): File and directory paths.
+
+    Returns:
+        list: (file path, name relative to the sent directory) tuples.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            # Walk the whole tree; names keep the directory layout below path
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    file_path = os.path.join(root, name)
+                    relative = os.path.relpath(file_path, path).replace(os.sep, '/')
+                    if not is_reserved(relative):
+                        files.append((file_path, relative))
+        elif os.path.isfile(path):
+            files.append((path, os.path.basename(path)))
+        else:
+            raise FileNotFoundError(f"No such file or directory: {path}")
+    return files
+
+def select_file():
+    """ Asks the user to pick a single file to send.
+
+    Returns:
+        str: file path
+    """
+    # Use the directory_selector function to get a valid directory
+    directory = directory_selector("stored")
+
+    # Use the list_files function to list and get files in the directory
+    files_dict = list_files(directory)
+
+    # Get file number from user
+    file_num = int(input("Enter the file number corresponding to the file you want to send: "))
+    
+    print("File selected: " + files_dict[file_num])
+
+    # Get file path from dictionary
+    return files_dict[file_num]
+
+def receive_acks(client_socket, acks):
+    """Collects the server's per-file acknowledgements until it closes the connection.
+
+    Args:
+        client_socket (socket): The client socket.
+        acks (list): List the acknowledgement frames are appended to.
+    """
+    try:
+        while True:
+            ack = recv_frame(client_socket)
+            if ack is None:
+                break
+            ack['received_at'] = time.perf_counter()
+            acks.append(ack)
+    except OSError as e:
+        print(f"Error: {e}")
+
+def send_files(client_socket, files, codec='none', serializer=None):
+    """Sends many files back to back over one connection.
+
+    Files are pipelined: the next header follows the previous body without
+    waiting for its acknowledgement, which a separate thread collects. Each
+    acknowledgement gets a 'latency' entry: seconds from starting to send
+    the file to receiving its acknowledgement.
+
+    Args:
+        client_socket (socket): The client socket, already greeted by the server.
+        files (list): (file path, name) tuples, e.g. from collect_files.
+        codec (str): Compression codec agreed with the server.
+        serializer: Serializer agreed with the server; pickle by default.
+
+    Returns:
+        tuple: (acknowledgement frame for every file the server saved, CompressionStats)
+    """
+    acks = []
+    stats = CompressionStats()
+    started = {}
+    reader = threading.Thread(target=receive_acks, args=(client_socket, acks))
+    reader.start()
+
+    try:
+        for file_path, name in files:
+            started[name or os.path.basename(file_path)] = time.perf_counter()
+            stats.add(send_file(client_socket, file_path, name, codec, serializer))
+    finally:
+        # Tell the server the batch is complete, then wait for the last acknowledgement
+        client_socket.shutdown(socket.SHUT_WR)
+        reader.join()
+
+    for ack in acks:
+        ack['latency'] = ack['received_at'] - started.get(ack['name'], ack['received_at'])
+    return acks, stats
+
+def plan_sync(client_socket, paths, serializer=None):
+    """Sends the client's digests and returns only the files the server lacks.
+
+    Directories are indexed by a persisted Manifest, so unchanged files are
+    not read again; the server compares the digests against its own index.
+
+    Args:
+        client_socket (socket): The client socket, already greeted by the server.
+        paths (list): File and directory paths.
+        serializer: Serializer agreed with the server; pickle by default.
+
+    Returns:
+        list: (file path, name) tuples for new or modified files.
+    """
+    files = []
+    digests = {}
+    for path in paths:
+        if os.path.isdir(path):
+            manifest = Manifest(path, is_partial)
+            for name, entry in sorted(manifest.scan().items()):
+                files.append((os.path.join(path, *name.split('/')), name))
+                digests[name] = entry['digest']
+            manifest.save()
+        else:
+            name = os.path.basename(path)
+            files.append((path, name))
+            digests[name] = file_digest(path)
+
+    send_frame(client_socket, {'type': 'sync', 'digests': digests}, serializer)
+    reply = recv_frame(client_socket)
+    if not reply or reply.get('type') != 'changed':
+        raise ConnectionError("Server did not answer the sync request")
+
+    changed = set(reply['names'])
+    return [(file_path, name) for file_path, name in files if name in changed]
+
+def connect(address, port):
+    """Connects to the server and waits until it is ready to receive.
 
     Args:
         address (str): The address of the server.
         port (int): The port of the server.
+
+    Returns:
+        tuple: (the connected client socket, the server's greeting frame)
     """
     # initialize TCP connection
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_address = (address, port)
     client_socket.connect(server_address)
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
     print(f"Client is connected to {address}:{port}")
 
     try:
-        # Use the directory_selector function to get a valid directory
-        directory = directory_selector("stored")
-
-        # Use the list_files function to list and get files in the directory
-        files_dict = list_files(directory)
-
-        # Get file number from user
-        file_num = int(input("Enter the file number corresponding to the file you want to send: "))
-        
-        print("File selected: " + files_dict[file_num])
-
-        # Get file path from dictionary
-        file_path = files_dict[file_num]
-
-        # Read the file content
-        with open(file_path, 'rb') as file:
-            file_content = file.read()
+        # Wait until the server has a free slot for this connection
+        greeting = wait_until_ready(client_socket)
+    except Exception:
+        client_socket.close()
+        raise
+    return client_socket, greeting
 
-        # Create a dictionary to hold file information
-        # split the file path into a list to get the file name; -1 to get the last element
-        file_data = {'name': file_path.split('/')[-1], 'content': file_content}
+def run_client(address, port, paths=None, sync=False, resume=False, streams=None, compress='none'):
+    """Runs the client.
 
-        # Pickle the file object
-        pickled_data = pickle.dumps(file_data)
+    Args:
+        address (str): The address of the server.
+        port (int): The port of the server.
+        paths (list): Files and directories to send. Prompts for one file if not given.
+        sync (bool): Only send files that are new or changed on the server.
+        resume (bool): Send files in verified chunks, resuming after dropped connections.
+        streams (int): Parallel connections per file in resume mode. Picked from the file size if not given.
+        compress (str): Codec to compress with, 'auto' for the best one the server supports, or 'none'.
+    """
+    client_socket, greeting = connect(address, port)
 
-        # Send the pickled file object
-        client_socket.sendall(pickled_data)
-        
-        # Close the client socket
-        print("File sent successfully")
+    try:
+        # Agree on a codec from the ones the server offers
+        codec = negotiate(compress, greeting.get('codecs', ['none']))
+        # and on a serializer from the ones it accepts
+        serializer = negotiate_serializer(greeting.get('serializers', ['pickle']))
+
+        # Headless batch mode when paths are given, otherwise ask for a single file
+        if paths and sync:
+            files = plan_sync(client_socket, paths, serializer)
+            print(f"{len(files)} new or changed files to send")
+        else:
+            files = collect_files(paths) if paths else [(select_file(), None)]
+
+        if resume:
+            # Send only the chunks the server lacks, reconnecting if the link drops
+            client_socket, stats = send_files_resumable(client_socket, files,
+                                                        lambda: connect(address, port)[0],
+                                                        streams=streams, codec=codec,
+                                                        serializer=serializer)
+            print(f"{len(files)} files sent successfully ({stats.wire_bytes} bytes transferred)")
+        else:
+            # Stream every file over this one connection
+            acks, stats = send_files(client_socket, files, codec, serializer)
+
+            saved = [ack for ack in acks if ack.get('status') == 'ok']
+            print(f"{len(saved)} of {len(files)} files sent successfully")
+            if len(saved) != len(files):
+                print("Some files were not saved")
+
+        if codec != 'none':
+            print(f"Compression ({codec}): {stats}")
 
     except Exception as e:
         print(f"Error: {e}")
         print("File not saved")
 
     finally:
+        # Close the client socket
         client_socket.close()
     
 
-def receive_file(client_socket, save_directory):
-    """Receives the pickled file object, unpickles it, and saves it to disk.
+def wait_until_ready(client_socket):
+    """Waits for the server's greeting frame.
+
+    Args:
+        client_socket (socket): The client socket.
+
+    Returns:
+        dict: The greeting, listing the codecs and serializers the server supports.
+
+    Raises:
+        ConnectionRefusedError: If the server is busy or closed the connection.
+    """
+    greeting = recv_frame(client_socket)
+    if not greeting or greeting.get('type') != 'ready':
+        raise ConnectionRefusedError("Server is busy, try again later")
+    return greeting
+
+def send_file(client_socket, file_path, name=None, codec='none', serializer=None):
+    """Sends a header frame describing the file followed by the file body.
 
     Args:
         client_socket (socket): The client socket.
+        file_path (str): Path of the file to send.
+        name (str): Name to save the file under. Defaults to the file name.
+        codec (str): Compression codec agreed with the server.
+        serializer: Serializer agreed with the server; pickle by default.
+
+    Returns:
+        CompressionStats: Bytes read, bytes sent and compression CPU time.
+    """
+    stats = CompressionStats()
+    with open(file_path, 'rb') as file:
+        stat = os.fstat(file.fileno())
+
+        # Create a dictionary to hold file information; the body follows it as raw bytes
+        header = {'type': 'file',
+                  'name': name or os.path.basename(file_path),
+                  'size': stat.st_size,
+                  'mtime': stat.st_mtime,
+                  'mode': stat.st_mode & 0o777,
+                  'codec': codec}
+
+        # Encode and send the header, then stream the body
+        send_frame(client_socket, header, serializer)
+        if codec == 'none':
+            send_body(client_socket, file, stat.st_size)
+            stats.raw_bytes = stats.wire_bytes = stat.st_size
+        else:
+            send_compressed(client_socket, file, 0, stat.st_size, codec, stats)
+    return stats
+
+def is_reserved(name):
+    """Tells whether a name is used by the server for its own files.
+
+    Args:
+        name (str): '/' separated name relative to the save directory.
+
+    Returns:
+        bool: True for the manifest in any directory, and for partial uploads and
+        their chunk records at the root.
+    """
+    return is_manifest(name.rsplit('/', 1)[-1]) or is_partial(name)
+
+def resolve_path(save_directory, name):
+    """Maps a name sent by the client to a path inside the save directory.
+
+    Args:
         save_directory (str): The directory to save the file.
+        name (str): Relative name from the file header, using '/' separators.
+
+    Returns:
+        str: The path to write to.
+
+    Raises:
+        ValueError: If the name is absolute, escapes the save directory or uses a reserved name.
     """
-    try:
-        # Receive the pickled file object
-        data = client_socket.recv(4096)
-        if not data:
-            print("Error: No data received.")
-            return
+    parts = name.split('/')
+    if name.startswith('/') or any(part in ('', '.', '..') for part in parts):
+        raise ValueError(f"Refusing unsafe file name: {name!r}")
+    if is_reserved(name):
+        raise ValueError(f"Refusing reserved file name: {name!r}")
+    return os.path.join(save_directory, *parts)
+
+class ServerState:
+    """
+    State shared by every connection handler of one server.
 
-        # Unpickle the file object
-        file_data = pickle.loads(data)
+    Args:
+        save_directory (str): The directory to save files.
+        max_connections (int): Number of clients served concurrently.
+        fsync (bool): Flush every received file to disk before acknowledging it.
+        serializers (list): Serializers accepted from clients; only 'schema' by default, so
+            clients cannot make the server unpickle anything.
+    """
 
-        # Extract file information
-        file_name = file_data['name']
-        file_content = file_data['content']
+    def __init__(self, save_directory, max_connections, fsync=False, serializers=None):
+        self.save_directory = save_directory
+        self.fsync = fsync
+        self.serializers = list(serializers or ['schema'])
+        # Frames from clients are decoded with this; the server answers with STRICT, which any client decodes
+        self.decoder = PERMISSIVE if 'pickle' in self.serializers else STRICT
+        self.slots = threading.BoundedSemaphore(max_connections) # One slot per worker
+        self.buffers = threading.local() # Per-thread receive buffers
+        self.manifest = Manifest(save_directory, is_partial) # Index of the files already saved
+        self.partials = PartialRegistry(save_directory) # Resumable uploads in progress
+        self.timings = deque(maxlen=10000) # Per-transfer timings of the most recent transfers
+
+    def buffer(self):
+        """
+        Returns the calling worker thread's receive buffer, reused across files.
+        """
+        if not hasattr(self.buffers, 'buffer'):
+            self.buffers.buffer = bytearray(CHUNK_SIZE)
+        return self.buffers.buffer
+
+    def record(self, name, size, accept, header, body, fsync):
+        """
+        Records how long each phase of a transfer took, in seconds.
+
+        Args:
+            name (str): Name of the file.
+            size (int): File size in bytes.
+            accept (float): Wait between accepting the connection and a worker picking it up.
+            header (float): Receiving the header frame.
+            body (float): Receiving and writing the body.
+            fsync (float): Flushing the file to disk.
+        """
+        self.timings.append({'name': name, 'size': size, 'accept': accept,
+                             'header': header, 'body': body, 'fsync': fsync})
+
+    def report(self):
+        """
+        Builds the reply to a 'stats' request.
+
+        Returns:
+            dict: Recent transfer timings and the server's peak resident memory.
+        """
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else None
+        return {'type': 'stats', 'transfers': list(self.timings), 'peak_rss': peak_rss}
+
+def receive_file(client_socket, state, header):
+    """Streams the body announced by a file header to disk.
+
+    Args:
+        client_socket (socket): The client socket.
+        state (ServerState): The server state.
+        header (dict): The file header frame.
+
+    Returns:
+        tuple: (seconds spent on the body, seconds spent in fsync)
+    """
+    # Extract file information
+    file_path = resolve_path(state.save_directory, header['name'])
+    file_size = header['size']
+    mode = file_mode(header)
+
+    # Stream the body to the specified directory, hashing it on the way
+    digest = new_digest()
+    codec = header.get('codec', 'none')
+    stats = CompressionStats()
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    started = time.perf_counter()
+    with open(file_path, 'wb') as file:
+        if codec == 'none':
+            recv_body(client_socket, file, file_size, state.buffer(), digest)
+        else:
+            recv_compressed(client_socket, file.write, file_size, codec, stats, digest)
+        body_done = time.perf_counter()
+
+        # Optionally make the file durable before it is acknowledged
+        if state.fsync:
+            file.flush()
+            os.fsync(file.fileno())
+    fsync_done = time.perf_counter()
+
+    # Restore the sender's permissions and modification time
+    os.chmod(file_path, mode)
+    if 'mtime' in header:
+        os.utime(file_path, (header['mtime'], header['mtime']))
+
+    # Record the file so later syncs know the server has it
+    state.manifest.update(header['name'], digest.hexdigest())
+
+    print(f"File received and saved to {file_path} ({file_size} bytes)")
+    if codec != 'none':
+        print(f"Decompression ({codec}): {stats}")
+    return body_done - started, fsync_done - body_done
+
+def handle_connection(client_socket, client_address, state, accepted_at=None):
+    """Handles one accepted connection on a worker thread.
 
-        # Save the file to the specified directory
-        file_path = os.path.join(save_directory, file_name)
-        with open(file_path, 'wb') as file:
-            file.write(file_content)
+    Args:
+        client_socket (socket): The client socket.
+        client_address (tuple): The address of the client.
+        state (ServerState): The server state.
+        accepted_at (float): time.perf_counter() when the connection was accepted.
+    """
+    # Time the connection waited for a free worker; charged to its first transfer
+    accept = time.perf_counter() - accepted_at if accepted_at else 0.0
+    received = 0
+    partials = {} # Uploads this connection has joined, by file ID
+    try:
+        # Tell the client it may start sending
+        send_frame(client_socket, {'type': 'ready', 'codecs': available_codecs(), 'serializers': state.serializers},
+                   STRICT)
 
-        print(f"File received and saved to {file_path}")
+        # Serve requests until the client closes its side
+        while True:
+            header_started = time.perf_counter()
+            request = recv_frame(client_socket, state.decoder)
+            if request is None:
+                break
+            header = time.perf_counter() - header_started
+
+            if request['type'] == 'sync':
+                # Refresh the index (one stat per unchanged file) and report what differs
+                state.manifest.scan()
+                names = state.manifest.changed(request['digests'])
+                send_frame(client_socket, {'type': 'changed', 'names': names}, STRICT)
+
+            elif request['type'] == 'file':
+                # Save the file and acknowledge it
+                body, fsync = receive_file(client_socket, state, request)
+                state.record(request['name'], request['size'], accept, header, body, fsync)
+                accept = 0.0
+                received += 1
+                send_frame(client_socket, {'type': 'ack', 'name': request['name'],
+                                           'size': request['size'], 'status': 'ok'}, STRICT)
+
+            elif request['type'] == 'begin':
+                # Start or resume a chunked upload and report the chunks still needed
+                partial = partials.get(request['file_id'])
+                if partial is None:
+                    final_path = resolve_path(state.save_directory, request['name'])
+                    partial = state.partials.begin(request, final_path)
+                    partials[partial.file_id] = partial
+                send_frame(client_socket, {'type': 'missing', 'indexes': partial.missing()}, STRICT)
+
+            elif request['type'] == 'chunk':
+                # Write a chunk in place; corrupt chunks are reported at commit time
+                partial = partials.get(request['file_id'])
+                if partial is None:
+                    partial = state.partials.get(request['file_id'])
+                    partials[partial.file_id] = partial
+                if not partial.receive_chunk(client_socket, request['index'], request['size'],
+                                             state.buffer(), request.get('codec', 'none')):
+                    print(f"Error: {client_address}: chunk {request['index']} failed verification")
+
+            elif request['type'] == 'commit':
+                # Move the finished file into place, or ask again for the chunks still missing
+                partial = partials[request['file_id']]
+                commit_started = time.perf_counter()
+                missing = state.partials.commit(partial, request['digest'])
+                if missing:
+                    send_frame(client_socket, {'type': 'missing', 'indexes': missing}, STRICT)
+                else:
+                    state.manifest.update(partial.header['name'], request['digest'])
+                    state.record(partial.header['name'], partial.size, accept, header,
+                                 partial.body_seconds, time.perf_counter() - commit_started)
+                    accept = 0.0
+                    received += 1
+                    del partials[partial.file_id]
+                    state.partials.release(partial)
+                    print(f"File received and saved to {partial.final_path} ({partial.size} bytes)")
+                    if partial.stats.wire_bytes != partial.stats.raw_bytes:
+                        print(f"Decompression: {partial.stats}")
+                    send_frame(client_socket, {'type': 'committed', 'name': partial.header['name']}, STRICT)
+
+            elif request['type'] == 'stats':
+                # Report recent per-transfer timings for benchmarks and monitoring
+                send_frame(client_socket, state.report(), STRICT)
+
+            else:
+                raise ValueError(f"Unknown request type: {request['type']!r}")
 
     except Exception as e:
-        print(f"Error: {e}")
+        print(f"Error: {client_address}: {e}")
 
-def run_server(address, port):
+    finally:
+        # Leave unfinished uploads on disk so they can resume later
+        for partial in partials.values():
+            state.partials.release(partial)
+
+        # Persist the index if this client added files
+        if received:
+            try:
+                state.manifest.save()
+            except OSError as e:
+                print(f"Error: could not save manifest: {e}")
+
+        # Close the client socket and free the slot for the next client
+        client_socket.close()
+        state.slots.release()
+
+def run_server(address, port, max_connections=8, timeout=30.0, when_busy='wait', save_directory=None,
+               fsync=False, stop_event=None, serializers=None):
     """Runs the server.
 
+    Up to max_connections clients are served at once by a thread pool. When
+    every slot is taken the server either stops accepting, so new clients
+    wait in the listen backlog ('wait'), or tells them it is busy and closes
+    the connection ('reject').
+
     Args:
         address (str): The address of the server.
         port (int): The port of the server.
+        max_connections (int): Number of clients served concurrently.
+        timeout (float): Seconds a connection may stay idle while reading.
+        when_busy (str): 'wait' or 'reject'.
+        save_directory (str): Where to save files. Prompts for a directory if not given.
+        fsync (bool): Flush every received file to disk before acknowledging it.
+        stop_event (threading.Event): Stops the server when set. Defaults to exit_event.
+        serializers (list): Serializers accepted from clients; only 'schema' by default.
     """
+    stop_event = stop_event or exit_event
     
     # initialize TCP connection
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_address = (address, port)
     server_socket.bind(server_address)
-    server_socket.listen(1)
+    server_socket.listen(max_connections)
+    server_socket.settimeout(0.5) # Wake up regularly to check stop_event
 
     print(f"Server is listening on {address}:{port}")
 
+    # Bounded pool of worker threads
+    pool = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="q1-worker")
+    has_slot = False
+
     try:
         # Use the directory_selector function to get a valid directory
-        save_directory = directory_selector("to besaved at")
+        if save_directory is None:
+            save_directory = directory_selector("to besaved at")
         
         print("Directory saved at: " + save_directory)
 
+        # Index the files already in the save directory
+        state = ServerState(save_directory, max_connections, fsync, serializers)
+        state.manifest.scan()
+        state.manifest.save()
+
         # Loop for waiting for a connection
-        while True:
-            client_socket, client_address = server_socket.accept()
+        while not stop_event.is_set():
+            # In 'wait' mode block until a slot frees up before accepting again
+            if not has_slot:
+                if when_busy == 'wait':
+                    has_slot = state.slots.acquire(timeout=0.5)
+                    if not has_slot:
+                        continue
+                else:
+                    has_slot = state.slots.acquire(blocking=False)
+
+            try:
+                client_socket, client_address = server_socket.accept()
+            except socket.timeout:
+                continue
+            accepted_at = time.perf_counter()
             print(f"Connection from {client_address}")
 
-            # Use the receive_file function to handle file reception
-            receive_file(client_socket, save_directory)
-            
-            # Close the client socket
-            client_socket.close()
+            if not has_slot:
+                # Every slot is taken; turn the client away instead of queueing it
+                try:
+                    send_frame(client_socket, {'type': 'busy'}, STRICT)
+                except OSError:
+                    pass
+                client_socket.close()
+                print(f"Rejected {client_address}: server busy")
+                continue
+
+            # Slow or stalled clients time out instead of holding a slot forever
+            client_socket.settimeout(timeout)
+            # Small frames go out at once instead of waiting for the ACK of a chunk's tail
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            pool.submit(handle_connection, client_socket, client_address, state, accepted_at)
+            has_slot = False
 
     except Exception as e:
         print(f"Server Error: {e}")
 
     finally:
+        if has_slot:
+            state.slots.release()
+        pool.shutdown(wait=True)
         server_socket.close()
         
-exit_event = threading.Event() # Create an event for exiting the server
     
 if __name__ == "__main__": # If the code is run as the main program (not as an import)
-    if len(sys.argv) != 2: # Check if the number of arguments is correct; if not:
-        print("Usage: python Q1.py <server|client>")
-        sys.exit(1)
-
-    mode = sys.argv[1].lower() # Get the mode from the command line argument
-
-    if mode == 'server':
+    parser = argparse.ArgumentParser(description="Pickled file transfer over sockets")
+    parser.add_argument('mode', type=str.lower, choices=['server', 'client'])
+    parser.add_argument('paths', nargs='*',
+                        help="client: files or directories to send; server: directory to save into")
+    parser.add_argument('--address', default=address, help="address to listen on or connect to")
+    parser.add_argument('--port', type=int, default=port, help="port to listen on or connect to")
+    parser.add_argument('--max-connections', type=int, default=8,
+                        help="number of clients the server handles at once")
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help="seconds a connection may stay idle before it is dropped")
+    parser.add_argument('--when-busy', choices=['wait', 'reject'], default='wait',
+                        help="make new clients wait for a free slot or reject them")
+    parser.add_argument('--fsync', action='store_true',
+                        help="server: flush every received file to disk before acknowledging it")
+    parser.add_argument('--sync', action='store_true',
+                        help="client: only send files that are new or changed on the server")
+    parser.add_argument('--resume', action='store_true',
+                        help="client: send verified chunks and resume interrupted uploads")
+    parser.add_argument('--compress', choices=['auto', 'none'] + available_codecs()[:-1], default='none',
+                        help="client: compress file bodies with this codec ('auto' picks the best shared one)")
+    parser.add_argument('--allow-pickle', action='store_true',
+                        help="server: also accept pickled frames from clients (unpickling can run arbitrary code)")
+    parser.add_argument('--streams', type=int, default=None,
+                        help="client: parallel connections per file (implies --resume; default: by file size)")
+    args = parser.parse_args()
+
+    if args.mode == 'server':
         # # Run the server in a separate thread
         # server_thread = threading.Thread(target=run_server, args=('127.0.0.1', 5555))
         # server_thread.start()
@@ -206,12 +717,12 @@ if __name__ == "__main__": # If the code is run as the main program (not as an i
             
         # # Wait for the server to exit
         # server_thread.join()
-        run_server(address, port)
+        save_directory = args.paths[0] if args.paths else None
+        run_server(args.address, args.port, args.max_connections, args.timeout, args.when_busy,
+                   save_directory, args.fsync,
+                   serializers=['schema', 'pickle'] if args.allow_pickle else None)
 
-    elif mode == 'client':
+    elif args.mode == 'client':
         # Run the client    
-        run_client(address, port)
-
-    else:
-        print("Invalid mode. Use 'server' or 'client'.")
-        sys.exit(1)
\ No newline at end of file
+        run_client(args.address, args.port, args.paths, args.sync, args.resume or bool(args.streams), args.streams,
+                   args.compress)
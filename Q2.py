@@ -1,43 +1,475 @@
 import socket
-import pickle
 import threading
-import queue
+import heapq
+import itertools
+import multiprocessing
+import os
+import pickle
+import random
+import reprlib
+import struct
+import time
+import traceback
+import concurrent.futures
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from framing import encode_frame, send_frame, recv_frame
+from journal import Journal, RECORD_HEADER
+from memo import ResultCache, task_key
+from serializers import available_serializers, negotiate_serializer
+from shm import SharedPayload, host_id, share, worth_sharing
+
+HEARTBEAT_INTERVAL = 1.0 # Seconds between heartbeats from a worker node
+HEARTBEAT_TIMEOUT = 3.5 # A node whose heartbeats stop for this long is considered dead
+RETRY_DELAY = 2.0 # Seconds a node is skipped after a connection to it failed
+LATENCY_WEIGHT = 0.2 # Weight of the newest sample in a node's latency average
+EXECUTORS = ('process', 'thread') # Where a worker node can run a task
+# Forking a node that already runs its accept, heartbeat and connection threads is unsafe,
+# and fork is not available everywhere; spawn behaves the same on every platform
+PROCESS_START_METHOD = 'spawn'
+BATCH_SIZE = 64 # Tasks sent to a node in one request
+BATCH_WINDOW = 0.002 # Seconds a partial batch waits for more tasks before it is sent
+TASK_IDS = itertools.count() # Task IDs, unique across all nodes of the process
+MAX_RETRIES = 2 # Times the client sends a task again after the connection it was sent on was lost
+SUPERVISE_INTERVAL = 0.05 # Seconds between the client's checks for missed deadlines and stragglers
+SPECULATE_AFTER = 0.9 # Share of a group of tasks that must be finished before its stragglers are duplicated
+SPECULATE_FACTOR = 2.0 # A straggler has been running this many times the group's median task time
+
+# Durable task queue
+ADDED = 1 # Journal record of a queued task; the attribute is its priority, the payload the pickled task
+TAKEN = 2 # Journal record of a task that left the queue
+INDEX_HEADER = struct.Struct("!QQQ") # journal inode, journal size covered, number of entries
+INDEX_ENTRY = struct.Struct("!QqQ") # sequence number, priority, journal offset of the ADDED record
+INDEX_INTERVAL = 10000 # Journal records between index checkpoints
+COMPACT_MIN_RECORDS = 10000 # Dead journal records before the journal is compacted
+
+"""
+Raised for a task that failed on a worker node with an exception that could not be sent back.
+"""
+class TaskError(Exception):
+    pass
+
+"""
+The traceback of a task that failed on a worker node.
+
+It is chained as the cause of the exception re-raised on the client, the
+same way concurrent.futures.ProcessPoolExecutor reports failures.
+"""
+class RemoteTraceback(Exception):
+    def __str__(self):
+        return self.args[0]
+
+"""
+Raised for a task that could not be sent to a worker node.
+
+The task never reached the node, so it is safe to send it elsewhere even if
+it is not idempotent.
+"""
+class TaskNotSent(ConnectionError):
+    pass
+
+def run_in(executor):
+    """
+    Marks a task function to run in the given executor on worker nodes.
+
+    CPU-bound functions belong in 'process', where they are not held back by
+    the GIL; functions that mostly wait on I/O are cheaper in 'thread'.
+
+    Args:
+        executor: 'process' or 'thread'.
+
+    Returns:
+        A decorator that records the hint on the function.
+    """
+    if executor not in EXECUTORS:
+        raise ValueError(f"Unknown executor: {executor!r}")
+    def mark(function):
+        function.executor = executor
+        return function
+    return mark
+
+def pure(function=None, ttl=None):
+    """
+    Marks a task function as pure: its result depends only on its arguments
+    and running it has no side effects, so a cached result can stand in for
+    running it again. Use it as @pure or @pure(ttl=60).
+
+    Only pure functions are looked up in the result caches of Client and WorkerNode.
+
+    Args:
+        function: The function, when used as @pure.
+        ttl: Optional seconds a cached result stays valid, overriding the cache's default.
+
+    Returns:
+        The function, or a decorator when only ttl is given.
+    """
+    def mark(function):
+        function.pure = True
+        function.idempotent = True
+        function.cache_ttl = ttl
+        return function
+    return mark(function) if function is not None else mark
+
+def idempotent(function):
+    """
+    Marks a task function as idempotent: running it twice has the same
+    effect as running it once.
+
+    A task that was sent but whose connection was lost may or may not have
+    run, so the client only sends it to another node, or runs a speculative
+    duplicate of it, if its function is idempotent. Pure functions are
+    idempotent too.
+
+    Args:
+        function: The function.
+
+    Returns:
+        The function.
+    """
+    function.idempotent = True
+    return function
+
+def cache_key(cache, task):
+    """
+    Gets the cache key of a task, if the task may be cached.
+
+    Args:
+        cache: A ResultCache, or None if caching is off.
+        task: The task.
+
+    Returns:
+        The key, or None if there is no cache, the function is not marked
+        pure or its arguments cannot be hashed.
+    """
+    function, args = task
+    if cache is None or not getattr(function, 'pure', False) or isinstance(args, SharedPayload):
+        return None
+    return task_key(function, args)
+
+def run_task(function, args, share_result=False):
+    """
+    Runs a task function. Module level, so process pools can pickle it.
+
+    Arguments sent through shared memory are mapped here, in the process
+    that runs the task, so they are never copied through the pool.
+
+    Args:
+        function: The task function.
+        args: The positional arguments, or a SharedPayload holding them.
+        share_result: Return a large result as a SharedPayload; the client is on this host.
+
+    Returns:
+        (True, result) if the task succeeded, or (False, failure) if it raised; see task_failure.
+    """
+    try:
+        if isinstance(args, SharedPayload):
+            args = args.load()
+        result = function(*args)
+    except Exception as e:
+        return False, task_failure(e)
+    print("Node executed task: " + describe(result))
+    if share_result and worth_sharing([result]):
+        try:
+            payload = share(result)
+        except Exception as e:
+            return False, task_failure(e)
+        if payload is not None:
+            return True, payload
+    return True, result
+
+def describe(value):
+    """
+    Formats a value for a log line without spelling out large values.
+
+    Args:
+        value: The value.
+
+    Returns:
+        A short text.
+    """
+    try:
+        size = memoryview(value).nbytes
+    except TypeError:
+        return reprlib.repr(value)
+    return f"<{type(value).__name__} of {size} bytes>"
+
+def run_batch(tasks, share_result=False):
+    """
+    Runs a slice of a batch in one pool job, so tiny tasks do not each pay for a trip to the pool.
+
+    Args:
+        tasks: (task ID, task) tuples.
+        share_result: Return large results as SharedPayloads.
+
+    Returns:
+        (task ID, succeeded, result or failure) tuples.
+    """
+    return [(task_id,) + run_task(function, args, share_result) for task_id, (function, args) in tasks]
+
+def task_failure(error):
+    """
+    Packs an exception so it can be sent back to the client.
+
+    Args:
+        error: The exception the task raised.
+
+    Returns:
+        (exception, traceback text). Exceptions that do not survive pickling
+        are replaced by a TaskError with the same message.
+    """
+    text = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+    try:
+        pickle.loads(pickle.dumps(error, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        error = TaskError(f"{type(error).__name__}: {error}")
+    return error, text
+
+def remote_exception(error, text):
+    """
+    Rebuilds the exception of a task that failed on a worker node.
+
+    Args:
+        error: The exception sent by the worker node.
+        text: The traceback text sent by the worker node.
+
+    Returns:
+        The exception, with the remote traceback as its cause.
+    """
+    error.__cause__ = RemoteTraceback(text)
+    return error
+
+def sendable(outcome):
+    """
+    Replaces a result that cannot be pickled with an error.
+
+    Args:
+        outcome: (task ID, succeeded, result or failure) tuple.
+
+    Returns:
+        The outcome, or a failed outcome if its value cannot be pickled.
+    """
+    task_id, _, value = outcome
+    try:
+        pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        return task_id, False, task_failure(TaskError(f"Result cannot be sent: {e}"))
+    return outcome
 
 """
 A task queue that stores tasks and provides methods to add and get tasks.
 """
 class TaskQueue:
-    def __init__(self):
+    def __init__(self, journal_path=None, fsync=False):
         """
         Initializes a task queue.
+
+        Tasks leave the queue lowest priority number first, and in the order
+        they were added within a priority.
+
+        With a journal_path the queue is durable: every change is appended to
+        that journal before it takes effect, so tasks still queued when the
+        process dies are back in the queue when it restarts. A compact index
+        next to the journal (journal_path + '.index') is checkpointed
+        regularly, so a restart only replays the journal written since the
+        last checkpoint and loads task payloads when they are taken.
+
+        Args:
+            journal_path: Optional journal file for a durable queue.
+            fsync: Flush every journal write to disk, to survive power loss as well.
         """
-        self.tasks = queue.Queue()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.heap = [] # (priority, sequence, task or None if not loaded yet, journal offset)
+        self.next_sequence = 0
+        self.journal = None
+        self.index_path = None
+        self.records_since_index = 0
+        self.dead_records = 0 # Journal records of tasks that already left the queue
+        if journal_path is not None:
+            self.recover(journal_path, fsync)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.heap)
 
-    def add_task(self, task):
+    def add_task(self, task, priority=0):
         """
         Adds a task to the queue.
 
         Args:
             task: The task to add.
+            priority: Tasks with a lower number are taken first.
         """
-        self.tasks.put(task)
+        self.add_tasks([task], priority)
 
-    def get_task(self):
+    def add_tasks(self, tasks, priority=0):
+        """
+        Adds several tasks with one journal write.
+
+        Args:
+            tasks: The tasks to add.
+            priority: Tasks with a lower number are taken first.
+        """
+        payloads = [pickle.dumps(task, protocol=pickle.HIGHEST_PROTOCOL) for task in tasks] \
+            if self.journal else None
+        with self.lock:
+            sequences = range(self.next_sequence, self.next_sequence + len(tasks))
+            self.next_sequence += len(tasks)
+            offsets = [None] * len(tasks)
+            if self.journal:
+                offsets = self.journal.append([(ADDED, sequence, priority, payload)
+                                               for sequence, payload in zip(sequences, payloads)])
+            for sequence, task, offset in zip(sequences, tasks, offsets):
+                heapq.heappush(self.heap, (priority, sequence, task, offset))
+            if self.journal:
+                # Only now, with the tasks in the heap, may a checkpoint or compaction describe them
+                self.journaled(len(tasks))
+            self.not_empty.notify(len(tasks))
+
+    def get_task(self, block=False, timeout=None):
         """
         Gets a task from the queue.
 
+        Args:
+            block: Wait for a task if the queue is empty.
+            timeout: Most seconds to wait when blocking; None waits forever.
+
         Returns:
             The task, or None if the queue is empty.
         """
-        if not self.tasks.empty():
-            return self.tasks.get()
-        return None
+        tasks = self.get_tasks(1, block, timeout)
+        return tasks[0] if tasks else None
+
+    def get_tasks(self, max_tasks, block=False, timeout=None):
+        """
+        Gets up to max_tasks tasks from the queue at once.
+
+        Args:
+            max_tasks: Most tasks to return.
+            block: Wait for at least one task if the queue is empty.
+            timeout: Most seconds to wait when blocking; None waits forever.
+
+        Returns:
+            A list of tasks, empty if none arrived in time.
+        """
+        with self.not_empty:
+            if block and not self.not_empty.wait_for(lambda: self.heap, timeout):
+                return []
+            entries = [heapq.heappop(self.heap) for _ in range(min(max_tasks, len(self.heap)))]
+            if not entries or not self.journal:
+                return [task for _, _, task, _ in entries]
+
+            # Load recovered tasks before a compaction can move their records
+            tasks = [task if task is not None else pickle.loads(self.journal.read(offset)[3])
+                     for _, _, task, offset in entries]
+            self.journal.append([(TAKEN, sequence, 0, b'') for _, sequence, _, _ in entries])
+            self.dead_records += 2 * len(entries)
+            self.journaled(len(entries))
+            return tasks
+
+    def recover(self, journal_path, fsync):
+        """
+        Opens the journal and rebuilds the queue from its index and the records written after it.
+
+        Args:
+            journal_path: The journal file.
+            fsync: Flush every journal write to disk.
+        """
+        self.journal = Journal(journal_path, fsync)
+        self.index_path = journal_path + ".index"
+        live = {} # sequence -> (priority, journal offset)
+        start = 0
+
+        try:
+            with open(self.index_path, 'rb') as file:
+                inode, covered, count = INDEX_HEADER.unpack(file.read(INDEX_HEADER.size))
+                # An index from before a compaction describes a different file
+                if inode == self.journal.inode and covered <= self.journal.size:
+                    for sequence, priority, offset in INDEX_ENTRY.iter_unpack(file.read(count * INDEX_ENTRY.size)):
+                        live[sequence] = (priority, offset)
+                    start = covered
+        except (OSError, struct.error) as e:
+            if os.path.exists(self.index_path):
+                print(f"Ignoring unreadable queue index: {e}")
+
+        end = start
+        last_sequence = max(live, default=-1)
+        for offset, kind, sequence, attribute, length in self.journal.scan(start):
+            if kind == ADDED:
+                live[sequence] = (attribute, offset)
+            elif kind == TAKEN:
+                live.pop(sequence, None)
+                self.dead_records += 2
+            last_sequence = max(last_sequence, sequence)
+            end = offset + RECORD_HEADER.size + length
+        if end < self.journal.size:
+            print(f"Dropping a torn record at the end of {journal_path}")
+            self.journal.truncate(end)
+
+        self.heap = [(priority, sequence, None, offset) for sequence, (priority, offset) in live.items()]
+        heapq.heapify(self.heap)
+        self.next_sequence = last_sequence + 1
+        self.write_index()
+
+    def journaled(self, count):
+        """
+        Compacts the journal or checkpoints the index once enough records were written.
+
+        Called with the lock held.
+
+        Args:
+            count: Number of records just written.
+        """
+        self.records_since_index += count
+        if self.dead_records >= max(COMPACT_MIN_RECORDS, len(self.heap)):
+            self.compact()
+        elif self.records_since_index >= INDEX_INTERVAL:
+            self.write_index()
+
+    def compact(self):
+        """
+        Rewrites the journal with only the tasks still queued. Called with the lock held.
+        """
+        records = [(ADDED, sequence, priority,
+                    pickle.dumps(task, protocol=pickle.HIGHEST_PROTOCOL) if task is not None
+                    else self.journal.read(offset)[3])
+                   for priority, sequence, task, offset in self.heap]
+        offsets = self.journal.rewrite(records)
+        # Keys are unchanged, so the list is still a valid heap
+        self.heap = [(priority, sequence, task, offset)
+                     for (priority, sequence, task, _), offset in zip(self.heap, offsets)]
+        self.dead_records = 0
+        self.write_index()
+
+    def write_index(self):
+        """
+        Checkpoints the queue's journal offsets to the index file. Called with the lock held.
+        """
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, 'wb') as file:
+            file.write(INDEX_HEADER.pack(self.journal.inode, self.journal.size, len(self.heap)))
+            file.write(b''.join(INDEX_ENTRY.pack(sequence, priority, offset)
+                                for priority, sequence, _, offset in self.heap))
+        os.replace(temp_path, self.index_path)
+        self.records_since_index = 0
+
+    def close(self):
+        """
+        Checkpoints the index and closes the journal of a durable queue.
+        """
+        with self.lock:
+            if self.journal:
+                self.write_index()
+                self.journal.close()
+                self.journal = None
 
 """
 A worker node that listens for tasks from a client and executes them.
 """
 class WorkerNode:
-    def __init__(self, host, port, task_queue):
+    def __init__(self, host, port, task_queue, processes=None, threads=None, default_executor='process',
+                 cache=None):
         """
         Initializes a worker node.
 
@@ -45,10 +477,92 @@ class WorkerNode:
             host: The host address of the worker node.
             port: The port number of the worker node.
             task_queue: The task queue to get tasks from.
+            processes: Size of the process pool. Defaults to the number of CPUs.
+            threads: Size of the thread pool. Defaults to the number of CPUs.
+            default_executor: Executor for tasks that carry no hint, 'process' or 'thread'.
+            cache: Optional ResultCache for results of pure tasks, shared by every connection and pool.
         """
+        if default_executor not in EXECUTORS:
+            raise ValueError(f"Unknown executor: {default_executor!r}")
         self.host = host
         self.port = port
         self.task_queue = task_queue
+        self.processes = processes or os.cpu_count() or 1
+        self.threads = threads or os.cpu_count() or 1
+        self.default_executor = default_executor
+        # The pools start their workers on first use
+        self.executors = {'process': self.new_process_pool(),
+                          'thread': ThreadPoolExecutor(self.threads)}
+        self.capacity = self.processes + self.threads # Tasks the node runs at once, reported in heartbeats
+        self.cache = cache
+        self.active = 0 # Tasks received and not finished yet
+        self.lock = threading.Lock()
+        self.host_id = host_id() # Clients with the same ID exchange large buffers through shared memory
+        self.shared_files = {} # connection -> shared memory files of results the client may not have read yet
+        self.serializers = {} # connection -> serializer negotiated in the client's hello
+
+    def new_process_pool(self):
+        """
+        Creates the node's process pool.
+
+        Returns:
+            ProcessPoolExecutor: The pool, starting its workers with PROCESS_START_METHOD.
+        """
+        return ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context(PROCESS_START_METHOD))
+
+    def run_in_pool(self, executor, function, *args):
+        """
+        Submits work to one of the node's pools.
+
+        A process pool breaks for good when one of its workers dies, e.g.
+        killed by the OS or unable to start; it is then replaced, so only
+        the work it was running fails.
+
+        Args:
+            executor: 'process' or 'thread'.
+            function: The function to run.
+            *args: Its arguments.
+
+        Returns:
+            The pool's Future.
+        """
+        pool = self.executors[executor]
+        try:
+            future = pool.submit(function, *args)
+        except BrokenProcessPool:
+            pool = self.replace_pool(pool)
+            future = pool.submit(function, *args)
+        if executor == 'process':
+            future.add_done_callback(lambda done: self.check_pool(pool, done))
+        return future
+
+    def check_pool(self, pool, future):
+        """
+        Replaces the process pool if a future it ran failed because the pool broke.
+
+        Args:
+            pool: The pool that ran the future.
+            future: The finished Future.
+        """
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            self.replace_pool(pool)
+
+    def replace_pool(self, broken):
+        """
+        Replaces a broken process pool, unless another thread already did.
+
+        Args:
+            broken: The broken pool.
+
+        Returns:
+            ProcessPoolExecutor: The pool now in use.
+        """
+        with self.lock:
+            if self.executors['process'] is broken:
+                print("Process pool broke; starting a new one")
+                self.executors['process'] = self.new_process_pool()
+                broken.shutdown(wait=False)
+            return self.executors['process']
 
     def start(self):
         """
@@ -64,15 +578,256 @@ class WorkerNode:
             sock.listen()
 
             while True:
-                # Accept a connection
+                # Accept a connection and serve it on its own thread
                 conn, addr = sock.accept()
-                with conn:
-                    data = conn.recv(4096)
-                    if not data:
+                threading.Thread(target=self.serve_connection, args=(conn,), daemon=True).start()
+
+    def serve_connection(self, conn):
+        """
+        Serves task requests on one persistent connection until the client closes it.
+
+        Args:
+            conn: The client connection.
+        """
+        send_lock = threading.Lock()
+        stop = threading.Event()
+        threading.Thread(target=self.send_heartbeats, args=(conn, send_lock, stop), daemon=True).start()
+        local = False # Whether the client runs on this host
+
+        with conn:
+            try:
+                while True:
+                    request = recv_frame(conn)
+                    if request is None:
                         break
-                    task = pickle.loads(data)
-                    result = self.execute_task(task)
-                    conn.sendall(pickle.dumps(result))
+                    if request.get('type') == 'hello':
+                        local = request.get('host_id') == self.host_id
+                        self.serializers[conn] = negotiate_serializer(request.get('serializers', ['pickle']))
+                        continue
+                    # Tasks run in the pools, so this thread can read the next request right away
+                    if request.get('type') == 'batch':
+                        self.submit_batch(conn, send_lock, request['tasks'], local)
+                        continue
+                    future = self.submit_task(request['task'], request.get('executor'), local)
+                    future.add_done_callback(
+                        lambda done, task_id=request['id']: self.send_result(conn, send_lock, task_id, done))
+            except (OSError, ValueError) as e:
+                print(f"Worker connection error: {e}")
+            finally:
+                stop.set()
+                self.serializers.pop(conn, None)
+                # Results the client never picked up would otherwise stay in memory until reboot
+                with self.lock:
+                    paths = self.shared_files.pop(conn, ())
+                for path in paths:
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+
+    def submit_task(self, task, executor=None, share_result=False):
+        """
+        Hands a task to one of the node's pools.
+
+        Args:
+            task: The task to execute.
+            executor: Optional 'process' or 'thread' hint from the request.
+            share_result: Return a large result through shared memory.
+
+        Returns:
+            A Future that receives run_task's outcome.
+        """
+        function, args = task
+        key = cache_key(self.cache, task)
+        if key is not None:
+            hit, result = self.cache.get(key)
+            if hit:
+                future = Future()
+                future.set_result((True, result))
+                return future
+
+        with self.lock:
+            self.active += 1
+        future = self.run_in_pool(self.pick_executor(task, executor), run_task, function, args, share_result)
+        future.add_done_callback(lambda done: self.task_finished())
+        if key is not None:
+            future.add_done_callback(lambda done: self.remember(key, function, done))
+        return future
+
+    def remember(self, key, function, future):
+        """
+        Caches the result of a finished pure task that succeeded.
+
+        Args:
+            key: The task's cache key.
+            function: The task function, for its TTL.
+            future: The finished Future with run_task's outcome.
+        """
+        if future.exception() is None:
+            succeeded, result = future.result()
+            if succeeded and not isinstance(result, SharedPayload):
+                self.cache.put(key, result, function.cache_ttl)
+
+    def submit_batch(self, conn, send_lock, tasks, share_result=False):
+        """
+        Runs a batch of tasks and sends their results back.
+
+        Each pool gets its share of the batch in as many slices as it has
+        workers, so a batch still spreads over every core. Every slice is
+        answered in one response as soon as it finishes, so a slow task only
+        holds back the results of its own slice.
+
+        Args:
+            conn: The client connection.
+            send_lock: Lock that serializes writes to the connection.
+            tasks: (task ID, task, executor hint) tuples.
+            share_result: Return large results through shared memory.
+        """
+        cached = [] # Outcomes answered from the cache
+        keys = {} # task ID -> (cache key, function) of the pure tasks that missed
+        groups = {}
+        for task_id, task, executor in tasks:
+            key = cache_key(self.cache, task)
+            if key is not None:
+                hit, result = self.cache.get(key)
+                if hit:
+                    cached.append((task_id, True, result))
+                    continue
+                keys[task_id] = (key, task[0])
+            groups.setdefault(self.pick_executor(task, executor), []).append((task_id, task))
+        if cached:
+            self.send_outcomes(conn, send_lock, cached)
+
+        slices = [] # (executor, slice of the batch)
+        for executor, items in groups.items():
+            workers = self.processes if executor == 'process' else self.threads
+            step = -(-len(items) // workers)
+            slices.extend((executor, items[start:start + step]) for start in range(0, len(items), step))
+
+        with self.lock:
+            self.active += len(tasks) - len(cached)
+        for executor, chunk in slices:
+            future = self.run_in_pool(executor, run_batch, chunk, share_result)
+            future.add_done_callback(
+                lambda done, chunk=chunk: self.send_slice_results(conn, send_lock, chunk, keys, done))
+
+    def send_slice_results(self, conn, send_lock, chunk, keys, future):
+        """
+        Sends the results of a finished slice of a batch back to the client.
+
+        Args:
+            conn: The client connection.
+            send_lock: Lock that serializes writes to the connection.
+            chunk: The slice, as (task ID, task) tuples.
+            keys: task ID -> (cache key, function) of the batch's pure tasks.
+            future: The finished Future of the slice.
+        """
+        self.task_finished(len(chunk))
+        try:
+            outcomes = future.result()
+        except Exception as e: # The pool could not run the slice, e.g. it failed to pickle
+            failure = task_failure(e)
+            outcomes = [(task_id, False, failure) for task_id, _ in chunk]
+        for task_id, succeeded, result in outcomes:
+            if succeeded and task_id in keys and not isinstance(result, SharedPayload):
+                key, function = keys[task_id]
+                self.cache.put(key, result, function.cache_ttl)
+        self.send_outcomes(conn, send_lock, outcomes)
+
+    def pick_executor(self, task, executor=None):
+        """
+        Picks the pool for a task from the request's hint, then the function's
+        run_in hint, then the node's default.
+
+        Args:
+            task: The task to execute.
+            executor: Optional 'process' or 'thread' hint from the request.
+
+        Returns:
+            'process' or 'thread'.
+        """
+        executor = executor or getattr(task[0], 'executor', None) or self.default_executor
+        return executor if executor in EXECUTORS else self.default_executor
+
+    def task_finished(self, count=1):
+        """
+        Updates the node's load when tasks finish.
+
+        Args:
+            count: Number of tasks that finished.
+        """
+        with self.lock:
+            self.active -= count
+
+    def send_result(self, conn, send_lock, task_id, future):
+        """
+        Sends the result of a finished task back to the client.
+
+        Args:
+            conn: The client connection.
+            send_lock: Lock that serializes writes to the connection.
+            task_id: The ID of the request, so the client can match the result to it.
+            future: The finished Future.
+        """
+        try:
+            succeeded, value = future.result()
+        except Exception as e: # The pool could not run the task, e.g. it failed to pickle
+            succeeded, value = False, task_failure(e)
+        self.send_outcomes(conn, send_lock, [(task_id, succeeded, value)])
+
+    def send_outcomes(self, conn, send_lock, outcomes):
+        """
+        Sends task outcomes back to the client in one response.
+
+        Args:
+            conn: The client connection.
+            send_lock: Lock that serializes writes to the connection.
+            outcomes: (task ID, succeeded, result or failure) tuples.
+        """
+        paths = [value.path for _, succeeded, value in outcomes if succeeded and isinstance(value, SharedPayload)]
+        if paths:
+            # The client unlinks them once read; remember them in case it never does
+            with self.lock:
+                pending = self.shared_files.setdefault(conn, set())
+                pending.update(paths)
+                if len(pending) > 256:
+                    pending.difference_update([path for path in pending if not os.path.exists(path)])
+        try:
+            with send_lock:
+                try:
+                    send_frame(conn, {'type': 'results', 'results': outcomes}, self.serializers.get(conn))
+                except OSError:
+                    raise
+                except Exception:
+                    # A result could not be pickled; fail just that task instead of the whole response
+                    send_frame(conn, {'type': 'results', 'results': [sendable(outcome) for outcome in outcomes]},
+                               self.serializers.get(conn))
+        except OSError as e:
+            print(f"Worker connection error: {e}")
+
+    def send_heartbeats(self, conn, send_lock, stop):
+        """
+        Reports the node's load on a connection until it closes.
+
+        The first heartbeat goes out immediately, so clients learn the node's
+        capacity before they send anything.
+
+        Args:
+            conn: The client connection.
+            send_lock: Lock that serializes writes to the connection.
+            stop: Event set when the connection closes.
+        """
+        while not stop.is_set():
+            with self.lock:
+                heartbeat = {'type': 'heartbeat', 'queue_depth': self.active, 'capacity': self.capacity,
+                             'processes': self.processes, 'threads': self.threads, 'host_id': self.host_id,
+                             'serializers': available_serializers()}
+            try:
+                with send_lock:
+                    send_frame(conn, heartbeat, self.serializers.get(conn))
+            except OSError:
+                break
+            stop.wait(HEARTBEAT_INTERVAL)
 
     def execute_task(self, task):
         """
@@ -83,108 +838,1081 @@ class WorkerNode:
 
         Returns:
             The result of the task.
+
+        Raises:
+            The exception the task raised.
         """
         function, args = task
-        try:
-            result = function(*args)
-            print("Node executed task: " + str(result))
-            return result
-        except Exception as e:
-            return f"Error: {str(e)}"
+        succeeded, value = run_task(function, args)
+        if not succeeded:
+            raise value[0]
+        return value
+
+"""
+Scheduling policy that hands tasks to the nodes in turn.
+"""
+class RoundRobinPolicy:
+    def __init__(self):
+        """
+        Initializes the policy.
+        """
+        self.counter = itertools.count()
+
+    def select(self, nodes):
+        """
+        Selects a node.
+
+        Args:
+            nodes: The available nodes.
+
+        Returns:
+            The selected node.
+        """
+        return nodes[next(self.counter) % len(nodes)]
+
+"""
+Scheduling policy that picks the node with the fewest outstanding tasks per unit of capacity.
+"""
+class LeastOutstandingPolicy:
+    def select(self, nodes):
+        """
+        Selects a node.
+
+        Args:
+            nodes: The available nodes.
+
+        Returns:
+            The selected node.
+        """
+        return min(nodes, key=lambda node: node.outstanding / node.capacity)
+
+"""
+Scheduling policy that samples two nodes and picks the one expected to answer sooner.
+
+Looking at two random nodes instead of all of them avoids herding every
+client onto the same "best" node while still steering away from slow ones.
+"""
+class PowerOfTwoChoicesPolicy:
+    def select(self, nodes):
+        """
+        Selects a node.
+
+        Args:
+            nodes: The available nodes.
+
+        Returns:
+            The selected node.
+        """
+        if len(nodes) == 1:
+            return nodes[0]
+        return min(random.sample(nodes, 2), key=lambda node: node.expected_latency())
+
+"""
+The Future of a task submitted through a Client.
+
+The client may send the task more than once: to another node after the
+connection it was sent on was lost, or as a speculative duplicate when it
+straggles. The first result to arrive is kept.
+"""
+class TaskFuture(Future):
+    def __init__(self, task, executor=None, idempotent=False, retries=0, timeout=None):
+        """
+        Initializes the Future of a task.
+
+        Args:
+            task: The task.
+            executor: Optional 'process' or 'thread' hint for the worker nodes.
+            idempotent: The task may run more than once.
+            retries: Times the task may be sent again after a lost connection.
+            timeout: Optional seconds until the task fails with concurrent.futures.TimeoutError.
+        """
+        super().__init__()
+        self.task_id = next(TASK_IDS)
+        self.task = task
+        self.executor = executor
+        self.idempotent = idempotent
+        self.retries = retries
+        self.started = time.monotonic()
+        self.deadline = self.started + timeout if timeout is not None else None
+        self.duplicated = False # A speculative duplicate was sent
+        self.attempts = [] # (node, Future) for every time the task was sent
+        self.lock = threading.Lock() # Guards attempts and retries
+
+    def running_attempts(self):
+        """
+        Counts the attempts that have not finished yet.
+
+        Returns:
+            The number of attempts still waiting for a result.
+        """
+        with self.lock:
+            return sum(1 for _, attempt in self.attempts if not attempt.done())
+
+    def cancel(self):
+        """
+        Cancels the task if none of its attempts was sent to a node yet.
+
+        Returns:
+            True if the task was cancelled.
+        """
+        with self.lock:
+            attempts = [attempt for _, attempt in self.attempts]
+        cancelled = [attempt.cancel() for attempt in attempts]
+        return all(cancelled) and super().cancel()
+
+"""
+Tasks submitted together, such as by Client.map, whose stragglers the client may duplicate.
+"""
+class TaskGroup:
+    def __init__(self, futures):
+        """
+        Initializes a group.
+
+        Args:
+            futures: TaskFutures of the tasks.
+        """
+        self.futures = futures
+        self.lock = threading.Lock()
+        self.remaining = len(futures)
+        self.durations = [] # Seconds each finished task took
+        self.median = None # Median of durations, once enough tasks finished
+        for future in futures:
+            future.add_done_callback(self.task_finished)
+
+    def task_finished(self, future):
+        """
+        Records the duration of a finished task.
+
+        Args:
+            future: The task's TaskFuture.
+        """
+        with self.lock:
+            self.remaining -= 1
+            if not future.cancelled():
+                self.durations.append(time.monotonic() - future.started)
+
+    def done(self):
+        """
+        Checks whether every task of the group has finished.
+        """
+        return self.remaining == 0
+
+    def stragglers(self, now):
+        """
+        Finds the tasks worth duplicating: once most of the group has
+        finished, the idempotent tasks that have been running much longer
+        than the group's median.
+
+        Args:
+            now: The current time.monotonic().
+
+        Returns:
+            A list of TaskFutures.
+        """
+        with self.lock:
+            if len(self.durations) < SPECULATE_AFTER * len(self.futures):
+                return []
+            if self.median is None:
+                self.median = sorted(self.durations)[len(self.durations) // 2]
+            limit = SPECULATE_FACTOR * self.median
+        return [future for future in self.futures
+                if future.idempotent and not future.duplicated and not future.done()
+                and now - future.started > limit]
 
 """
 A client that distributes tasks to worker nodes and collects the results.
 """
 class Client:
-    def __init__(self, worker_nodes):
+    def __init__(self, worker_nodes, policy=None, cache=None, timeout=None, retries=MAX_RETRIES, speculate=False):
         """
         Initializes a client.
 
         Args:
             worker_nodes: A list of worker nodes.
+            policy: Scheduling policy. Defaults to LeastOutstandingPolicy.
+            cache: Optional ResultCache; results of pure tasks found there never leave the client.
+            timeout: Default seconds a task may take before it fails, None to wait forever.
+            retries: Times a task is sent to another node after the connection it was sent
+                on was lost. Only idempotent tasks are sent again once they reached a node.
+            speculate: Let map() and distribute_tasks() run a duplicate of an idempotent
+                task that straggles behind the rest, on another node, and keep whichever
+                result arrives first.
         """
         print("Client initialized")
         self.worker_nodes = worker_nodes
+        self.policy = policy or LeastOutstandingPolicy()
+        self.capacity_freed = threading.Event() # Set whenever a task finishes
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.in_flight = {} # cache key -> Future of a pure task that was sent and not answered yet
+        self.joined = 0 # Pure tasks that waited for an identical task in flight instead of being sent
 
-    def distribute_tasks(self, tasks):
+        # Deadlines, retries and speculation are handled by a supervisor thread
+        self.timeout = timeout
+        self.retries = retries
+        self.speculate = speculate
+        self.supervision = threading.Condition() # Guards the fields below and wakes the supervisor
+        self.deadlines = [] # Heap of (deadline, task ID, TaskFuture)
+        self.retry_queue = [] # (TaskFuture, node that lost it) tuples waiting to be sent again
+        self.groups = [] # TaskGroups still running
+        self.supervisor = None
+
+    def submit(self, task, executor=None, timeout=None, idempotent=None):
         """
-        Distributes tasks to worker nodes.
+        Sends a task to a worker node without waiting for the result.
+
+        Waits while every live node is saturated.
 
         Args:
-            tasks: A list of tasks.
+            task: The task to execute.
+            executor: Optional 'process' or 'thread' hint, overriding the function's run_in hint.
+            timeout: Optional seconds until the task fails with
+                concurrent.futures.TimeoutError, overriding the client's default.
+            idempotent: Whether the task may run more than once, overriding the
+                function's idempotent or pure marker.
+
+        Returns:
+            A TaskFuture with the task's ID as its task_id attribute. Its result()
+            returns the task's result or raises the exception the task raised.
+
+        Raises:
+            ConnectionError: If no worker node is available.
+        """
+        key = cache_key(self.cache, task)
+        if key is not None:
+            hit, result = self.cache.get(key)
+            if hit:
+                future = TaskFuture(task)
+                future.set_result(result)
+                return future
+            with self.lock:
+                sent = self.in_flight.get(key)
+                if sent is not None:
+                    self.joined += 1
+            if sent is not None:
+                return self.follow(task, sent)
+
+        if idempotent is None:
+            idempotent = getattr(task[0], 'idempotent', False)
+        timeout = self.timeout if timeout is None else timeout
+        future = TaskFuture(task, executor, idempotent, self.retries, timeout)
+        if not self.send_attempt(future):
+            raise ConnectionError("No worker node available")
+        if future.deadline is not None:
+            with self.supervision:
+                heapq.heappush(self.deadlines, (future.deadline, future.task_id, future))
+                self.wake_supervisor()
+        if key is not None:
+            with self.lock:
+                self.in_flight[key] = future
+            future.add_done_callback(lambda done: self.remember(key, task[0], done))
+        return future
+
+    def send_attempt(self, future, exclude=(), wait=True):
+        """
+        Sends a task to one more node.
+
+        Args:
+            future: The task's TaskFuture.
+            exclude: Nodes not to send it to.
+            wait: Wait while every live node is saturated; otherwise give up at once.
+
+        Returns:
+            True if the task was sent, False if no node could take it.
+        """
+        node = self.get_available_node(exclude, wait)
+        if node is None:
+            return False
+        attempt = node.enqueue(future.task, future.executor)
+        with future.lock:
+            future.attempts.append((node, attempt))
+        attempt.add_done_callback(lambda done: self.attempt_done(future, node, done))
+        return True
+
+    def attempt_done(self, future, node, attempt):
+        """
+        Settles a task when one of its attempts finishes, or arranges for it
+        to be sent again if the attempt's connection was lost.
+
+        Args:
+            future: The task's TaskFuture.
+            node: The node the attempt was sent to.
+            attempt: The attempt's finished Future.
+        """
+        self.capacity_freed.set()
+        try:
+            result = attempt.result()
+        except concurrent.futures.CancelledError:
+            return
+        except Exception as e:
+            error = e
+        else:
+            self.settle(future, result)
+            return
+        if future.done():
+            return
+        # A task that raised ConnectionError itself carries its remote traceback
+        if isinstance(error, ConnectionError) and not isinstance(error.__cause__, RemoteTraceback):
+            if future.running_attempts():
+                return # A duplicate may still deliver
+            with future.lock:
+                retry = future.retries > 0 and (future.idempotent or isinstance(error, TaskNotSent))
+                if retry:
+                    future.retries -= 1
+            if retry:
+                with self.supervision:
+                    self.retry_queue.append((future, node))
+                    self.wake_supervisor()
+                return
+        self.settle(future, error=error)
+
+    def settle(self, future, result=None, error=None):
+        """
+        Resolves a task unless another attempt or its deadline got there
+        first, and abandons its other attempts: those not sent yet are
+        withdrawn, the others free their node's slot at once.
+
+        Args:
+            future: The task's TaskFuture.
+            result: The result.
+            error: The exception, if the task failed.
+        """
+        try:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        except concurrent.futures.InvalidStateError:
+            return
+        with future.lock:
+            attempts = [(node, attempt) for node, attempt in future.attempts if not attempt.done()]
+        for node, attempt in attempts:
+            node.abandon(attempt)
+
+    def wake_supervisor(self):
+        """
+        Starts the supervisor thread, or wakes it up. Called with supervision held.
+        """
+        if self.supervisor is None:
+            self.supervisor = threading.Thread(target=self.supervise, daemon=True)
+            self.supervisor.start()
+        self.supervision.notify()
+
+    def supervise(self):
+        """
+        Fails tasks that missed their deadline, sends tasks again after a lost
+        connection and duplicates stragglers. Runs in its own thread.
+        """
+        while True:
+            with self.supervision:
+                if not (self.deadlines or self.retry_queue or self.groups):
+                    self.supervision.wait()
+                elif not self.retry_queue:
+                    wait = SUPERVISE_INTERVAL
+                    if self.deadlines:
+                        wait = min(wait, self.deadlines[0][0] - time.monotonic())
+                    if wait > 0:
+                        self.supervision.wait(wait)
+                now = time.monotonic()
+                expired = []
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    expired.append(heapq.heappop(self.deadlines)[2])
+                retries, self.retry_queue = self.retry_queue, []
+                self.groups = [group for group in self.groups if not group.done()]
+                groups = list(self.groups)
+
+            for future in expired:
+                if not future.done():
+                    self.settle(future, error=concurrent.futures.TimeoutError(
+                        f"Task {future.task_id} missed its deadline"))
+            for future, node in retries:
+                self.retry(future, node)
+            for group in groups:
+                for future in group.stragglers(now):
+                    self.duplicate(future)
+
+    def retry(self, future, lost_node):
+        """
+        Sends a task again, to another node than the one that lost it if possible.
+
+        Args:
+            future: The task's TaskFuture.
+            lost_node: The node whose connection was lost.
+        """
+        if future.done() or future.running_attempts():
+            return
+        if self.send_attempt(future, (lost_node,), wait=False) or self.send_attempt(future, wait=False):
+            print(f"Task {future.task_id} sent again after losing {lost_node.host}:{lost_node.port}")
+        elif any(node.is_alive() for node in self.worker_nodes):
+            # Every node is saturated; try again on the next round
+            with self.supervision:
+                self.retry_queue.append((future, lost_node))
+        else:
+            self.settle(future, error=ConnectionError("No worker node available"))
+
+    def duplicate(self, future):
+        """
+        Runs a speculative duplicate of a straggling task on another node.
+
+        Args:
+            future: The task's TaskFuture.
+        """
+        with future.lock:
+            busy = {node for node, attempt in future.attempts if not attempt.done()}
+        if self.send_attempt(future, busy, wait=False):
+            future.duplicated = True
+            print(f"Task {future.task_id} is straggling; running a duplicate")
+
+    def watch(self, futures):
+        """
+        Lets the supervisor duplicate the stragglers of a group of tasks, if speculation is on.
+
+        Args:
+            futures: TaskFutures of the group.
+        """
+        if not self.speculate:
+            return
+        with self.supervision:
+            self.groups.append(TaskGroup(futures))
+            self.wake_supervisor()
+
+    def follow(self, task, sent):
+        """
+        Makes a Future that resolves like an identical task already in flight.
+
+        Args:
+            task: The task.
+            sent: The Future of the task in flight.
 
         Returns:
-            A list of results.
+            A new TaskFuture with its own task_id.
+        """
+        future = TaskFuture(task)
+        def copy(done):
+            if done.cancelled():
+                future.set_exception(concurrent.futures.CancelledError())
+            elif done.exception() is not None:
+                future.set_exception(done.exception())
+            else:
+                future.set_result(done.result())
+        sent.add_done_callback(copy)
+        return future
+
+    def remember(self, key, function, future):
         """
-        results = []
-        threads = []
+        Caches the result of a finished pure task that succeeded.
 
-        for task in tasks:
-            print("Getting available node")
-            node = self.get_available_node()
-            if node:
-                thread = threading.Thread(target=self.execute_task_on_node, args=(node, task, results))
-                threads.append(thread)
-                thread.start()
+        Args:
+            key: The task's cache key.
+            function: The task function, for its TTL.
+            future: The task's finished Future.
+        """
+        with self.lock:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+        if not future.cancelled() and future.exception() is None:
+            self.cache.put(key, future.result(), function.cache_ttl)
 
-        for thread in threads:
-            thread.join()
+    def cache_stats(self):
+        """
+        Reports what the client-side cache saved.
 
-        return results
+        Returns:
+            The cache's statistics, plus 'joined': tasks that shared the result
+            of an identical task in flight. None without a cache.
+        """
+        if self.cache is None:
+            return None
+        stats = self.cache.stats()
+        with self.lock:
+            stats['joined'] = self.joined
+        return stats
 
-    def get_available_node(self):
+    def map(self, function, *iterables, executor=None, timeout=None):
+        """
+        Runs function on the worker nodes for every set of arguments, like the built-in map.
+
+        All tasks are submitted before this returns.
+
+        Args:
+            function: The task function.
+            iterables: Iterables that supply the positional arguments.
+            executor: Optional 'process' or 'thread' hint, overriding the function's run_in hint.
+            timeout: Optional seconds each task may take, overriding the client's default.
+
+        Returns:
+            An iterator over the results in input order. It raises the
+            exception of a failed task when it reaches that task.
+        """
+        futures = [self.submit((function, args), executor, timeout) for args in zip(*iterables)]
+        self.watch(futures)
+        return (future.result() for future in futures)
+
+    def as_completed(self, futures, timeout=None):
+        """
+        Yields futures from submit() as they finish, so early results can be used right away.
+
+        Args:
+            futures: Futures returned by submit().
+            timeout: Optional seconds to wait for all of them.
+
+        Returns:
+            An iterator over the futures in completion order.
+        """
+        return concurrent.futures.as_completed(futures, timeout)
+
+    def distribute_tasks(self, tasks, timeout=None):
+        """
+        Distributes tasks to worker nodes and waits for all of them.
+
+        Args:
+            tasks: A list of tasks.
+            timeout: Optional seconds each task may take, overriding the client's default.
+
+        Returns:
+            A list of results, in the order of the tasks.
+
+        Raises:
+            concurrent.futures.TimeoutError: If a task missed its deadline.
+            The exception of the first failed task.
+        """
+        futures = [self.submit(task, timeout=timeout) for task in tasks]
+        self.watch(futures)
+        return [future.result() for future in futures]
+
+    def get_available_node(self, exclude=(), wait=True):
         """
         Gets an available worker node.
 
+        Dead nodes are skipped. If every live node is saturated this waits
+        until one of them finishes a task.
+
+        Args:
+            exclude: Nodes not to choose.
+            wait: Whether to wait for a saturated node; if False, None is returned instead.
+
         Returns:
             A worker node, or None if no available node is found.
         """
-        for node in self.worker_nodes:
-            return node
-        return None
+        while True:
+            alive = [node for node in self.worker_nodes if node not in exclude and node.is_alive()]
+            if not alive:
+                return None
+            available = [node for node in alive if not node.is_saturated()]
+            if available:
+                return self.policy.select(available)
+            if not wait:
+                return None
+            self.capacity_freed.wait(0.1)
+            self.capacity_freed.clear()
+
+"""
+A persistent, multiplexed connection from a node to a worker node.
+"""
+class NodeConnection:
+    def __init__(self, host, port, on_heartbeat, shared_memory=True):
+        """
+        Opens a connection to a worker node and starts reading its responses.
+
+        Args:
+            host: The host address of the worker node.
+            port: The port number of the worker node.
+            on_heartbeat: Called with every heartbeat frame the worker sends.
+            shared_memory: Accept large results through shared memory if the worker node runs on this host.
+        """
+        self.on_heartbeat = on_heartbeat
+        self.sock = socket.create_connection((host, port), timeout=RETRY_DELAY)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Lets the worker node tell whether it can hand results back through shared memory,
+        # and which serializers it may answer with
+        send_frame(self.sock, {'type': 'hello', 'host_id': host_id() if shared_memory else None,
+                               'serializers': available_serializers()})
+        self.serializer = None # Pickle until the first heartbeat says what the worker node accepts
+        self.send_lock = threading.Lock() # Serializes writes to the socket
+        self.lock = threading.Lock() # Guards pending and closed
+        self.pending = {} # task ID -> Future waiting for its result
+        self.closed = False
+        self.reader = threading.Thread(target=self.read_responses, daemon=True)
+        self.reader.start()
 
-    def execute_task_on_node(self, node, task, results):
+    def send(self, task_id, task, future, executor=None):
         """
-        Executes a task on a worker node.
+        Sends a task without waiting for earlier tasks on this connection to finish.
 
         Args:
-            node: The worker node to execute the task on.
+            task_id: The ID the response will carry.
             task: The task to execute.
-            results: A list to store the results.
+            future: The Future that receives the result.
+            executor: Optional 'process' or 'thread' hint for the worker node.
+
+        Raises:
+            The serializer's error, such as pickle.PicklingError, if the task cannot be encoded.
+        """
+        # Encode first, so a task that cannot be encoded is never registered
+        frame = encode_frame({'id': task_id, 'task': task, 'executor': executor}, self.serializer)
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("Connection to worker node is closed")
+            self.pending[task_id] = future
+        try:
+            with self.send_lock:
+                self.sock.sendall(frame)
+        except OSError as e:
+            # A frame cut short is never run, so the task can go elsewhere
+            with self.lock:
+                self.pending.pop(task_id, None)
+            self.close()
+            raise TaskNotSent(f"Task could not be sent: {e}") from e
+
+    def forget(self, task_id):
+        """
+        Stops waiting for a task's result; the result is ignored if it still arrives.
+
+        Args:
+            task_id: The task's ID.
+
+        Returns:
+            True if the task was waiting on this connection.
+        """
+        with self.lock:
+            return self.pending.pop(task_id, None) is not None
+
+    def send_batch(self, tasks):
         """
-        result = node.execute_task(task)
-        results.append(result)
+        Sends several tasks in one request; the worker node answers with all results at once.
+
+        Tasks that cannot be encoded, such as lambdas under pickle, fail
+        with the serializer's error; the rest of the batch is sent.
+
+        Args:
+            tasks: (task ID, task, executor hint, Future) tuples.
+        """
+        serializer = self.serializer
+        try:
+            frame = encode_frame({'type': 'batch',
+                                  'tasks': [(task_id, task, executor) for task_id, task, executor, _ in tasks]},
+                                 serializer)
+        except Exception:
+            # Find the tasks at fault; encoding each one alone is only paid for a bad batch
+            tasks = [item for item in tasks if self.encodes(item, serializer)]
+            if not tasks:
+                return
+            frame = encode_frame({'type': 'batch',
+                                  'tasks': [(task_id, task, executor) for task_id, task, executor, _ in tasks]},
+                                 serializer)
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("Connection to worker node is closed")
+            for task_id, _, _, future in tasks:
+                self.pending[task_id] = future
+        try:
+            with self.send_lock:
+                self.sock.sendall(frame)
+        except OSError as e:
+            with self.lock:
+                for task_id, _, _, _ in tasks:
+                    self.pending.pop(task_id, None)
+            self.close()
+            raise TaskNotSent(f"Tasks could not be sent: {e}") from e
+
+    def encodes(self, item, serializer):
+        """
+        Checks that a task of a batch can be encoded, failing its Future if not.
+
+        Args:
+            item: (task ID, task, executor hint, Future) tuple.
+            serializer: The connection's serializer.
+
+        Returns:
+            True if the task can be sent.
+        """
+        task_id, task, executor, future = item
+        try:
+            encode_frame((task_id, task, executor), serializer)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return False
+        return True
+
+    def read_responses(self):
+        """
+        Resolves pending Futures as responses arrive, in any order.
+        """
+        try:
+            while True:
+                response = recv_frame(self.sock)
+                if response is None:
+                    break
+                if response.get('type') == 'heartbeat':
+                    if self.serializer is None:
+                        self.serializer = negotiate_serializer(response.get('serializers', ['pickle']))
+                    self.on_heartbeat(response)
+                    continue
+                with self.lock:
+                    futures = [(self.pending.pop(task_id, None), succeeded, value)
+                               for task_id, succeeded, value in response['results']]
+                for future, succeeded, value in futures:
+                    if future is None:
+                        # The task was abandoned, e.g. after its deadline
+                        if isinstance(value, SharedPayload):
+                            value.unlink()
+                        continue
+                    if not succeeded:
+                        future.set_exception(remote_exception(*value))
+                    elif isinstance(value, SharedPayload):
+                        try:
+                            result = value.load()
+                        except Exception as e:
+                            future.set_exception(e)
+                        else:
+                            future.set_result(result)
+                        finally:
+                            value.unlink()
+                    else:
+                        future.set_result(value)
+        except (OSError, ValueError) as e:
+            if not self.closed: # Closing the socket ourselves also ends the read
+                print(f"Node connection error: {e}")
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Closes the connection and fails every task still waiting on it.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Connection to worker node was lost"))
 
 """
 A node that can execute tasks.
 """
 class Node:
-    def __init__(self, host, port):
+    def __init__(self, host, port, pool_size=2, batch_size=BATCH_SIZE, batch_window=BATCH_WINDOW,
+                 shared_memory=True):
         """
         Initializes a node.
 
         Args:
             host: The host address of the node.
             port: The port number of the node.
+            pool_size: Number of connections kept open to the node.
+            batch_size: Most tasks enqueue() sends in one request.
+            batch_window: Seconds a partial batch waits for more tasks before it is sent.
+            shared_memory: Pass large arguments through shared memory when the node runs on this host.
         """
         self.host = host
         self.port = port
+        self.shared_memory = shared_memory
+        self.host_id = host_id()
+        self.same_host = False # Learned from the node's heartbeats
+        self.pool_size = pool_size
+        self.connections = []
+        self.lock = threading.Lock()
+        self.next_connection = 0
 
-    def execute_task(self, task):
+        # Load and health, used by the client's scheduling policy
+        self.outstanding = 0 # Tasks sent and not answered yet
+        self.latency = None # Moving average of task round trip time, in seconds
+        self.capacity = 1 # Tasks the node runs at once, from its heartbeats
+        self.queue_depth = 0 # Tasks running on the node, from its heartbeats
+        self.last_heartbeat = None
+        self.down_until = 0.0 # The node is skipped until this time.monotonic() value
+        self.max_outstanding_per_slot = 4 # Outstanding tasks per unit of capacity before the node counts as saturated
+
+        # Tasks waiting to be sent as one batch
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.batch = [] # (task ID, task, executor hint, Future) tuples
+        self.batch_started = 0.0 # time.monotonic() when the first task of the batch arrived
+        self.batch_ready = threading.Condition() # Guards the batch and wakes the flusher
+        self.flusher = None
+
+    def on_heartbeat(self, heartbeat):
+        """
+        Records the load a worker node reported.
+
+        Args:
+            heartbeat: The heartbeat frame.
+        """
+        with self.lock:
+            self.capacity = max(1, heartbeat['capacity'])
+            self.queue_depth = heartbeat['queue_depth']
+            self.last_heartbeat = time.monotonic()
+            self.same_host = heartbeat.get('host_id') == self.host_id
+
+    def share_arguments(self, task, future):
+        """
+        Moves large arguments of a task into shared memory if the node runs on this host.
+
+        The shared memory file is removed once the task finishes.
+
+        Args:
+            task: The task.
+            future: The task's Future.
+
+        Returns:
+            The task to send, with a SharedPayload in place of its arguments if they were moved.
+        """
+        function, args = task
+        if not (self.shared_memory and self.same_host and worth_sharing(args)):
+            return task
+        payload = share(args)
+        if payload is None:
+            return task
+        future.add_done_callback(lambda done: payload.unlink())
+        return function, payload
+
+    def is_alive(self):
+        """
+        Checks whether the node can take tasks.
+
+        A node is dead for RETRY_DELAY seconds after a connection to it
+        failed, and when its heartbeats stop; in that case its connections are
+        closed so the tasks waiting on them fail instead of hanging.
+
+        Returns:
+            True if the node looks healthy.
+        """
+        now = time.monotonic()
+        if now < self.down_until:
+            return False
+        with self.lock:
+            connected = any(not conn.closed for conn in self.connections)
+            stale = connected and self.last_heartbeat is not None and \
+                now - self.last_heartbeat > HEARTBEAT_TIMEOUT
+        if stale:
+            print(f"Node {self.host}:{self.port} stopped sending heartbeats")
+            self.down_until = now + RETRY_DELAY
+            self.last_heartbeat = None
+            self.close()
+            return False
+        return True
+
+    def is_saturated(self):
+        """
+        Checks whether the node already has as much work as it should queue.
+
+        Returns:
+            True if no more tasks should be sent to the node for now.
+        """
+        # Leave room for two full batches, so the next one is on its way while the node runs the last
+        limit = max(self.capacity * self.max_outstanding_per_slot, 2 * self.batch_size)
+        return self.outstanding >= limit
+
+    def expected_latency(self):
+        """
+        Estimates how long a new task would take on this node.
+
+        Returns:
+            Estimated seconds, based on the average latency and the current backlog.
+        """
+        latency = self.latency if self.latency is not None else 0.0
+        return latency * (self.outstanding + 1) / self.capacity
+
+    def task_done(self, started, future):
+        """
+        Updates the load and latency figures when a task finishes.
+
+        Args:
+            started: time.monotonic() when the task was sent.
+            future: The finished Future.
+        """
+        elapsed = time.monotonic() - started
+        with self.lock:
+            self.outstanding -= 1
+            if not future.cancelled() and future.exception() is None:
+                self.latency = elapsed if self.latency is None else \
+                    (1 - LATENCY_WEIGHT) * self.latency + LATENCY_WEIGHT * elapsed
+
+    def abandon(self, future):
+        """
+        Gives up on a task sent to the node, so it stops counting as outstanding.
+
+        A task still waiting for its batch is withdrawn. A task already sent
+        keeps running on the node, but its Future fails with CancelledError
+        right away and its result is ignored if it arrives later.
+
+        Args:
+            future: The Future returned by submit() or enqueue().
+        """
+        if future.cancel():
+            return
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            if connection.forget(future.task_id):
+                future.set_exception(concurrent.futures.CancelledError(f"Task {future.task_id} was abandoned"))
+                return
+
+    def get_connection(self):
+        """
+        Gets a pooled connection, opening one if the pool is not full yet.
+
+        Returns:
+            A NodeConnection.
+        """
+        with self.lock:
+            # Drop connections that failed
+            self.connections = [conn for conn in self.connections if not conn.closed]
+            if len(self.connections) < self.pool_size:
+                try:
+                    self.connections.append(NodeConnection(self.host, self.port, self.on_heartbeat, self.shared_memory))
+                except OSError:
+                    if not self.connections:
+                        # Skip the node for a while instead of retrying on every task
+                        self.down_until = time.monotonic() + RETRY_DELAY
+                        raise
+                if self.last_heartbeat is None:
+                    # Start the heartbeat clock, so a node that never reports also times out
+                    self.last_heartbeat = time.monotonic()
+            # Spread tasks over the pool
+            self.next_connection = (self.next_connection + 1) % len(self.connections)
+            return self.connections[self.next_connection]
+
+    def submit(self, task, executor=None):
+        """
+        Sends a task to the node without waiting for the result.
+
+        Args:
+            task: The task to execute.
+            executor: Optional 'process' or 'thread' hint, overriding the function's run_in hint.
+
+        Returns:
+            A Future that receives the result of the task, with the task's ID as its task_id attribute.
+        """
+        future = Future()
+        future.task_id = next(TASK_IDS)
+        connection = self.get_connection()
+        with self.lock:
+            self.outstanding += 1
+        started = time.monotonic()
+        future.add_done_callback(lambda done: self.task_done(started, done))
+        future.set_running_or_notify_cancel()
+        task = self.share_arguments(task, future)
+        try:
+            connection.send(future.task_id, task, future, executor)
+        except Exception as e: # Unreachable node, or a task that cannot be encoded
+            if not future.done():
+                future.set_exception(e)
+        return future
+
+    def enqueue(self, task, executor=None):
+        """
+        Adds a task to the node's next batch without waiting for the result.
+
+        The batch is sent when it holds batch_size tasks or batch_window
+        seconds after its first task, whichever comes first. The Future can
+        be cancelled until its batch is sent.
+
+        Args:
+            task: The task to execute.
+            executor: Optional 'process' or 'thread' hint, overriding the function's run_in hint.
+
+        Returns:
+            A Future that receives the result of the task, with the task's ID as its task_id attribute.
+        """
+        future = Future()
+        future.task_id = next(TASK_IDS)
+        with self.lock:
+            self.outstanding += 1
+        started = time.monotonic()
+        future.add_done_callback(lambda done: self.task_done(started, done))
+        task = self.share_arguments(task, future)
+
+        full = None
+        with self.batch_ready:
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.flush_batches, daemon=True)
+                self.flusher.start()
+            if not self.batch:
+                self.batch_started = started
+                self.batch_ready.notify()
+            self.batch.append((future.task_id, task, executor, future))
+            if len(self.batch) >= self.batch_size:
+                full, self.batch = self.batch, []
+        if full:
+            self.send_batch(full)
+        return future
+
+    def flush_batches(self):
+        """
+        Sends partial batches once their latency window has passed.
+        """
+        while True:
+            with self.batch_ready:
+                while not self.batch:
+                    self.batch_ready.wait()
+                deadline = self.batch_started + self.batch_window
+                now = time.monotonic()
+                if now < deadline:
+                    self.batch_ready.wait(deadline - now)
+                    # The batch may have filled up and gone, or a new one started
+                    if not self.batch or time.monotonic() < self.batch_started + self.batch_window:
+                        continue
+                batch, self.batch = self.batch, []
+            try:
+                self.send_batch(batch)
+            except Exception as e:
+                # Keep the flusher alive, or every later partial batch would wait forever
+                print(f"Error: batch for {self.host}:{self.port} failed: {e}")
+
+    def send_batch(self, batch):
+        """
+        Sends a batch of tasks in one request.
+
+        Args:
+            batch: (task ID, task, executor hint, Future) tuples.
+        """
+        # Drop tasks cancelled while they waited; the rest can no longer be cancelled
+        batch = [item for item in batch if item[3].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            self.get_connection().send_batch(batch)
+        except Exception as e:
+            if isinstance(e, OSError) and not isinstance(e, TaskNotSent):
+                e = TaskNotSent(f"Node {self.host}:{self.port} is unreachable: {e}")
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def execute_task(self, task, timeout=None):
         """
         Executes a task.
 
         Args:
             task: The task to execute.
+            timeout: Optional seconds to wait for the result.
 
         Returns:
             The result of the task.
+
+        Raises:
+            concurrent.futures.TimeoutError: If the result did not arrive in time.
+            The exception the task raised on the worker node.
+        """
+        return self.submit(task).result(timeout)
+
+    def close(self):
+        """
+        Closes every pooled connection.
         """
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((self.host, self.port))
-            s.sendall(pickle.dumps(task))
-            data = s.recv(4096)
-            return pickle.loads(data)
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            conn.close()
 
 """
 A worker that can execute tasks and report its availability.
@@ -207,11 +1935,27 @@ class Worker(Node):
         Starts the worker.
         """
         while True:
-            task = self.task_queue.get_task()
-            if task:
-                result = self.execute_task(task)
+            # Sleeps until tasks arrive, then sends what is queued as batches
+            tasks = self.task_queue.get_tasks(self.batch_size, block=True)
+            futures = [self.enqueue(task) for task in tasks]
+            for future in futures:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Task failed: {e}")
+                    continue
                 print(f"Task result: {result}")
 
+# Example tasks; defined at module level, so the process pool's workers can unpickle them
+def add(a, b):
+    return a + b
+
+def subtract(a, b):
+    return a - b
+
+def multiply(a, b):
+    return a * b
+
 # Example usage
 if __name__ == "__main__":
     task_queue = TaskQueue()
@@ -222,16 +1966,6 @@ if __name__ == "__main__":
         threading.Thread(target=worker_node.start).start()
 
     client = Client([Node("localhost", 5001)])
-    
-    # Example tasks
-    def add(a, b):
-        return a + b
-    
-    def subtract(a, b):
-        return a - b
-
-    def multiply(a, b):
-        return a * b        
 
     tasks = [(add, (1, 2)), (multiply, (3, 4)), (add, (5, 6)), (subtract, (10, 8))]
 
@@ -9,53 +9,1267 @@
 #Allow clients to join and leave the chat room dynamically while maintaining active connections with other clients.
 #Use pickling to serialize and deserialize messages exchanged between clients and the server.
 
+import abc
+import asyncio
+import bisect
+import multiprocessing
+import os
+import shutil
 import socket
+import struct
+import tempfile
 import threading
-import pickle
+import time
+from collections import OrderedDict, deque
 
-class ChatServer:
+from framing import FRAME_HEADER, FrameDecoder, encode_frame, recv_frame, send_frame
+from journal import Journal, RECORD_HEADER
+from serializers import PERMISSIVE, STRICT, available_serializers, negotiate_serializer
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+def raise_file_limit():
+    """ Raises the open file limit to its hard maximum, so a server can hold thousands of connections.
+
+    Returns:
+        int: The new soft limit, or None if it cannot be changed on this platform.
+    """
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+SLOW_CONSUMER_POLICIES = ('drop', 'disconnect', 'coalesce')
+OUTBOX_MESSAGES = 4096 # Messages queued for one client before the slow consumer policy applies
+OUTBOX_BYTES = 4 * 1024 * 1024 # Bytes queued for one client before it is disconnected, whatever the policy
+READ_SIZE = 64 * 1024 # Bytes asked for per read; one read may hold many messages
+BATCH_WINDOW = 0.001 # Seconds a writer waits for more messages, so they go out in one write
+
+class SlowConsumer(Exception):
+    """
+    Raised by Outbox.put when a client has fallen so far behind that it must be disconnected.
+    """
+
+class Outbox:
+    """
+    A bounded queue of encoded messages waiting to be written to one client.
+
+    Buffers are shared, not copied: a broadcast encodes its message once and
+    puts the same bytes object in the outbox of every recipient.
+
+    Args:
+        policy (str): What to do when OUTBOX_MESSAGES messages are queued: 'drop' new
+            messages, 'disconnect' the client, or 'coalesce' the backlog into a single
+            buffer that goes out in one write.
+        max_messages (int): Messages queued before the policy applies.
+        max_bytes (int): Bytes queued before the client is disconnected, whatever the policy.
+    """
+
+    def __init__(self, policy='disconnect', max_messages=OUTBOX_MESSAGES, max_bytes=OUTBOX_BYTES):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy!r}")
+        self.policy = policy
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.buffers = deque()
+        self.size = 0 # Bytes queued
+        self.dropped = 0 # Messages dropped by the 'drop' policy
+        self.closed = False
+        self.ready = threading.Condition() # Guards the queue and wakes a writer thread
+
+    def put(self, data):
+        """
+        Queues an encoded message.
+
+        Args:
+            data (bytes): The message.
+
+        Returns:
+            bool: True if the outbox was empty, so an idle writer has to be woken up.
+
+        Raises:
+            SlowConsumer: If the client has to be disconnected.
+        """
+        with self.ready:
+            if self.closed:
+                return False
+            if self.size + len(data) > self.max_bytes:
+                raise SlowConsumer(f"{self.size} bytes queued")
+            if len(self.buffers) >= self.max_messages:
+                if self.policy == 'drop':
+                    self.dropped += 1
+                    return False
+                if self.policy == 'disconnect':
+                    raise SlowConsumer(f"{len(self.buffers)} messages queued")
+                backlog = b''.join(self.buffers)
+                self.buffers.clear()
+                self.buffers.append(backlog)
+            was_empty = not self.buffers
+            self.buffers.append(data)
+            self.size += len(data)
+            self.ready.notify()
+            return was_empty
+
+    def take(self):
+        """
+        Takes everything queued, without waiting.
+
+        Returns:
+            list: The queued buffers, oldest first.
+        """
+        with self.ready:
+            buffers = list(self.buffers)
+            self.buffers.clear()
+            self.size = 0
+            return buffers
+
+    def get(self):
+        """
+        Takes everything queued, waiting until something is. Used by writer threads.
+
+        Returns:
+            list: The queued buffers, oldest first, or an empty list once the outbox is closed.
+        """
+        with self.ready:
+            while not self.buffers and not self.closed:
+                self.ready.wait()
+        return self.take()
+
+    def close(self):
+        """
+        Discards the queue and stops the writer.
+        """
+        with self.ready:
+            self.closed = True
+            self.buffers.clear()
+            self.size = 0
+            self.ready.notify_all()
+
+DEFAULT_ROOM = 'lobby' # Room every client joins when it connects
+
+def transcode(data, serializer):
+    """
+    Re-encodes frames encoded with STRICT for a client that negotiated another serializer.
+
+    Args:
+        data (bytes): One or more frames.
+        serializer: The client's serializer.
+
+    Returns:
+        bytes: The same messages, encoded with the client's serializer.
+    """
+    return b''.join(encode_frame(message, serializer) for message in FrameDecoder(serializer=STRICT).feed(data))
+
+def format_message(message):
+    """ Formats a message from the server for display.
+
+    Args:
+        message (dict): The message, as described in ChatHub.
+
+    Returns:
+        str: One line of text.
+    """
+    if not isinstance(message, dict):
+        return str(message)
+    kind = message.get('type')
+    if kind == 'message':
+        return f"[{message['room']}] {message['sender']}: {message['text']}"
+    if kind == 'direct':
+        return f"[{message['sender']} -> {message['to']}] {message['text']}"
+    return f"[{message['room']}] {message['text']}" if message.get('room') else f"* {message['text']}"
+
+HISTORY_MESSAGES = 100 # Messages kept per room and replayed to clients that join it
+HISTORY_ROOMS = 10000 # Rooms whose recent messages are kept; the least recently used go first
+HISTORY_REPLAY_LIMIT = 1000 # Most messages returned by one /since
+HISTORY_SCAN_RECORDS = 100000 # Most log records one /since reads, whatever room they belong to
+HISTORY_RECOVER_RECORDS = 100000 # Log records read back into the rooms' recent messages on a restart
+LOG_FLUSH_INTERVAL = 0.05 # Seconds the log writer waits for more messages, so they go to disk in one write
+LOG_INDEX_INTERVAL = 256 # Log records between entries of the offset index
+LOG_MESSAGE = 1 # Log record of a room message; the attribute is its time in microseconds
+LOG_ROOM = struct.Struct("!H") # Length of the room name at the start of a log record's payload
+LOG_INDEX_ENTRY = struct.Struct("!qQ") # time in microseconds, log offset of every LOG_INDEX_INTERVAL-th record
+
+class MessageLog:
+    """
+    An append-only on-disk log of room messages, so history survives restarts.
+
+    Records are kept in a Journal. A compact index next to it (path + '.index')
+    holds the time and offset of every LOG_INDEX_INTERVAL-th record, so
+    "messages since a time" seeks close to the first one instead of scanning
+    the whole log.
+
+    Messages are queued in memory and written by a background thread, many
+    to one write, so logging does not hold up delivery.
+
+    Args:
+        path (str): The log file.
+        fsync (bool): Flush every write to disk, to survive power loss as well.
+        flush_interval (float): Seconds the writer waits for more messages before it writes them.
+    """
+
+    def __init__(self, path, fsync=False, flush_interval=LOG_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.journal = Journal(path, fsync)
+        self.index_path = path + ".index"
+        self.index = [] # (time in microseconds, offset) of every LOG_INDEX_INTERVAL-th record
+        self.lock = threading.Lock() # Held while the log or the index change, and while they are read
+        self.ready = threading.Condition(threading.Lock()) # Guards pending and closed
+        self.pending = [] # (room, time, encoded message) not written yet
+        self.closed = False
+        self.next_sequence = 0 # Sequence number of the next record, used only by the writer once recovered
+        self.recover()
+        self.index_file = open(self.index_path, 'ab')
+        self.writer = threading.Thread(target=self.write_records, daemon=True)
+        self.writer.start()
+
+    def recover(self):
+        """
+        Loads the index, then indexes the records written after its last entry and drops a torn one.
+        """
+        try:
+            with open(self.index_path, 'rb') as file:
+                data = file.read()
+            # A crash may have cut the last entry short
+            data = data[:len(data) - len(data) % LOG_INDEX_ENTRY.size]
+            self.index = [entry for entry in LOG_INDEX_ENTRY.iter_unpack(data) if entry[1] < self.journal.size]
+        except OSError as e:
+            if os.path.exists(self.index_path):
+                print(f"Rebuilding unreadable message log index: {e}")
+            self.index = []
+        start = self.index[-1][1] if self.index else 0
+
+        end = start
+        rebuilt = False
+        for offset, kind, sequence, attribute, length in self.journal.scan(start):
+            if sequence % LOG_INDEX_INTERVAL == 0 and (not self.index or offset > self.index[-1][1]):
+                self.index.append((attribute, offset))
+                rebuilt = True
+            end = offset + RECORD_HEADER.size + length
+            self.next_sequence = sequence + 1
+        if end < self.journal.size:
+            print(f"Dropping a torn record at the end of {self.path}")
+            self.journal.truncate(end)
+            self.index = [entry for entry in self.index if entry[1] < end]
+            rebuilt = True
+        if rebuilt or not os.path.exists(self.index_path):
+            with open(self.index_path, 'wb') as file:
+                file.write(b''.join(LOG_INDEX_ENTRY.pack(*entry) for entry in self.index))
+
+    def append(self, room, sent, data):
+        """
+        Queues a message for the writer.
+
+        Args:
+            room (str): The room.
+            sent (float): The message's time.
+            data (bytes): The encoded message.
+        """
+        # Records are built by the writer, to keep this cheap for the thread delivering the message
+        with self.ready:
+            self.pending.append((room, sent, data))
+            if len(self.pending) == 1:
+                self.ready.notify()
+
+    def write_records(self):
+        """
+        Writes queued messages until the log is closed. Runs on the writer thread.
+        """
+        while True:
+            with self.ready:
+                self.ready.wait_for(lambda: self.pending or self.closed)
+                if self.closed and not self.pending:
+                    return
+                if self.flush_interval:
+                    # Let a burst of messages catch up, so it goes out in one write; close() cuts the wait short
+                    self.ready.wait_for(lambda: self.closed, self.flush_interval)
+            with self.lock:
+                with self.ready:
+                    messages, self.pending = self.pending, []
+                records = []
+                for room, sent, data in messages:
+                    name = room.encode()
+                    records.append((LOG_MESSAGE, self.next_sequence, int(sent * 1000000),
+                                    LOG_ROOM.pack(len(name)) + name + data))
+                    self.next_sequence += 1
+                try:
+                    offsets = self.journal.append(records)
+                except OSError as e:
+                    print(f"Error writing the message log: {e}")
+                    continue
+                entries = [(sent, offset) for (_, sequence, sent, _), offset in zip(records, offsets)
+                           if sequence % LOG_INDEX_INTERVAL == 0]
+                if entries:
+                    self.index.extend(entries)
+                    self.index_file.write(b''.join(LOG_INDEX_ENTRY.pack(*entry) for entry in entries))
+                    self.index_file.flush()
+
+    @staticmethod
+    def parse(payload):
+        """
+        Splits a record payload into its room and encoded message.
+
+        Args:
+            payload (bytes): The payload.
+
+        Returns:
+            tuple: (room, encoded message).
+        """
+        length, = LOG_ROOM.unpack_from(payload)
+        return payload[LOG_ROOM.size:LOG_ROOM.size + length].decode(), payload[LOG_ROOM.size + length:]
+
+    def since(self, room, sent, limit=HISTORY_REPLAY_LIMIT, max_records=HISTORY_SCAN_RECORDS):
+        """
+        Reads the messages of a room logged after a time, oldest first.
+
+        The log is read sequentially from the index entry before the time,
+        without holding the lock, so the writer keeps writing meanwhile. A
+        quiet room would otherwise mean reading the log to its end: at most
+        max_records records are read, and the messages found in them returned.
+
+        Args:
+            room (str): The room.
+            sent (float): The time.
+            limit (int): Most messages returned.
+            max_records (int): Most records read.
+
+        Returns:
+            list: (time, encoded message) of each message.
+        """
+        after = int(sent * 1000000)
+        name = room.encode()
+        prefix = LOG_ROOM.pack(len(name)) + name # Start of the payloads of the room's records
+        messages = []
+        with self.lock:
+            # Messages from other shards can be logged slightly out of time order,
+            # so start one index entry before the first one that is too late
+            position = bisect.bisect_left(self.index, (after,))
+            start = self.index[position - 2][1] if position >= 2 else 0
+            # The log up to end and the messages still pending hold every message once
+            end = self.journal.size
+            with self.ready:
+                pending = list(self.pending)
+        records = self.journal.scan(start, payloads=True)
+        try:
+            for count, (offset, kind, _, attribute, payload) in enumerate(records, 1):
+                if offset >= end:
+                    break
+                if kind == LOG_MESSAGE and attribute > after and payload.startswith(prefix):
+                    messages.append((attribute / 1000000, payload[len(prefix):]))
+                    if len(messages) == limit:
+                        return messages
+                if count == max_records:
+                    return messages
+        finally:
+            records.close()
+        for logged_room, logged, data in pending:
+            if logged_room == room and int(logged * 1000000) > after:
+                messages.append((logged, data))
+                if len(messages) == limit:
+                    break
+        return messages
+
+    def recent(self, records=HISTORY_RECOVER_RECORDS):
+        """
+        Reads the last messages of the log, of every room.
+
+        Args:
+            records (int): About how many records to read.
+
+        Returns:
+            list: (room, time, encoded message) of each message, oldest first.
+        """
+        messages = []
+        with self.lock:
+            position = max(0, len(self.index) - 1 - records // LOG_INDEX_INTERVAL)
+            start = self.index[position][1] if self.index else 0
+            for _, kind, _, attribute, payload in self.journal.scan(start, payloads=True):
+                if kind == LOG_MESSAGE:
+                    room, data = self.parse(payload)
+                    messages.append((room, attribute / 1000000, data))
+        return messages
+
+    def close(self):
+        """
+        Writes the queued messages and closes the log.
+        """
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+        self.writer.join()
+        with self.lock:
+            self.index_file.close()
+            self.journal.close()
+
+class MessageHistory:
+    """
+    The recent messages of every room, replayed to clients that join it,
+    and optionally a MessageLog with all of them.
+
+    Messages are kept encoded, so a replay is one concatenation of frames
+    the client receives in one write.
+
+    Args:
+        size (int): Messages kept per room.
+        log (MessageLog): Optional log, also read back on creation to restore recent messages.
+    """
+
+    def __init__(self, size=HISTORY_MESSAGES, log=None):
+        self.size = size
+        self.log = log
+        self.lock = threading.Lock()
+        self.rooms = OrderedDict() # room -> deque of (time, encoded message), least recently used room first
+        if log is not None:
+            for room, sent, data in log.recent():
+                self.remember(room, sent, data)
+
+    def remember(self, room, sent, data):
+        """
+        Adds a message to a room's recent messages. Called with the lock held.
+
+        Args:
+            room (str): The room.
+            sent (float): The message's time.
+            data (bytes): The encoded message.
+        """
+        messages = self.rooms.get(room)
+        if messages is None:
+            messages = self.rooms[room] = deque(maxlen=self.size)
+            if len(self.rooms) > HISTORY_ROOMS:
+                self.rooms.popitem(last=False)
+        else:
+            self.rooms.move_to_end(room)
+        messages.append((sent, data))
+
+    def record(self, room, sent, data):
+        """
+        Keeps a message of a room and queues it for the log.
+
+        Args:
+            room (str): The room.
+            sent (float): The message's time.
+            data (bytes): The encoded message.
+        """
+        with self.lock:
+            self.remember(room, sent, data)
+        if self.log is not None:
+            self.log.append(room, sent, data)
+
+    def recent(self, room):
+        """
+        Returns the recent messages of a room as one buffer.
+
+        Args:
+            room (str): The room.
+
+        Returns:
+            bytes: The encoded messages, oldest first.
+        """
+        with self.lock:
+            return b''.join(data for _, data in self.rooms.get(room, ()))
+
+    def since(self, room, sent):
+        """
+        Returns the messages of a room sent after a time as one buffer,
+        from the recent messages if they go back far enough and from the log otherwise.
+
+        Args:
+            room (str): The room.
+            sent (float): The time.
+
+        Returns:
+            bytes: The encoded messages, oldest first; at most HISTORY_REPLAY_LIMIT of them.
+        """
+        with self.lock:
+            messages = list(self.rooms.get(room, ()))
+        # The recent messages hold every later message if they reach back to the time
+        if self.log is not None and (not messages or messages[0][0] > sent):
+            messages = self.log.since(room, sent)
+        return b''.join([data for time_sent, data in messages if time_sent > sent][:HISTORY_REPLAY_LIMIT])
+
+    def close(self):
+        """
+        Closes the log, once the queued messages are written.
+        """
+        if self.log is not None:
+            self.log.close()
+
+class ChatMember:
+    """
+    A client that has joined, as the chat rooms see it.
+
+    Args:
+        username (str): The username the client introduced itself with.
+        outbox (Outbox): The client's outbox.
+        connection: The server's handle on the client: its socket or its StreamWriter.
+        wake (callable): Called when the outbox receives messages while it was empty, to wake its writer.
+        serializer: The serializer negotiated with the client; the hub's own, STRICT, by default.
+    """
+
+    def __init__(self, username, outbox, connection, wake=None, serializer=STRICT):
+        self.username = username
+        self.outbox = outbox
+        self.connection = connection
+        self.wake = wake
+        self.serializer = serializer
+        self.rooms = set() # Rooms the client is subscribed to
+        self.room = None # Room the client's plain messages go to
+
+class ChatHub(abc.ABC):
+    """
+    Rooms, subscriptions and direct messages, shared by ChatServer and AsyncChatServer.
+
+    Two indexes keep the cost of a message proportional to its audience, not to
+    the number of connected clients: room -> subscribed members, and username ->
+    members using that name. Each member keeps the set of rooms it is in.
+
+    Clients send plain text; text starting with '/' is a command:
+        /join ROOM      subscribe to ROOM and talk there
+        /leave [ROOM]   unsubscribe from ROOM, the current room by default
+        /switch ROOM    talk in ROOM, joining it first if needed
+        /msg USER TEXT  send TEXT to USER only
+        /rooms          list your rooms
+        /since TIME [ROOM]  get the messages of ROOM, the current room by default, sent after TIME
+
+    Clients receive dicts: {'type': 'message', 'room', 'sender', 'text'},
+    {'type': 'direct', 'sender', 'to', 'text'} and {'type': 'notice', 'room', 'text'}.
+    Room messages also carry their 'time', and the last ones of a room are
+    replayed to every client that joins it.
+
+    Messages are encoded once, with the schema serializer and without pickle,
+    and re-encoded only for clients that negotiated another serializer (see
+    negotiate). Clients are never sent pickles they did not ask for.
+
+    Args:
+        bus (ShardBus): Optional bus to the other shards of a ShardedChatServer.
+        history (MessageHistory): Keeps room messages; by default the last HISTORY_MESSAGES of each room, in memory.
+        serializers (list): Serializers the server accepts from clients, best first. Only
+            'schema' by default, so clients cannot make the server unpickle anything.
+    """
+
+    def __init__(self, bus=None, history=None, serializers=None):
+        self.bus = bus
+        self.serializers = list(serializers or ['schema'])
+        self.history = history if history is not None else MessageHistory()
+        self.index_lock = threading.Lock() # Guards rooms, members and every member's rooms
+        self.rooms = {} # room -> set of subscribed ChatMembers
+        self.members = {} # username -> set of ChatMembers
+
+    def negotiate(self, hello):
+        """
+        Agrees on serializers with a client, from the first message it sends.
+
+        Args:
+            hello (dict): {'type': 'hello', 'username', 'serializers'}, the serializers the client accepts.
+
+        Returns:
+            tuple: (username, serializer to send to the client with, serializer to decode its
+            messages with, the encoded welcome to send it first).
+
+        Raises:
+            ValueError: If the message is not a hello or the client accepts none of the server's serializers.
+        """
+        if (type(hello) is not dict or hello.get('type') != 'hello' or type(hello.get('username')) is not str
+                or type(hello.get('serializers')) is not list):
+            raise ValueError("Expected a hello")
+        serializer = negotiate_serializer(hello['serializers'], self.serializers)
+        decoder = PERMISSIVE if 'pickle' in self.serializers else STRICT
+        welcome = encode_frame({'type': 'welcome', 'serializers': self.serializers}, STRICT)
+        return hello['username'], serializer, decoder, welcome
+
+    @abc.abstractmethod
+    def disconnect(self, member):
+        """
+        Disconnects a client that cannot keep up. Implemented by the servers.
+
+        Args:
+            member (ChatMember): The client.
+        """
+
+    def deliver(self, members, data):
+        """
+        Queues an encoded message in the outbox of every recipient.
+
+        Args:
+            members (iterable): The recipients.
+            data (bytes): The message, encoded once with encode_frame and STRICT.
+        """
+        slow = []
+        transcoded = {} # serializer name -> data for the members that use it
+        for member in members:
+            frame = data
+            if member.serializer.name != STRICT.name:
+                frame = transcoded.get(member.serializer.name)
+                if frame is None:
+                    frame = transcoded[member.serializer.name] = transcode(data, member.serializer)
+            try:
+                if member.outbox.put(frame) and member.wake is not None:
+                    member.wake()
+            except SlowConsumer as e:
+                print(f"Disconnecting slow client {member.username}: {e}")
+                slow.append(member)
+        for member in slow:
+            self.disconnect(member)
+
+    def publish(self, room, message, sender=None):
+        """
+        Delivers a message to the subscribers of a room, on every shard.
+
+        Args:
+            room (str): The room.
+            message (dict): The message.
+            sender (ChatMember): A subscriber that does not get the message back.
+        """
+        data = encode_frame(message, STRICT)
+        sent = message.get('time')
+        self.deliver_room(room, data, sender, sent)
+        if self.bus is not None:
+            self.bus.publish(room, data, sent)
+
+    def deliver_room(self, room, data, sender=None, sent=None):
+        """
+        Delivers an encoded message to the subscribers of a room on this server.
+
+        Args:
+            room (str): The room.
+            data (bytes): The encoded message.
+            sender (ChatMember): A subscriber that does not get the message back.
+            sent (float): The message's time, if it belongs in the room's history.
+        """
+        with self.index_lock:
+            members = [member for member in self.rooms.get(room, ()) if member is not sender]
+            if sent is not None:
+                # Under the lock, so a joining client gets the message either replayed or delivered
+                self.history.record(room, sent, data)
+        self.deliver(members, data)
+
+    def broadcast(self, message, sender=None):
+        """
+        Delivers a message to every connected client, whatever its rooms, on every shard.
+
+        Args:
+            message (dict): The message.
+            sender (ChatMember): A client that does not get the message back.
+        """
+        data = encode_frame(message, STRICT)
+        self.deliver_all(data, sender)
+        if self.bus is not None:
+            self.bus.broadcast(data)
+
+    def deliver_all(self, data, sender=None):
+        """
+        Delivers an encoded message to every client of this server.
+
+        Args:
+            data (bytes): The encoded message.
+            sender (ChatMember): A client that does not get the message back.
+        """
+        with self.index_lock:
+            members = [member for named in self.members.values() for member in named if member is not sender]
+        self.deliver(members, data)
+
+    def deliver_user(self, username, data):
+        """
+        Delivers an encoded message to every connection of one user on this server.
+
+        Args:
+            username (str): The user.
+            data (bytes): The encoded message.
+
+        Returns:
+            bool: True if the user has a connection here.
+        """
+        with self.index_lock:
+            recipients = list(self.members.get(username, ()))
+        self.deliver(recipients, data)
+        return bool(recipients)
+
+    def notify(self, member, text):
+        """
+        Sends a notice to one client.
+
+        Args:
+            member (ChatMember): The client.
+            text (str): The notice.
+        """
+        self.deliver([member], encode_frame({'type': 'notice', 'room': None, 'text': text}, STRICT))
+
+    def add_member(self, member):
+        """
+        Registers a client that introduced itself and puts it in DEFAULT_ROOM.
+
+        Args:
+            member (ChatMember): The client.
+        """
+        with self.index_lock:
+            named = self.members.setdefault(member.username, set())
+            first = not named
+            named.add(member)
+        if first and self.bus is not None:
+            self.bus.add_user(member.username)
+        self.join(member, DEFAULT_ROOM)
+
+    def remove_member(self, member):
+        """
+        Unregisters a client, takes it out of its rooms and stops its writer.
+
+        Safe to call more than once.
+
+        Args:
+            member (ChatMember): The client.
+        """
+        with self.index_lock:
+            named = self.members.get(member.username)
+            if named is None or member not in named:
+                return
+            named.discard(member)
+            last = not named
+            if last:
+                del self.members[member.username]
+            rooms, member.rooms = member.rooms, set()
+            emptied = [room for room in rooms if self.unindex(member, room)]
+        member.outbox.close()
+        if member.wake is not None:
+            member.wake()
+        if self.bus is not None:
+            for room in emptied:
+                self.bus.unsubscribe(room)
+            if last:
+                self.bus.remove_user(member.username)
+        for room in rooms:
+            self.publish(room, {'type': 'notice', 'room': room, 'text': f"{member.username} has left the chat."})
+
+    def unindex(self, member, room):
+        """
+        Removes a member from a room's subscribers, dropping the room once it is empty.
+        Called with index_lock held.
+
+        Args:
+            member (ChatMember): The client.
+            room (str): The room.
+
+        Returns:
+            bool: True if the room has no subscribers on this server any more.
+        """
+        subscribers = self.rooms.get(room)
+        if subscribers is None:
+            return False
+        subscribers.discard(member)
+        if subscribers:
+            return False
+        del self.rooms[room]
+        return True
+
+    def join(self, member, room):
+        """
+        Subscribes a client to a room, replays its recent messages and makes it the room the client talks in.
+
+        Args:
+            member (ChatMember): The client.
+            room (str): The room.
+        """
+        with self.index_lock:
+            new = room not in member.rooms
+            created = new and room not in self.rooms
+            if new:
+                member.rooms.add(room)
+                self.rooms.setdefault(room, set()).add(member)
+                recent = self.history.recent(room)
+                if recent:
+                    self.deliver([member], recent) # One buffer, so one write
+        member.room = room
+        if created and self.bus is not None:
+            self.bus.subscribe(room)
+        if new:
+            self.publish(room, {'type': 'notice', 'room': room, 'text': f"{member.username} has joined the chat."})
+
+    def leave(self, member, room):
+        """
+        Unsubscribes a client from a room.
+
+        Args:
+            member (ChatMember): The client.
+            room (str): The room.
+
+        Returns:
+            bool: False if the client was not in the room.
+        """
+        with self.index_lock:
+            if room not in member.rooms:
+                return False
+            member.rooms.discard(room)
+            emptied = self.unindex(member, room)
+            if member.room == room:
+                member.room = min(member.rooms) if member.rooms else None
+        if emptied and self.bus is not None:
+            self.bus.unsubscribe(room)
+        notice = {'type': 'notice', 'room': room, 'text': f"{member.username} has left the chat."}
+        self.publish(room, notice)
+        self.deliver([member], encode_frame(notice, STRICT))
+        return True
+
+    def since(self, member, room, sent):
+        """
+        Sends a client the messages of a room sent after a time. They may have to be read from the log.
+
+        Args:
+            member (ChatMember): The client.
+            room (str): The room.
+            sent (float): The time.
+        """
+        self.replay(member, room, sent, self.history.since(room, sent))
+
+    def replay(self, member, room, sent, messages):
+        """
+        Sends a client the answer to its /since.
+
+        Args:
+            member (ChatMember): The client.
+            room (str): The room.
+            sent (float): The time.
+            messages (bytes): The encoded messages.
+        """
+        if messages:
+            self.deliver([member], messages)
+        else:
+            self.notify(member, f"No messages in {room} since {sent}.")
+
+    def direct(self, member, username, text):
+        """
+        Sends a message to every connection of one user, on every shard.
+
+        Args:
+            member (ChatMember): The sender.
+            username (str): The recipient's username.
+            text (str): The message.
+        """
+        data = encode_frame({'type': 'direct', 'sender': member.username, 'to': username, 'text': text}, STRICT)
+        delivered = self.deliver_user(username, data)
+        if self.bus is not None:
+            delivered = self.bus.direct(username, data) or delivered
+        if not delivered:
+            self.notify(member, f"No user named {username} is connected.")
+
+    def handle_message(self, member, text):
+        """
+        Handles a message from a client: a command, or text for its current room.
+
+        Args:
+            member (ChatMember): The client.
+            text (str): The message.
+        """
+        if not isinstance(text, str):
+            text = str(text)
+        if not text.startswith('/'):
+            if member.room is None:
+                self.notify(member, "You are not in a room; /join one first.")
+            else:
+                self.publish(member.room, {'type': 'message', 'room': member.room, 'sender': member.username,
+                                           'text': text, 'time': time.time()}, member)
+            return
+
+        command, _, argument = text[1:].partition(' ')
+        argument = argument.strip()
+        if command in ('join', 'switch') and argument:
+            self.join(member, argument)
+            if command == 'switch':
+                self.notify(member, f"Talking in {argument}.")
+        elif command == 'leave':
+            room = argument or member.room
+            if room is None or not self.leave(member, room):
+                self.notify(member, f"You are not in {room or 'a room'}.")
+        elif command == 'msg' and ' ' in argument:
+            username, _, message = argument.partition(' ')
+            self.direct(member, username, message.strip())
+        elif command == 'rooms':
+            with self.index_lock:
+                rooms = sorted(member.rooms)
+            self.notify(member, f"Your rooms: {', '.join(rooms) or 'none'}; talking in {member.room or 'none'}.")
+        elif command == 'since' and argument:
+            sent, _, room = argument.partition(' ')
+            room = room.strip() or member.room
+            try:
+                sent = float(sent)
+            except ValueError:
+                self.notify(member, "Usage: /since TIME [ROOM], TIME in seconds since the epoch.")
+                return
+            if room is None:
+                self.notify(member, f"No messages in a room since {sent}.")
+            else:
+                self.since(member, room, sent)
+        else:
+            self.notify(member, "Commands: /join ROOM, /leave [ROOM], /switch ROOM, /msg USER TEXT, /rooms, "
+                                "/since TIME [ROOM]")
+
+BUS_RETRY_INTERVAL = 0.05 # Seconds between attempts to reach a shard whose bus is not up yet
+BUS_BUFFER_BYTES = 16 * 1024 * 1024 # Bytes queued for one shard before the slow consumer policy applies
+BUS_MAX_BYTES = 64 * 1024 * 1024 # Bytes queued for one shard before it is disconnected, whatever the policy
+BUS_MESSAGE_EVENTS = ('room', 'user', 'all') # Events the 'drop' policy may drop; announcements never are
+
+class ShardBus:
+    """
+    Connects the shards of a ShardedChatServer, so clients on different
+    shards share rooms and can message each other.
+
+    Every shard listens on a Unix socket in a shared directory and connects
+    to every other shard's socket. Shards announce which rooms have local
+    subscribers and which users are connected locally, and only send a
+    message to the shards that are interested in it. A message is encoded
+    once by the shard its sender is on; other shards forward the encoded
+    frame to their clients without decoding it.
+
+    Announcements travel like messages, so a shard learns of a new
+    subscriber elsewhere a moment after it joins: a message published in
+    that moment does not reach it.
+
+    Nothing is queued for a shard that is not connected; when the connection
+    is made, the shard is told which rooms and users this one has. A shard
+    that falls behind is handled like a slow client: past BUS_BUFFER_BYTES
+    queued, messages to it are dropped or it is disconnected, as the policy
+    says, and past BUS_MAX_BYTES it is disconnected. A disconnected shard is
+    connected to again.
+
+    Runs on the event loop of an AsyncChatServer; it is not thread-safe.
+
+    Args:
+        directory (str): Directory holding the bus sockets of all shards.
+        shard (int): Number of this shard, from 0 to shards - 1.
+        shards (int): Number of shards.
+        slow_consumer (str): Policy for shards that cannot keep up: 'drop' messages to them,
+            'disconnect' them, or 'coalesce', which only disconnects them past BUS_MAX_BYTES.
+    """
+
+    def __init__(self, directory, shard, shards, slow_consumer='disconnect'):
+        self.directory = directory
+        self.shard = shard
+        self.shards = shards
+        self.slow_consumer = slow_consumer
+        self.hub = None
+        self.loop = None
+        self.server = None
+        self.connect_tasks = {} # shard -> task connecting to it
+        self.peers = {} # shard -> asyncio.StreamWriter to that shard
+        self.pending = {shard: [] for shard in range(shards) if shard != self.shard} # shard -> frames not sent yet
+        self.pending_bytes = dict.fromkeys(self.pending, 0) # shard -> bytes of its pending frames
+        self.dropped = 0 # Messages dropped by the 'drop' policy
+        self.flush_scheduled = False
+        self.room_shards = {} # room -> shards with subscribers to it
+        self.user_shards = {} # username -> shards the user is connected to
+
+    def path(self, shard):
+        """
+        Returns the bus socket of a shard.
+
+        Args:
+            shard (int): The shard.
+
+        Returns:
+            str: The path of the socket.
+        """
+        return os.path.join(self.directory, f"bus-{shard}.sock")
+
+    async def start(self, hub):
+        """
+        Starts listening for the other shards and connecting to them.
+
+        Args:
+            hub (ChatHub): Delivers the messages of the other shards to local clients.
+        """
+        self.hub = hub
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_unix_server(self.handle_peer, self.path(self.shard))
+        for shard in self.pending:
+            self.connect_tasks[shard] = asyncio.create_task(self.connect(shard))
+
+    async def connect(self, shard):
+        """
+        Connects to another shard, retrying until its bus is up.
+
+        Args:
+            shard (int): The shard.
+        """
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path(shard))
+                break
+            except OSError:
+                await asyncio.sleep(BUS_RETRY_INTERVAL)
+        self.peers[shard] = writer
+        # Tell the shard what it missed while it was not connected: this shard's rooms and users
+        with self.hub.index_lock:
+            events = [('hello', self.shard)] + [('subscribe', room) for room in self.hub.rooms] + \
+                     [('join', username) for username in self.hub.members]
+        for event in events:
+            self.send([shard], event)
+
+    def disconnect(self, shard):
+        """
+        Drops the connection to a shard and what is queued for it, and starts connecting to it again.
+
+        Args:
+            shard (int): The shard.
+        """
+        writer = self.peers.pop(shard)
+        self.pending[shard] = []
+        self.pending_bytes[shard] = 0
+        writer.transport.abort()
+        self.connect_tasks[shard] = asyncio.create_task(self.connect(shard))
+
+    def send(self, shards, event):
+        """
+        Queues an event for some shards. Queued events go out together once the
+        event loop has handled what it is doing, e.g. all the messages of one read.
+
+        Args:
+            shards (iterable): The shards.
+            event (tuple): The event.
+        """
+        frame = encode_frame(event, STRICT)
+        for shard in shards:
+            writer = self.peers.get(shard)
+            if writer is None:
+                continue # It is told the current state once connected
+            queued = self.pending_bytes[shard] + writer.transport.get_write_buffer_size()
+            if queued > BUS_MAX_BYTES or (queued > BUS_BUFFER_BYTES and self.slow_consumer == 'disconnect'):
+                print(f"Disconnecting slow shard {shard}: {queued} bytes queued")
+                self.disconnect(shard)
+                continue
+            if queued > BUS_BUFFER_BYTES and self.slow_consumer == 'drop' and event[0] in BUS_MESSAGE_EVENTS:
+                self.dropped += 1
+                continue
+            self.pending[shard].append(frame)
+            self.pending_bytes[shard] += len(frame)
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        """
+        Makes sure queued events are sent at the next turn of the event loop.
+        """
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        """
+        Sends the queued events, one write per shard.
+        """
+        self.flush_scheduled = False
+        for shard, writer in list(self.peers.items()):
+            if writer.is_closing():
+                print(f"Lost the connection to shard {shard}; reconnecting")
+                self.disconnect(shard)
+                continue
+            frames, self.pending[shard] = self.pending[shard], []
+            self.pending_bytes[shard] = 0
+            if frames:
+                writer.writelines(frames)
+
+    def subscribe(self, room):
+        """
+        Announces that a room has subscribers on this shard.
+
+        Args:
+            room (str): The room.
+        """
+        self.send(self.pending, ('subscribe', room))
+
+    def unsubscribe(self, room):
+        """
+        Announces that a room has no subscribers on this shard any more.
+
+        Args:
+            room (str): The room.
+        """
+        self.send(self.pending, ('unsubscribe', room))
+
+    def add_user(self, username):
+        """
+        Announces that a user is connected to this shard.
+
+        Args:
+            username (str): The user.
+        """
+        self.send(self.pending, ('join', username))
+
+    def remove_user(self, username):
+        """
+        Announces that a user is not connected to this shard any more.
+
+        Args:
+            username (str): The user.
+        """
+        self.send(self.pending, ('left', username))
+
+    def publish(self, room, data, sent=None):
+        """
+        Sends an encoded message to the shards with subscribers to a room.
+
+        Args:
+            room (str): The room.
+            data (bytes): The encoded message.
+            sent (float): The message's time, if it belongs in the room's history.
+        """
+        shards = self.room_shards.get(room)
+        if shards:
+            self.send(shards, ('room', room, data, sent))
+
+    def broadcast(self, data):
+        """
+        Sends an encoded message to every other shard, for all of their clients.
+
+        Args:
+            data (bytes): The encoded message.
+        """
+        self.send(self.pending, ('all', data))
+
+    def direct(self, username, data):
+        """
+        Sends an encoded message to the shards a user is connected to.
+
+        Args:
+            username (str): The user.
+            data (bytes): The encoded message.
+
+        Returns:
+            bool: True if the user is connected to another shard.
+        """
+        shards = self.user_shards.get(username)
+        if not shards:
+            return False
+        self.send(shards, ('user', username, data))
+        return True
+
+    async def handle_peer(self, reader, writer):
+        """
+        Applies the events another shard sends.
+
+        Args:
+            reader (asyncio.StreamReader): Reads from the shard.
+            writer (asyncio.StreamWriter): The other end of the connection, unused.
+        """
+        peer = None
+        decoder = FrameDecoder(serializer=STRICT)
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                for event in decoder.feed(data):
+                    kind = event[0]
+                    if kind == 'room':
+                        self.hub.deliver_room(event[1], event[2], None, event[3])
+                    elif kind == 'user':
+                        self.hub.deliver_user(event[1], event[2])
+                    elif kind == 'all':
+                        self.hub.deliver_all(event[1])
+                    elif kind == 'subscribe':
+                        self.room_shards.setdefault(event[1], set()).add(peer)
+                    elif kind == 'unsubscribe':
+                        self.forget(self.room_shards, event[1], peer)
+                    elif kind == 'join':
+                        self.user_shards.setdefault(event[1], set()).add(peer)
+                    elif kind == 'left':
+                        self.forget(self.user_shards, event[1], peer)
+                    elif kind == 'hello':
+                        peer = event[1]
+        except Exception as e:
+            print(f"Lost the bus to shard {peer}: {e}")
+        finally:
+            # A shard that went away has no subscribers or users left
+            for interests in (self.room_shards, self.user_shards):
+                for key in [key for key, shards in interests.items() if peer in shards]:
+                    self.forget(interests, key, peer)
+            writer.close()
+
+    @staticmethod
+    def forget(interests, key, shard):
+        """
+        Removes a shard from an interest map.
+
+        Args:
+            interests (dict): room_shards or user_shards.
+            key (str): The room or username.
+            shard (int): The shard.
+        """
+        shards = interests.get(key)
+        if shards is not None:
+            shards.discard(shard)
+            if not shards:
+                del interests[key]
+
+class ChatServer(ChatHub):
     """
     A simple real-time chat application where multiple clients can communicate with each other via a central server using sockets.
-    Messages sent by clients are pickled before transmission. The server receives pickled messages, unpickles them, and broadcasts them to all connected clients.
+    Messages are serialized before transmission, with the serializer each client negotiated in its hello.
+    The server decodes them and delivers them to the clients in the same room.
+    Every message travels as a length-prefixed frame (see framing.py).
 
     Args:
         host (str): The host address of the server.
         port (int): The port number of the server.
+        slow_consumer (str): Outbox policy for clients that cannot keep up: 'drop', 'disconnect' or 'coalesce'.
+        batch_window (float): Seconds a writer waits for more messages before it sends them together.
+        history (MessageHistory): Keeps room messages; by default the last HISTORY_MESSAGES of each room, in memory.
+        serializers (list): Serializers accepted from clients; only 'schema' by default (see ChatHub).
     """
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, slow_consumer='disconnect', batch_window=BATCH_WINDOW, history=None,
+                 serializers=None):
+        super().__init__(history=history, serializers=serializers)
         self.host = host
         self.port = port
-        self.clients = []
+        self.slow_consumer = slow_consumer
+        self.batch_window = batch_window
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(5)
 
-    def broadcast(self, message, client_socket):
+    def disconnect(self, member):
         """
-        Broadcasts a message to all connected clients.
+        Disconnects a client that cannot keep up.
+
+        Closing its outbox stops its writer, which shuts the socket down; that
+        also ends its handler, which removes it from its rooms.
 
         Args:
-            message (str): The message to be broadcast.
-            client_socket (socket.socket): The socket of the client that sent the message.
+            member (ChatMember): The client.
         """
-        for client in self.clients:
-            if client != client_socket:
-                try:
-                    client.send(pickle.dumps(message))
-                except:
-                    # Remove the client if there's an issue with sending the message
-                    self.remove_client(client)
+        member.outbox.close()
 
-    def remove_client(self, client_socket):
+    def write_outbox(self, client_socket, outbox):
         """
-        Removes a client from the list of connected clients.
+        Sends a client's queued messages until its outbox is closed. Runs in a thread per client.
 
         Args:
-            client_socket (socket.socket): The socket of the client to be removed.
+            client_socket (socket.socket): The socket of the client.
+            outbox (Outbox): The client's outbox.
         """
-        if client_socket in self.clients:
-            self.clients.remove(client_socket)
+        try:
+            while True:
+                buffers = outbox.get()
+                if not buffers:
+                    break
+                if self.batch_window:
+                    # Let a burst of messages catch up, so it goes out in one send
+                    time.sleep(self.batch_window)
+                    buffers += outbox.take()
+                client_socket.sendall(b''.join(buffers))
+        except OSError:
+            pass
+        finally:
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
     def handle_client(self, client_socket, addr):
         """
@@ -65,20 +1279,34 @@ class ChatServer:
             client_socket (socket.socket): The socket of the client.
             addr (tuple): The address of the client.
         """
+        member = None
+        decoder = FrameDecoder(serializer=STRICT)
         try:
             while True:
-                data = client_socket.recv(1024)
+                data = client_socket.recv(READ_SIZE)
                 if not data:
                     break
-                # Unpickle the message
-                message = pickle.loads(data)
-                # Broadcast the message to all connected clients
-                self.broadcast(message, client_socket)
+                # One read may hold several messages, or part of one
+                for message in decoder.feed(data):
+                    if member is not None:
+                        self.handle_message(member, message)
+                        continue
+                    # The first message a client sends is its hello
+                    try:
+                        username, serializer, decoder.serializer, welcome = self.negotiate(message)
+                    except ValueError as e:
+                        print(f"Refusing client {addr}: {e}")
+                        return
+                    member = ChatMember(username, Outbox(self.slow_consumer), client_socket, serializer=serializer)
+                    member.outbox.put(welcome)
+                    threading.Thread(target=self.write_outbox, args=(client_socket, member.outbox), daemon=True).start()
+                    self.add_member(member)
         except:
             pass  # Handle disconnection or errors
         finally:
+            if member is not None:
+                self.remove_member(member)
             client_socket.close()
-            self.remove_client(client_socket)
 
     def start(self):
         """
@@ -89,16 +1317,9 @@ class ChatServer:
             while True:
                 client_socket, addr = self.server_socket.accept()
                 
-                # Add the client to the list of connected clients
-                self.clients.append(client_socket)
-                
                 print("Client connected:", addr)
                 
-                # Broadcast that a new client has joined
-                message = f"{self.username} has joined the chat."
-                self.broadcast(message, client_socket)
-                
-                # Start a new thread to handle the client
+                # Start a new thread to handle the client; it starts the client's writer once the client introduced itself
                 client_handler = threading.Thread(target=self.handle_client, args=(client_socket, addr))
                 
                 client_handler.start()
@@ -106,24 +1327,36 @@ class ChatServer:
             print("Server shutting down.")
         finally:
             self.server_socket.close()
+            self.history.close()
 
 class ChatClient:
     """
     A simple real-time chat application where multiple clients can communicate with each other via a central server using sockets.
-    Messages sent by clients are pickled before transmission. The server receives pickled messages, unpickles them, and broadcasts them to all connected clients.
+    Messages are serialized before transmission, with a serializer agreed with the server when the client connects.
+    The server decodes them and broadcasts them to all connected clients.
 
     Args:
         host (str): The host address of the server.
         port (int): The port number of the server.
         username (str): The username of the client.
+        serializers (list): Serializers the client accepts, best first; all available ones by default.
     """
 
-    def __init__(self, host, port, username):
+    def __init__(self, host, port, username, serializers=None):
         self.host = host
         self.port = port
         self.username = username
+        self.serializers = list(serializers or available_serializers())
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client_socket.connect((self.host, self.port))
+        # Introduce ourselves, so the server can announce us, and agree on a serializer
+        send_frame(self.client_socket, {'type': 'hello', 'username': self.username, 'serializers': self.serializers},
+                   STRICT)
+        welcome = recv_frame(self.client_socket, STRICT)
+        if welcome is None:
+            self.client_socket.close()
+            raise ConnectionError("The server refused the connection")
+        self.serializer = negotiate_serializer(welcome['serializers'], self.serializers)
         self.receive_thread = threading.Thread(target=self.receive_messages)
         self.receive_thread.start()
 
@@ -132,10 +1365,10 @@ class ChatClient:
         Sends a message to the server.
 
         Args:
-            message (str): The message to be sent.
+            message (str): The message to be sent, or a command such as /join ROOM (see ChatHub).
         """
         try:
-            self.client_socket.send(pickle.dumps(f"{self.username}: {message}"))
+            self.client_socket.sendall(encode_frame(message, self.serializer))
         except:
             print("Error sending message.")
 
@@ -143,18 +1376,368 @@ class ChatClient:
         """
         Receives messages from the server.
         """
+        decoder = FrameDecoder(serializer=PERMISSIVE if 'pickle' in self.serializers else STRICT)
         try:
             while True:
-                data = self.client_socket.recv(1024)
+                data = self.client_socket.recv(READ_SIZE)
                 if not data:
                     break
-                message = pickle.loads(data)
-                print(message)
+                for message in decoder.feed(data):
+                    print(format_message(message))
         except:
             pass  # Handle disconnection or errors
         finally:
             self.client_socket.close()
 
+class AsyncChatServer(ChatHub):
+    """
+    An event-loop version of ChatServer. Every client is served by the same
+    thread, so thousands of connected clients cost a few kilobytes each
+    instead of an OS thread each. It speaks the same protocol as ChatServer,
+    so ChatClient and AsyncChatClient can both connect to it.
+
+    Args:
+        host (str): The host address of the server.
+        port (int): The port number of the server.
+        backlog (int): Connections the OS queues before the server accepts them.
+        slow_consumer (str): Outbox policy for clients that cannot keep up: 'drop', 'disconnect' or 'coalesce'.
+        batch_window (float): Seconds a writer waits for more messages before it sends them together.
+        bus (ShardBus): Bus to the other shards, when the server is one shard of a ShardedChatServer.
+        sock (socket.socket): Listening socket to accept on instead of binding host and port.
+        history (MessageHistory): Keeps room messages; by default the last HISTORY_MESSAGES of each room, in memory.
+        serializers (list): Serializers accepted from clients; only 'schema' by default (see ChatHub).
+    """
+
+    def __init__(self, host, port, backlog=1024, slow_consumer='disconnect', batch_window=BATCH_WINDOW, bus=None,
+                 sock=None, history=None, serializers=None):
+        super().__init__(bus, history, serializers)
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.slow_consumer = slow_consumer
+        self.batch_window = batch_window
+        self.sock = sock
+        self.server = None
+
+    def disconnect(self, member):
+        """
+        Disconnects a client that cannot keep up, dropping whatever is
+        buffered for it. Its handler sees the connection end and removes it
+        from its rooms.
+
+        Args:
+            member (ChatMember): The client.
+        """
+        member.outbox.close()
+        member.wake()
+        member.connection.transport.abort()
+
+    async def write_outbox(self, writer, outbox, ready):
+        """
+        Sends a client's queued messages until its outbox is closed.
+
+        Args:
+            writer (asyncio.StreamWriter): Writes to the client.
+            outbox (Outbox): The client's outbox.
+            ready (asyncio.Event): Set when the outbox receives messages or is closed.
+        """
+        try:
+            while not outbox.closed:
+                await ready.wait()
+                if self.batch_window:
+                    # Let a burst of messages catch up, so it goes out in one write
+                    await asyncio.sleep(self.batch_window)
+                ready.clear()
+                buffers = outbox.take()
+                if buffers:
+                    writer.writelines(buffers)
+                    await writer.drain()
+        except OSError:
+            pass
+
+    def since(self, member, room, sent):
+        """
+        Sends a client the messages of a room sent after a time.
+
+        Reading them from the log can take a while, so it runs on the loop's
+        default executor instead of holding up every other client of the loop.
+
+        Args:
+            member (ChatMember): The client.
+            room (str): The room.
+            sent (float): The time.
+        """
+        def done(future):
+            try:
+                messages = future.result()
+            except Exception as e:
+                print(f"Error reading the history of {room}: {e}")
+                messages = b''
+            self.replay(member, room, sent, messages)
+
+        asyncio.get_running_loop().run_in_executor(None, self.history.since, room, sent).add_done_callback(done)
+
+    async def handle_client(self, reader, writer):
+        """
+        Handles a client connection.
+
+        Args:
+            reader (asyncio.StreamReader): Reads from the client.
+            writer (asyncio.StreamWriter): Writes to the client.
+        """
+        member = None
+        decoder = FrameDecoder(serializer=STRICT)
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                # One read may hold several messages, or part of one
+                for message in decoder.feed(data):
+                    if member is not None:
+                        self.handle_message(member, message)
+                        continue
+                    # The first message a client sends is its hello
+                    try:
+                        username, serializer, decoder.serializer, welcome = self.negotiate(message)
+                    except ValueError as e:
+                        print(f"Refusing client {writer.get_extra_info('peername')}: {e}")
+                        return
+                    ready = asyncio.Event()
+                    member = ChatMember(username, Outbox(self.slow_consumer), writer, ready.set, serializer)
+                    member.outbox.put(welcome)
+                    ready.set()
+                    writer_task = asyncio.create_task(self.write_outbox(writer, member.outbox, ready)) # Keeps the task referenced while it runs
+                    self.add_member(member)
+        except Exception:
+            pass  # Handle disconnection or errors
+        finally:
+            if member is not None:
+                self.remove_member(member)
+            writer.close()
+
+    async def serve(self):
+        """
+        Accepts and serves clients until cancelled.
+        """
+        if self.bus is not None:
+            await self.bus.start(self)
+        if self.sock is not None:
+            self.server = await asyncio.start_server(self.handle_client, sock=self.sock, backlog=self.backlog)
+        else:
+            # Shards of a ShardedChatServer each bind the port and the kernel spreads connections over them
+            self.server = await asyncio.start_server(self.handle_client, self.host, self.port, backlog=self.backlog,
+                                                     reuse_address=True, reuse_port=self.bus is not None)
+        shard = f" (shard {self.bus.shard})" if self.bus is not None else ""
+        print(f"Server listening on {self.host}:{self.port}{shard}")
+        async with self.server:
+            await self.server.serve_forever()
+
+    def start(self):
+        """
+        Starts the server and runs its event loop in the calling thread.
+        """
+        raise_file_limit()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("Server shutting down.")
+        finally:
+            self.history.close()
+
+class AsyncChatClient:
+    """
+    An asyncio version of ChatClient, for programs that run many clients or an event loop of their own.
+
+    Args:
+        host (str): The host address of the server.
+        port (int): The port number of the server.
+        username (str): The username of the client.
+        batch_window (float): Seconds sent messages wait for more, so they go out in one write.
+        serializers (list): Serializers the client accepts, best first; all available ones by default.
+    """
+
+    def __init__(self, host, port, username, batch_window=BATCH_WINDOW, serializers=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.batch_window = batch_window
+        self.serializers = list(serializers or available_serializers())
+        self.serializer = None # Agreed with the server by connect
+        self.pending = [] # Frames waiting for the batch window to pass
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        """
+        Connects to the server, introduces the client and agrees on a serializer.
+
+        Raises:
+            ConnectionError: If the server refuses the client.
+        """
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(encode_frame({'type': 'hello', 'username': self.username, 'serializers': self.serializers},
+                                       STRICT))
+        await self.writer.drain()
+        try:
+            header = await self.reader.readexactly(FRAME_HEADER.size)
+            welcome = STRICT.decode(await self.reader.readexactly(FRAME_HEADER.unpack(header)[0]))
+        except asyncio.IncompleteReadError:
+            self.writer.close()
+            raise ConnectionError("The server refused the connection") from None
+        self.serializer = negotiate_serializer(welcome['serializers'], self.serializers)
+
+    async def send_message(self, message):
+        """
+        Sends a message to the server.
+
+        Messages sent within batch_window seconds of the first one go out together.
+
+        Args:
+            message (str): The message to be sent, or a command such as /join ROOM (see ChatHub).
+        """
+        try:
+            self.pending.append(encode_frame(message, self.serializer))
+            if len(self.pending) == 1:
+                if self.batch_window:
+                    asyncio.get_running_loop().call_later(self.batch_window, self.flush)
+                else:
+                    self.flush()
+            await self.writer.drain()
+        except OSError:
+            print("Error sending message.")
+
+    def flush(self):
+        """
+        Writes the pending messages in one write.
+        """
+        pending, self.pending = self.pending, []
+        if pending and not self.writer.is_closing():
+            self.writer.writelines(pending)
+
+    async def receive_messages(self, on_message=None):
+        """
+        Receives messages from the server until it disconnects.
+
+        Args:
+            on_message (callable): Called with every message received; by default it is printed with format_message.
+        """
+        if on_message is None:
+            on_message = lambda message: print(format_message(message))
+        decoder = FrameDecoder(serializer=PERMISSIVE if 'pickle' in self.serializers else STRICT)
+        try:
+            while True:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+                for message in decoder.feed(data):
+                    on_message(message)
+        except Exception:
+            pass  # Handle disconnection or errors
+        finally:
+            self.writer.close()
+
+    async def close(self):
+        """
+        Leaves the chat.
+        """
+        self.flush()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+def run_shard(host, port, shard, shards, directory, sock=None, backlog=1024, slow_consumer='disconnect',
+              batch_window=BATCH_WINDOW, log_path=None, serializers=None):
+    """ Runs one shard of a ShardedChatServer. This is the target of the shard processes.
+
+    Args:
+        host (str): The host address of the server.
+        port (int): The port number of the server.
+        shard (int): Number of this shard.
+        shards (int): Number of shards.
+        directory (str): Directory holding the bus sockets.
+        sock (socket.socket): Listening socket shared by the shards, None to bind with SO_REUSEPORT.
+        backlog (int): Connections the OS queues before the server accepts them.
+        slow_consumer (str): Outbox policy for clients that cannot keep up.
+        batch_window (float): Seconds a writer waits for more messages before it sends them together.
+        log_path (str): Message log file of the server; this shard logs to log_path + '.' + shard.
+        serializers (list): Serializers accepted from clients; only 'schema' by default.
+    """
+    bus = ShardBus(directory, shard, shards, slow_consumer)
+    history = MessageHistory(log=MessageLog(f"{log_path}.{shard}")) if log_path else None
+    server = AsyncChatServer(host, port, backlog, slow_consumer, batch_window, bus=bus, sock=sock, history=history,
+                            serializers=serializers)
+    server.start()
+
+class ShardedChatServer:
+    """
+    Runs an AsyncChatServer in each of several processes, so a chat server
+    can use every core of its host instead of the one the GIL allows.
+
+    The processes share the listening port: each binds it with SO_REUSEPORT,
+    which lets the kernel spread new connections over them, or, where that
+    is not available, they all accept on one listening socket created here.
+    Each process serves its own clients and relays messages to the others
+    over a ShardBus, so clients see the same rooms whatever process they
+    are connected to.
+
+    Each shard keeps the history of the rooms it has clients in, and with a
+    log_path logs it to a file of its own.
+
+    Args:
+        host (str): The host address of the server.
+        port (int): The port number of the server.
+        shards (int): Number of processes, by default one per CPU.
+        backlog (int): Connections the OS queues before the server accepts them.
+        slow_consumer (str): Outbox policy for clients that cannot keep up: 'drop', 'disconnect' or 'coalesce'.
+        batch_window (float): Seconds a writer waits for more messages before it sends them together.
+        log_path (str): Optional message log file; each shard appends its number to it.
+        serializers (list): Serializers accepted from clients; only 'schema' by default (see ChatHub).
+    """
+
+    def __init__(self, host, port, shards=None, backlog=1024, slow_consumer='disconnect', batch_window=BATCH_WINDOW,
+                 log_path=None, serializers=None):
+        self.host = host
+        self.port = port
+        self.shards = shards or os.cpu_count() or 1
+        self.backlog = backlog
+        self.slow_consumer = slow_consumer
+        self.batch_window = batch_window
+        self.log_path = log_path
+        self.serializers = serializers
+        self.processes = []
+
+    def start(self):
+        """
+        Starts the shard processes and waits for them to exit.
+        """
+        directory = tempfile.mkdtemp(prefix="q3-bus-")
+        sock = None
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            sock = socket.create_server((self.host, self.port), backlog=self.backlog, reuse_port=False)
+        try:
+            for shard in range(self.shards):
+                process = multiprocessing.Process(target=run_shard, name=f"q3-shard-{shard}",
+                                                  args=(self.host, self.port, shard, self.shards, directory, sock,
+                                                        self.backlog, self.slow_consumer, self.batch_window,
+                                                        self.log_path, self.serializers))
+                process.start()
+                self.processes.append(process)
+            for process in self.processes:
+                process.join()
+        except KeyboardInterrupt:
+            print("Server shutting down.")
+        finally:
+            for process in self.processes:
+                process.join(timeout=1)
+                if process.is_alive():
+                    process.terminate()
+            if sock is not None:
+                sock.close()
+            shutil.rmtree(directory, ignore_errors=True)
+
 if __name__ == "__main__":
     # Execute both server and client from the same script
     is_server = input("Are you running as a server? (y/n): ").lower() == 'y'
@@ -162,7 +1745,19 @@ if __name__ == "__main__":
     if is_server:
         host = input("Enter server host (default: 127.0.0.1): ") or "127.0.0.1"
         port = int(input("Enter server port (default: 25565): ") or 25565)
-        server = ChatServer(host, port)
+        # The event-loop server scales to thousands of clients; the threaded one is kept for comparison
+        threaded = input("Use a thread per client? (y/N): ").lower() == 'y'
+        shards = 1
+        if not threaded:
+            # More processes use more cores; they share the port and relay messages between them
+            shards = int(input(f"Number of server processes (default: 1, up to {os.cpu_count()} cores): ") or 1)
+        # Without a log, room history is kept in memory only and lost on restart
+        log_path = input("Message log file (default: none): ") or None
+        if shards > 1:
+            server = ShardedChatServer(host, port, shards, log_path=log_path)
+        else:
+            history = MessageHistory(log=MessageLog(log_path)) if log_path else None
+            server = ChatServer(host, port, history=history) if threaded else AsyncChatServer(host, port, history=history)
         server.start()
     else:
         host = input("Enter server host (default: 127.0.0.1): ") or "127.0.0.1"
@@ -170,7 +1765,7 @@ if __name__ == "__main__":
         username = input("Enter your username: ")
         client = ChatClient(host, port, username)
         while True:
-            message = input("Enter your message (type 'exit' to quit): ")
+            message = input("Enter your message (type 'exit' to quit, /help for commands): ")
             if message.lower() == 'exit':
                 break
             client.send_message(message)
@@ -0,0 +1,350 @@
+""" Benchmark harness for the Q1 file transfer.
+
+Starts a fresh Q1 server on loopback for every mode, pushes the same set of
+synthetic files to it and reports elapsed seconds, MB/s of file data sent,
+files/s handled, p50/p99 per-file latency, peak memory of client and
+server, and the server's average per-transfer timings for accept, header,
+body and fsync.
+
+The sync mode re-syncs files the server already has: it sends nothing, so
+its MB/s is 0 and its files/s is the rate at which files are checked.
+
+Usage: python bench_q1.py [--files 4K:2000,1M:100,64M:4] [--modes batch,zlib] [--json results.json]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import Q1
+from framing import send_frame, recv_frame
+from resumable import send_file_resumable
+from serializers import STRICT
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+MODES = ['single', 'batch', 'sync', 'zlib', 'resume', 'parallel']
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+TEXT = b"2024-01-01T00:00:00 INFO transfer ok user=benchmark bytes=1048576\n"
+
+def parse_size(text):
+    """ Parses a size such as 512, 4K, 64M or 1G.
+
+    Args:
+        text (str): The size.
+
+    Returns:
+        int: Size in bytes.
+    """
+    text = text.strip().upper()
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+def parse_files(spec):
+    """ Parses a file set such as '4K:2000,1M:100'.
+
+    Args:
+        spec (str): Comma separated size:count pairs.
+
+    Returns:
+        list: (size, count) tuples.
+    """
+    pairs = []
+    for item in spec.split(','):
+        size, _, count = item.partition(':')
+        pairs.append((parse_size(size), int(count or 1)))
+    return pairs
+
+def make_files(directory, pairs, compressible):
+    """ Writes the synthetic files.
+
+    Every file mixes random blocks with repetitive log text, so the codecs
+    have realistic work to do.
+
+    Args:
+        directory (str): Where to write the files.
+        pairs (list): (size, count) tuples.
+        compressible (float): Fraction of each file that is log text, from 0 to 1.
+
+    Returns:
+        int: Total number of bytes written.
+    """
+    block = 64 * 1024
+    text = (TEXT * (block // len(TEXT) + 1))[:block]
+    total = 0
+    for size, count in pairs:
+        folder = os.path.join(directory, f"{size}")
+        os.makedirs(folder, exist_ok=True)
+        for number in range(count):
+            with open(os.path.join(folder, f"file{number:06d}.bin"), 'wb') as file:
+                written = 0
+                while written < size:
+                    length = min(block, size - written)
+                    random_block = (written // block) % 100 >= compressible * 100
+                    file.write(os.urandom(length) if random_block else text[:length])
+                    written += length
+            total += size
+    return total
+
+def free_port():
+    """ Asks the OS for a free loopback port.
+
+    Returns:
+        int: The port number.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def open_connection(port):
+    """ Connects to the benchmark server without printing anything.
+
+    Args:
+        port (int): The server port.
+
+    Returns:
+        socket: A greeted connection.
+    """
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    Q1.wait_until_ready(sock)
+    return sock
+
+def start_server(save_directory, port, fsync):
+    """ Starts a Q1 server in its own process and waits until it accepts connections.
+
+    Args:
+        save_directory (str): The server's save directory.
+        port (int): The port to listen on.
+        fsync (bool): Make the server fsync every file.
+
+    Returns:
+        subprocess.Popen: The server process.
+    """
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Q1.py'),
+               'server', save_directory, '--address', '127.0.0.1', '--port', str(port),
+               '--max-connections', '16']
+    if fsync:
+        command.append('--fsync')
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            open_connection(port).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("Benchmark server did not start")
+
+def server_stats(port):
+    """ Fetches the server's per-transfer timings.
+
+    Args:
+        port (int): The server port.
+
+    Returns:
+        dict: The 'stats' reply.
+    """
+    sock = open_connection(port)
+    try:
+        send_frame(sock, {'type': 'stats'}, STRICT)
+        return recv_frame(sock)
+    finally:
+        sock.close()
+
+def send_one_per_connection(port, files):
+    """ Sends each file over a connection of its own, like the original client.
+
+    Args:
+        port (int): The server port.
+        files (list): (file path, name) tuples.
+
+    Returns:
+        list: Per-file latencies in seconds.
+    """
+    latencies = []
+    for file_path, name in files:
+        started = time.perf_counter()
+        sock = open_connection(port)
+        try:
+            Q1.send_file(sock, file_path, name, serializer=STRICT)
+            sock.shutdown(socket.SHUT_WR)
+            if not recv_frame(sock):
+                raise ConnectionError(f"{name} was not acknowledged")
+        finally:
+            sock.close()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+def run_client(mode, source, port, results):
+    """ Runs one mode's client side in a child process and reports its numbers.
+
+    Args:
+        mode (str): The mode.
+        source (str): Directory holding the synthetic files.
+        port (int): The server port.
+        results (multiprocessing.Queue): Receives the measurements.
+    """
+    sys.stdout = open(os.devnull, 'w') # Keep Q1's progress messages out of the report
+    files = Q1.collect_files([source])
+    sent = files
+    skip = 0
+
+    if mode == 'sync':
+        # Measure a re-sync against a server that already has every file
+        sock = open_connection(port)
+        Q1.send_files(sock, files, serializer=STRICT)
+        sock.close()
+        manifest = Q1.Manifest(source) # Warm the client's index as a repeated sync would have
+        manifest.scan()
+        manifest.save()
+        skip = len(server_stats(port)['transfers'])
+
+    started = time.perf_counter()
+    latencies = []
+    if mode == 'single':
+        latencies = send_one_per_connection(port, files)
+    elif mode in ('batch', 'zlib'):
+        sock = open_connection(port)
+        acks, _ = Q1.send_files(sock, files, 'zlib' if mode == 'zlib' else 'none', STRICT)
+        sock.close()
+        latencies = [ack['latency'] for ack in acks]
+    elif mode == 'sync':
+        sock = open_connection(port)
+        sent = Q1.plan_sync(sock, [source], STRICT)
+        acks, _ = Q1.send_files(sock, sent, serializer=STRICT)
+        sock.close()
+        latencies = [ack['latency'] for ack in acks]
+    elif mode in ('resume', 'parallel'):
+        sock = open_connection(port)
+        connect = (lambda: open_connection(port)) if mode == 'parallel' else None
+        for file_path, name in files:
+            file_started = time.perf_counter()
+            send_file_resumable(sock, file_path, name, connect, serializer=STRICT)
+            latencies.append(time.perf_counter() - file_started)
+        sock.close()
+    seconds = time.perf_counter() - started
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else None
+    sent_bytes = sum(os.path.getsize(file_path) for file_path, _ in sent)
+    results.put({'seconds': seconds, 'latencies': latencies, 'peak_rss': peak_rss, 'skip': skip,
+                 'sent_bytes': sent_bytes})
+
+def percentile(values, pct):
+    """ Nearest-rank percentile.
+
+    Args:
+        values (list): The samples.
+        pct (float): Percentile from 0 to 100.
+
+    Returns:
+        float: The percentile, or 0.0 without samples.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))]
+
+def bench_mode(mode, source, total_bytes, file_count, fsync):
+    """ Benchmarks one mode against a fresh server.
+
+    Args:
+        mode (str): The mode.
+        source (str): Directory holding the synthetic files.
+        total_bytes (int): Size of all files together.
+        file_count (int): Number of files.
+        fsync (bool): Make the server fsync every file.
+
+    Returns:
+        dict: The measurements.
+    """
+    save_directory = tempfile.mkdtemp(prefix=f"bench-q1-{mode}-")
+    port = free_port()
+    server = start_server(save_directory, port, fsync)
+    try:
+        results = multiprocessing.Queue()
+        client = multiprocessing.Process(target=run_client, args=(mode, source, port, results))
+        client.start()
+        measured = results.get()
+        client.join()
+        stats = server_stats(port)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(save_directory, ignore_errors=True)
+
+    transfers = stats['transfers'][measured['skip']:]
+    seconds = measured['seconds']
+    row = {'mode': mode, 'files': file_count, 'bytes': total_bytes, 'sent_bytes': measured['sent_bytes'],
+           'seconds': seconds, 'mb_per_s': measured['sent_bytes'] / seconds / 1e6, 'files_per_s': file_count / seconds,
+           'p50_ms': percentile(measured['latencies'], 50) * 1000,
+           'p99_ms': percentile(measured['latencies'], 99) * 1000,
+           'client_rss_mb': (measured['peak_rss'] or 0) / 1e6,
+           'server_rss_mb': (stats['peak_rss'] or 0) / 1e6}
+    for phase in ('accept', 'header', 'body', 'fsync'):
+        values = [transfer[phase] for transfer in transfers]
+        row[f"{phase}_ms"] = sum(values) / len(values) * 1000 if values else 0.0
+    return row
+
+def print_table(rows):
+    """ Prints the results as a table.
+
+    Args:
+        rows (list): One dict per mode.
+    """
+    columns = [('seconds', 3), ('mb_per_s', 1), ('files_per_s', 1), ('p50_ms', 2), ('p99_ms', 2),
+               ('client_rss_mb', 1), ('server_rss_mb', 1), ('accept_ms', 3),
+               ('header_ms', 3), ('body_ms', 3), ('fsync_ms', 3)]
+    print(f"{'mode':<9}" + ''.join(f"{name:>14}" for name, _ in columns))
+    for row in rows:
+        print(f"{row['mode']:<9}" + ''.join(f"{row[name]:>14.{digits}f}" for name, digits in columns))
+
+def main():
+    """ Parses the command line and runs the benchmark. """
+    parser = argparse.ArgumentParser(description="Benchmark the Q1 file transfer over loopback")
+    parser.add_argument('--files', default="4K:2000,1M:100,64M:4",
+                        help="comma separated size:count pairs of synthetic files")
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help=f"comma separated modes to run, from {', '.join(MODES)}")
+    parser.add_argument('--compressible', type=float, default=0.5,
+                        help="fraction of each file that is compressible text")
+    parser.add_argument('--fsync', action='store_true', help="make the server fsync every file")
+    parser.add_argument('--json', help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    modes = [mode.strip() for mode in args.modes.split(',')]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(sorted(unknown))}")
+
+    source = tempfile.mkdtemp(prefix="bench-q1-source-")
+    try:
+        pairs = parse_files(args.files)
+        total_bytes = make_files(source, pairs, args.compressible)
+        file_count = sum(count for _, count in pairs)
+        print(f"{file_count} files, {total_bytes / 1e6:.1f} MB")
+
+        rows = [bench_mode(mode, source, total_bytes, file_count, args.fsync) for mode in modes]
+        print_table(rows)
+
+        if args.json:
+            with open(args.json, 'w') as file:
+                json.dump(rows, file, indent=2)
+    finally:
+        shutil.rmtree(source, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
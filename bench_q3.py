@@ -0,0 +1,341 @@
+""" Load generator and fan-out latency benchmark for the Q3 chat server.
+
+Starts a fresh Q3 server on loopback for every server kind, connects
+thousands of simulated clients to it from several processes, puts them in
+rooms of a given size and has each of them send messages at a given rate.
+Reports the send-to-receive latency percentiles of room messages, messages
+delivered per second, the server's CPU use and peak memory, and how many
+clients failed to connect or were disconnected by the server.
+
+Every message carries the wall clock time it was sent at, which all
+processes on the host share, so latency is measured end to end: from the
+sending client through the server to every receiving client.
+
+Usage: python bench_q3.py [--servers async,threaded] [--clients 1000] [--room-size 10] [--rate 1] [--json results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sys
+import time
+from array import array
+
+import Q3
+from bench_q1 import free_port, percentile
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+SERVERS = ['async', 'threaded', 'sharded']
+SHARD_SETTLE = 1.0 # Seconds given to every shard to start listening once the first one accepts
+
+def run_server(kind, port, shards, slow_consumer, results):
+    """ Runs the server in a child process until it is interrupted, then reports its resource use.
+
+    Args:
+        kind (str): 'async', 'threaded' or 'sharded'.
+        port (int): The port to listen on.
+        shards (int): Number of processes of a sharded server.
+        slow_consumer (str): Outbox policy for clients that cannot keep up.
+        results (multiprocessing.Queue): Receives the measurements.
+    """
+    sys.stdout = open(os.devnull, 'w') # Keep the server's connection messages out of the report
+    Q3.raise_file_limit()
+    started = time.perf_counter()
+    if kind == 'threaded':
+        server = Q3.ChatServer('127.0.0.1', port, slow_consumer)
+    elif kind == 'async':
+        server = Q3.AsyncChatServer('127.0.0.1', port, slow_consumer=slow_consumer)
+    else:
+        server = Q3.ShardedChatServer('127.0.0.1', port, shards, slow_consumer=slow_consumer)
+    server.start()
+    seconds = time.perf_counter() - started
+    if kind == 'sharded':
+        for process in server.processes:
+            process.join() # Shards count in RUSAGE_CHILDREN once they are reaped
+
+    cpu, peak_rss = None, None
+    if resource:
+        usages = [resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)]
+        cpu = sum(usage.ru_utime + usage.ru_stime for usage in usages)
+        peak_rss = max(usage.ru_maxrss for usage in usages) * 1024
+    results.put({'seconds': seconds, 'cpu': cpu, 'peak_rss': peak_rss})
+
+def start_server(kind, port, shards, slow_consumer):
+    """ Starts a Q3 server in its own process and waits until it accepts connections.
+
+    Args:
+        kind (str): 'async', 'threaded' or 'sharded'.
+        port (int): The port to listen on.
+        shards (int): Number of processes of a sharded server.
+        slow_consumer (str): Outbox policy for clients that cannot keep up.
+
+    Returns:
+        tuple: (multiprocessing.Process, multiprocessing.Queue receiving its measurements).
+    """
+    results = multiprocessing.Queue()
+    server = multiprocessing.Process(target=run_server, args=(kind, port, shards, slow_consumer, results))
+    server.start()
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            # A connection that closes before sending a username is simply dropped
+            socket.create_connection(('127.0.0.1', port)).close()
+            if kind == 'sharded':
+                time.sleep(SHARD_SETTLE)
+            return server, results
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("Benchmark server did not start")
+
+def stop_server(server, results):
+    """ Interrupts the server as Ctrl+C would and collects its measurements.
+
+    Args:
+        server (multiprocessing.Process): The server process.
+        results (multiprocessing.Queue): Receives its measurements.
+
+    Returns:
+        dict: The measurements, with None values if the server did not report them.
+    """
+    os.kill(server.pid, signal.SIGINT)
+    try:
+        measured = results.get(timeout=30)
+    except Exception:
+        measured = {'seconds': None, 'cpu': None, 'peak_rss': None}
+    server.join(timeout=5)
+    if server.is_alive():
+        server.terminate()
+        server.join()
+    return measured
+
+async def simulate(port, first, count, options, go, start_at):
+    """ Connects clients, has them talk in their rooms and measures what they receive.
+
+    Args:
+        port (int): The server port.
+        first (int): Number of the first client of this process.
+        count (int): Number of clients in this process.
+        options (dict): join_rate, rate, duration, drain, room_size and message_size.
+        go (StartSignal): Reports that the clients are connected and waits for the other processes.
+        start_at (multiprocessing.Value): Wall clock time the measurement starts at.
+
+    Returns:
+        dict: The measurements.
+    """
+    loop = asyncio.get_running_loop()
+    stats = {'connected': 0, 'failed': 0, 'disconnects': 0, 'sent': 0, 'received': 0, 'latencies': array('d')}
+    clients = []
+    closing = False
+    window = [0.0, 0.0] # Messages sent in this wall clock window are measured
+    padding = 'x' * options['message_size']
+
+    def on_message(message):
+        if message.get('type') != 'message':
+            return
+        sent = float(message['text'].partition(' ')[0])
+        if window[0] <= sent < window[1]:
+            stats['received'] += 1
+            stats['latencies'].append(time.time() - sent)
+
+    def on_closed(task):
+        if not closing:
+            stats['disconnects'] += 1
+
+    async def join(index):
+        client = Q3.AsyncChatClient('127.0.0.1', port, f"user{index}", batch_window=0)
+        try:
+            await client.connect()
+            await client.send_message(f"/join room{index // options['room_size']}")
+            await client.send_message(f"/leave {Q3.DEFAULT_ROOM}")
+        except OSError:
+            stats['failed'] += 1
+            return
+        stats['connected'] += 1
+        clients.append(client)
+        loop.create_task(client.receive_messages(on_message)).add_done_callback(on_closed)
+
+    async def talk(client):
+        period = 1 / options['rate']
+        await asyncio.sleep(random.random() * period) # Spread the clients over the period
+        while time.time() < window[1] and not client.writer.is_closing():
+            await client.send_message(f"{time.time():.6f} {padding}")
+            stats['sent'] += 1
+            await asyncio.sleep(period)
+
+    # Join at the requested rate, without waiting for slow accepts to pace the next client
+    joins = []
+    for index in range(first, first + count):
+        joins.append(loop.create_task(join(index)))
+        await asyncio.sleep(1 / options['join_rate'])
+    await asyncio.gather(*joins)
+
+    go.ready.put(stats['connected'])
+    await loop.run_in_executor(None, go.wait)
+    window[:] = [start_at.value, start_at.value + options['duration']]
+    await asyncio.sleep(max(0.0, window[0] - time.time()))
+    await asyncio.gather(*(talk(client) for client in clients))
+    await asyncio.sleep(options['drain'])
+
+    closing = True
+    await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+    return stats
+
+def run_clients(port, first, count, options, go, start_at, results):
+    """ Runs a share of the clients in a child process and reports their numbers.
+
+    Args:
+        port (int): The server port.
+        first (int): Number of the first client of this process.
+        count (int): Number of clients in this process.
+        options (dict): See simulate.
+        go (StartSignal): Reports that the clients are connected and waits for the other processes.
+        start_at (multiprocessing.Value): Wall clock time the measurement starts at.
+        results (multiprocessing.Queue): Receives the measurements.
+    """
+    sys.stdout = open(os.devnull, 'w') # Keep the clients' error messages out of the report
+    Q3.raise_file_limit()
+    results.put(asyncio.run(simulate(port, first, count, options, go, start_at)))
+
+class StartSignal:
+    """
+    Lets the client processes report that their clients are connected and
+    wait until all of them are, so every process starts talking at once.
+    """
+
+    def __init__(self):
+        self.ready = multiprocessing.Queue()
+        self.event = multiprocessing.Event()
+
+    def wait(self):
+        """
+        Waits until every client process is ready.
+        """
+        self.event.wait()
+
+def bench_server(kind, options, clients, processes, shards, slow_consumer):
+    """ Benchmarks one server kind with a fresh server.
+
+    Args:
+        kind (str): 'async', 'threaded' or 'sharded'.
+        options (dict): See simulate.
+        clients (int): Number of simulated clients.
+        processes (int): Number of client processes.
+        shards (int): Number of processes of a sharded server.
+        slow_consumer (str): Outbox policy for clients that cannot keep up.
+
+    Returns:
+        dict: The measurements.
+    """
+    port = free_port()
+    server, server_results = start_server(kind, port, shards, slow_consumer)
+    go = StartSignal()
+    start_at = multiprocessing.Value('d', 0.0)
+    results = multiprocessing.Queue()
+    workers = []
+    try:
+        for number in range(processes):
+            first = clients * number // processes
+            count = clients * (number + 1) // processes - first
+            worker = multiprocessing.Process(target=run_clients,
+                                             args=(port, first, count, options, go, start_at, results))
+            worker.start()
+            workers.append(worker)
+        connected = sum(go.ready.get() for _ in workers)
+        start_at.value = time.time() + 0.5
+        go.event.set()
+        measured = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        usage = stop_server(server, server_results)
+
+    latencies = [latency for result in measured for latency in result['latencies']]
+    sent = sum(result['sent'] for result in measured)
+    received = sum(result['received'] for result in measured)
+    room_size = options['room_size']
+    # Every message reaches the other members of its room; the last room may be smaller
+    sizes = [min(room_size, clients - first) for first in range(0, clients, room_size)]
+    recipients = sum(size * (size - 1) for size in sizes) / clients
+    cpu = usage['cpu']
+    return {'server': kind, 'clients': connected, 'sent': sent, 'delivered': received,
+            'delivered_ratio': received / (sent * recipients) if sent and recipients else 0.0,
+            'msgs_per_s': received / options['duration'],
+            'p50_ms': percentile(latencies, 50) * 1000, 'p90_ms': percentile(latencies, 90) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000, 'max_ms': max(latencies, default=0.0) * 1000,
+            'server_cpu_pct': cpu / usage['seconds'] * 100 if cpu is not None and usage['seconds'] else 0.0,
+            'server_rss_mb': (usage['peak_rss'] or 0) / 1e6,
+            'failed': sum(result['failed'] for result in measured),
+            'disconnects': sum(result['disconnects'] for result in measured)}
+
+def print_table(rows):
+    """ Prints the results as a table.
+
+    Args:
+        rows (list): One dict per server kind.
+    """
+    columns = [('clients', 0), ('delivered', 0), ('delivered_ratio', 3), ('msgs_per_s', 0), ('p50_ms', 2),
+               ('p90_ms', 2), ('p99_ms', 2), ('max_ms', 1), ('server_cpu_pct', 1), ('server_rss_mb', 1),
+               ('failed', 0), ('disconnects', 0)]
+    print(f"{'server':<9}" + ''.join(f"{name:>16}" for name, _ in columns))
+    for row in rows:
+        print(f"{row['server']:<9}" + ''.join(f"{row[name]:>16.{digits}f}" for name, digits in columns))
+
+def main():
+    """ Parses the command line and runs the benchmark. """
+    parser = argparse.ArgumentParser(description="Benchmark the Q3 chat server over loopback")
+    parser.add_argument('--servers', default='async,threaded',
+                        help=f"comma separated server kinds to run, from {', '.join(SERVERS)}")
+    parser.add_argument('--clients', type=int, default=1000, help="number of simulated clients")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                        help="number of processes the clients are spread over")
+    parser.add_argument('--shards', type=int, default=os.cpu_count() or 1,
+                        help="number of processes of the sharded server")
+    parser.add_argument('--join-rate', type=float, default=500.0, help="clients connecting per second")
+    parser.add_argument('--rate', type=float, default=1.0, help="messages each client sends per second")
+    parser.add_argument('--room-size', type=int, default=10, help="clients per room")
+    parser.add_argument('--message-size', type=int, default=100, help="bytes of padding in every message")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds the clients send messages")
+    parser.add_argument('--drain', type=float, default=2.0,
+                        help="seconds to wait for messages still in flight after sending stops")
+    parser.add_argument('--slow-consumer', default='disconnect', choices=Q3.SLOW_CONSUMER_POLICIES,
+                        help="server policy for clients that cannot keep up")
+    parser.add_argument('--json', help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    servers = [kind.strip() for kind in args.servers.split(',')]
+    unknown = set(servers) - set(SERVERS)
+    if unknown:
+        parser.error(f"unknown servers: {', '.join(sorted(unknown))}")
+    if args.clients < 1 or args.room_size < 1 or args.rate <= 0 or args.join_rate <= 0:
+        parser.error("--clients, --room-size, --rate and --join-rate must be positive")
+
+    processes = max(1, min(args.processes, args.clients))
+    options = {'join_rate': args.join_rate / processes, 'rate': args.rate, 'duration': args.duration,
+               'drain': args.drain, 'room_size': args.room_size, 'message_size': args.message_size}
+    print(f"{args.clients} clients in {processes} processes, rooms of {args.room_size}, "
+          f"{args.rate:g} messages/s per client for {args.duration:g}s")
+
+    rows = [bench_server(kind, options, args.clients, processes, args.shards, args.slow_consumer)
+            for kind in servers]
+    print_table(rows)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(rows, file, indent=2)
+
+if __name__ == "__main__":
+    main()
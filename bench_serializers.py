@@ -0,0 +1,156 @@
+""" Micro-benchmark of the frame serializers on the payloads Q1, Q2 and Q3 send.
+
+Encodes and decodes each payload with every serializer in a tight loop and
+reports microseconds per encode and per decode, and the payload size on
+the wire. The schema serializer is measured both as negotiated with peers
+that accept pickle and as STRICT, for peers that do not; the layout column
+shows what a payload was actually encoded as, since the schema serializer
+pickles what has no fixed layout when pickle is allowed.
+
+Usage: python bench_serializers.py [--payloads q3-message,q2-results] [--seconds 0.2] [--json results.json]
+"""
+
+import argparse
+import json
+import operator
+import time
+
+from serializers import PICKLE_OPCODE, SCHEMAS_BY_TAG, SERIALIZERS, STRICT, TEXT_TAG
+
+def make_payloads():
+    """ Builds one realistic frame of every kind the applications send.
+
+    Returns:
+        dict: name -> object, in the order they are reported.
+    """
+    digests = {f"logs/2024-01-{day:02d}/part-{part:04d}.log": f"{day * 7919 + part:064x}"
+               for day in range(1, 11) for part in range(100)}
+    return {
+        'q1-file': {'type': 'file', 'name': 'logs/2024-01-01/part-0001.log', 'size': 1048576,
+                    'mtime': 1704067200.25, 'mode': 0o644, 'codec': 'none'},
+        'q1-ack': {'type': 'ack', 'name': 'logs/2024-01-01/part-0001.log', 'size': 1048576, 'status': 'ok'},
+        'q1-chunk': {'type': 'chunk', 'file_id': 'f3a9c1d2e4b5a6c7', 'index': 42, 'size': 1048576, 'codec': 'zlib'},
+        'q1-sync': {'type': 'sync', 'digests': digests},
+        'q2-task': {'id': 1234, 'task': (operator.add, (1, 2)), 'executor': None},
+        'q2-batch': {'type': 'batch', 'tasks': [(task_id, (operator.mul, (task_id, 3)), 'thread')
+                                                for task_id in range(64)]},
+        'q2-results': {'type': 'results', 'results': [(task_id, True, task_id * 3) for task_id in range(64)]},
+        'q2-heartbeat': {'type': 'heartbeat', 'queue_depth': 3, 'capacity': 16, 'processes': 8, 'threads': 8,
+                         'host_id': '4c4c4544-0042-3510-8052-b4c04f4e3532', 'serializers': list(SERIALIZERS)},
+        'q3-hello': {'type': 'hello', 'username': 'alice', 'serializers': list(SERIALIZERS)},
+        'q3-text': "hello everyone, the build is green again",
+        'q3-message': {'type': 'message', 'room': 'lobby', 'sender': 'alice',
+                       'text': "hello everyone, the build is green again", 'time': 1704067200.123456},
+        'q3-direct': {'type': 'direct', 'sender': 'alice', 'to': 'bob', 'text': "lunch at noon?"},
+        'q3-notice': {'type': 'notice', 'room': 'lobby', 'text': "bob has joined the chat."},
+    }
+
+# label -> serializer, as reported
+BENCHED = {'schema': SERIALIZERS['schema'], 'strict': STRICT, 'pickle': SERIALIZERS['pickle']}
+
+def layout(data):
+    """ Tells how a payload was encoded, from its first byte.
+
+    Args:
+        data (bytes): The payload.
+
+    Returns:
+        str: 'fixed' for a schema layout, 'text', 'value' for the generic encoding, or 'pickle'.
+    """
+    if data[0] == PICKLE_OPCODE:
+        return 'pickle'
+    if data[0] in SCHEMAS_BY_TAG:
+        return 'fixed'
+    return 'text' if data[0] == TEXT_TAG else 'value'
+
+def per_call(function, argument, seconds):
+    """ Times a function in a tight loop.
+
+    Args:
+        function (callable): The function.
+        argument: Its only argument.
+        seconds (float): Roughly how long to keep calling it.
+
+    Returns:
+        float: Microseconds per call.
+    """
+    calls = 0
+    batch = 64
+    started = time.perf_counter()
+    deadline = started + seconds
+    while True:
+        for _ in range(batch):
+            function(argument)
+        calls += batch
+        now = time.perf_counter()
+        if now >= deadline:
+            return (now - started) / calls * 1e6
+        batch *= 2
+
+def bench_payload(name, payload, seconds):
+    """ Measures every serializer on one payload.
+
+    Args:
+        name (str): The payload's name.
+        payload: The object.
+        seconds (float): Time spent on each measurement.
+
+    Returns:
+        list: One dict per serializer that can encode the payload; STRICT cannot encode functions.
+    """
+    rows = []
+    for label, serializer in BENCHED.items():
+        try:
+            data = serializer.encode(payload)
+        except TypeError:
+            continue
+        if serializer.decode(data) != payload:
+            raise AssertionError(f"{label} does not round-trip {name}")
+        rows.append({'payload': name, 'serializer': label, 'layout': layout(data), 'bytes': len(data),
+                     'encode_us': per_call(serializer.encode, payload, seconds),
+                     'decode_us': per_call(serializer.decode, data, seconds)})
+    return rows
+
+def print_table(rows):
+    """ Prints the results as a table, with each serializer relative to pickle.
+
+    Args:
+        rows (list): One dict per payload and serializer.
+    """
+    pickled = {row['payload']: row for row in rows if row['serializer'] == 'pickle'}
+    print(f"{'payload':<14}{'serializer':<12}{'layout':<8}{'bytes':>10}{'encode_us':>12}{'decode_us':>12}"
+          f"{'size_vs_pickle':>16}{'speed_vs_pickle':>17}")
+    for row in rows:
+        base = pickled.get(row['payload'], row)
+        speed = (base['encode_us'] + base['decode_us']) / (row['encode_us'] + row['decode_us'])
+        print(f"{row['payload']:<14}{row['serializer']:<12}{row['layout']:<8}{row['bytes']:>10}"
+              f"{row['encode_us']:>12.2f}{row['decode_us']:>12.2f}{row['bytes'] / base['bytes']:>16.2f}"
+              f"{speed:>16.2f}x")
+
+def main():
+    """ Parses the command line and runs the benchmark. """
+    payloads = make_payloads()
+    parser = argparse.ArgumentParser(description="Benchmark the frame serializers on real payloads")
+    parser.add_argument('--payloads', default=','.join(payloads),
+                        help=f"comma separated payloads to run, from {', '.join(payloads)}")
+    parser.add_argument('--seconds', type=float, default=0.2,
+                        help="seconds spent on each encode and decode measurement")
+    parser.add_argument('--json', help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.payloads.split(',')]
+    unknown = set(names) - set(payloads)
+    if unknown:
+        parser.error(f"unknown payloads: {', '.join(sorted(unknown))}")
+
+    rows = []
+    for name in names:
+        rows += bench_payload(name, payloads[name], args.seconds)
+    print_table(rows)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(rows, file, indent=2)
+
+if __name__ == "__main__":
+    main()
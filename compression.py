@@ -0,0 +1,193 @@
+""" Negotiated, block-wise compression of file bodies.
+
+A compressed body is a sequence of blocks, each a 1 byte flag and a 4 byte
+length followed by the payload. Every block covers up to CHUNK_SIZE bytes of
+the original data and is compressed on its own, so both sides stream with
+bounded memory and the sender can fall back to raw blocks at any point.
+"""
+
+import os
+import struct
+import time
+import zlib
+
+try:
+    import bz2
+except ImportError: # Python built without libbz2
+    bz2 = None
+
+try:
+    import lzma
+except ImportError: # Python built without liblzma
+    lzma = None
+
+from framing import recv_exact, CHUNK_SIZE
+
+BLOCK_HEADER = struct.Struct("!BI") # flag, payload length
+RAW = 0 # Block payload is stored as is
+COMPRESSED = 1 # Block payload is compressed with the transfer's codec
+PROBE_BLOCKS = 2 # Blocks compressed before deciding whether compression pays off
+MIN_SAVING = 0.1 # Keep compressing only if the probe blocks shrank by at least 10%
+
+# name -> (compress function, decompressor factory), in order of preference
+CODECS = {'zlib': (zlib.compress, zlib.decompressobj)}
+if lzma is not None:
+    # The default preset is too slow to keep up with a network link
+    CODECS['lzma'] = (lambda data: lzma.compress(data, preset=1), lzma.LZMADecompressor)
+if bz2 is not None:
+    CODECS['bz2'] = (bz2.compress, bz2.BZ2Decompressor)
+
+def available_codecs():
+    """ Lists the codecs this side supports.
+
+    Returns:
+        list: Codec names in order of preference, ending with 'none'.
+    """
+    return list(CODECS) + ['none']
+
+def negotiate(requested, offered):
+    """ Picks the codec for a transfer.
+
+    Args:
+        requested (str): Codec asked for by the user, or 'auto' for the best shared one.
+        offered (list): Codecs the other side supports.
+
+    Returns:
+        str: The codec name, 'none' if nothing usable is shared.
+    """
+    if requested == 'auto':
+        for name in available_codecs():
+            if name in offered:
+                return name
+        return 'none'
+    if requested not in offered or requested not in available_codecs():
+        print(f"Codec {requested} is not supported by both sides; sending uncompressed")
+        return 'none'
+    return requested
+
+class CompressionStats:
+    """
+    Bytes before and after compression, and the CPU time it took.
+    """
+
+    def __init__(self):
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.cpu_seconds = 0.0
+        # Sizes of the first blocks of the transfer, used to decide whether compression pays off
+        self.probe_blocks = 0
+        self.probe_raw = 0
+        self.probe_wire = 0
+
+    def add(self, other):
+        """
+        Adds another transfer's numbers to these.
+
+        Args:
+            other (CompressionStats): The other transfer.
+        """
+        self.raw_bytes += other.raw_bytes
+        self.wire_bytes += other.wire_bytes
+        self.cpu_seconds += other.cpu_seconds
+
+    @property
+    def ratio(self):
+        """
+        Original size divided by size on the wire.
+        """
+        return self.raw_bytes / self.wire_bytes if self.wire_bytes else 1.0
+
+    def __str__(self):
+        return (f"{self.raw_bytes} -> {self.wire_bytes} bytes (ratio {self.ratio:.2f}x, "
+                f"{self.cpu_seconds:.3f}s CPU)")
+
+def send_compressed(sock, file, offset, size, codec, stats):
+    """ Compresses size bytes of a file, starting at offset, and sends them as blocks.
+
+    The first PROBE_BLOCKS blocks are compressed; if they did not shrink by
+    MIN_SAVING the rest is sent raw, which skips already compressed data such
+    as images and archives. The decision is kept in stats, so a file sent in
+    several calls is only probed once.
+
+    Args:
+        sock (socket): The socket to write to.
+        file (file): File opened in binary mode.
+        offset (int): File offset of the first byte.
+        size (int): Number of bytes to send.
+        codec (str): Codec name.
+        stats (CompressionStats): Updated with the sizes and CPU time.
+    """
+    compress = CODECS[codec][0]
+    remaining = size
+    while remaining:
+        data = os.pread(file.fileno(), min(CHUNK_SIZE, remaining), offset)
+        if not data:
+            raise ValueError("File shrank while it was being sent")
+
+        flag, payload = RAW, data
+        probing = stats.probe_blocks < PROBE_BLOCKS
+        if probing or stats.probe_wire <= stats.probe_raw * (1 - MIN_SAVING):
+            started = time.thread_time()
+            compressed = compress(data)
+            stats.cpu_seconds += time.thread_time() - started
+            if len(compressed) < len(data):
+                flag, payload = COMPRESSED, compressed
+            if probing:
+                stats.probe_blocks += 1
+                stats.probe_raw += len(data)
+                stats.probe_wire += len(payload)
+
+        sock.sendall(BLOCK_HEADER.pack(flag, len(payload)))
+        sock.sendall(payload)
+        stats.raw_bytes += len(data)
+        stats.wire_bytes += BLOCK_HEADER.size + len(payload)
+        offset += len(data)
+        remaining -= len(data)
+
+def recv_compressed(sock, write, size, codec, stats, digest=None):
+    """ Receives blocks and writes the original size bytes.
+
+    Args:
+        sock (socket): The socket to read from.
+        write (callable): Called with each block of original data, in order.
+        size (int): Number of original bytes to receive.
+        codec (str): Codec name.
+        stats (CompressionStats): Updated with the sizes and CPU time.
+        digest (hashlib object): Optional hasher updated with the original data.
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unsupported codec: {codec!r}")
+    decompressor = CODECS[codec][1]
+
+    remaining = size
+    while remaining:
+        header = recv_exact(sock, BLOCK_HEADER.size)
+        if header is None:
+            raise ConnectionError(f"Connection closed with {remaining} of {size} bytes outstanding")
+        flag, length = BLOCK_HEADER.unpack(header)
+        if length > 2 * CHUNK_SIZE:
+            raise ValueError(f"Block of {length} bytes is too large")
+        payload = recv_exact(sock, length) if length else b''
+        if payload is None:
+            raise ConnectionError("Connection closed inside a block")
+
+        limit = min(CHUNK_SIZE, remaining)
+        if flag == COMPRESSED:
+            # Bound the output so a malicious block cannot expand without limit
+            started = time.thread_time()
+            state = decompressor()
+            data = state.decompress(payload, limit)
+            stats.cpu_seconds += time.thread_time() - started
+            if not state.eof:
+                raise ValueError("Block expands beyond its announced size")
+        else:
+            data = payload
+        if not data or len(data) > limit:
+            raise ValueError("Block does not match the announced size")
+
+        write(data)
+        if digest is not None:
+            digest.update(data)
+        stats.raw_bytes += len(data)
+        stats.wire_bytes += BLOCK_HEADER.size + length
+        remaining -= len(data)
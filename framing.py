@@ -0,0 +1,216 @@
+""" Length-prefixed framing helpers shared by the socket applications.
+
+A frame is a 4 byte big-endian length followed by an object encoded by a
+serializer (see serializers.py). Frames are pickled unless the connection
+negotiated another serializer; every frame is decoded by what it holds, so
+readers do not need to know which one the sender used. Large payloads such
+as file bodies are not framed; they are streamed as raw bytes right after
+the frame that announces their size.
+"""
+
+import os
+import struct
+
+from serializers import PERMISSIVE, SERIALIZERS
+
+FRAME_HEADER = struct.Struct("!I") # 4 byte unsigned length prefix
+MAX_FRAME_SIZE = 16 * 1024 * 1024 # Upper bound for a single frame (16 MiB)
+CHUNK_SIZE = 1024 * 1024 # Size of the chunks used to stream bodies (1 MiB)
+
+def recv_exact(sock, size):
+    """ Receives exactly size bytes from a socket.
+
+    Args:
+        sock (socket): The socket to read from.
+        size (int): Number of bytes to read.
+
+    Returns:
+        bytes: The data, or None if the connection was closed before any byte was read.
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            if received == 0:
+                return None
+            raise ConnectionError(f"Connection closed after {received} of {size} bytes")
+        received += count
+    return bytes(buffer)
+
+def encode_frame(obj, serializer=None):
+    """ Encodes an object into one length-prefixed frame.
+
+    Frames can be concatenated and sent in a single write.
+
+    Args:
+        obj: The object to encode.
+        serializer: The connection's serializer; pickle by default.
+
+    Returns:
+        bytes: The frame.
+    """
+    payload = (serializer or SERIALIZERS['pickle']).encode(obj)
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def send_frame(sock, obj, serializer=None):
+    """ Encodes an object and sends it as one length-prefixed frame.
+
+    Args:
+        sock (socket): The socket to write to.
+        obj: The object to send.
+        serializer: The connection's serializer; pickle by default.
+    """
+    sock.sendall(encode_frame(obj, serializer))
+
+def recv_frame(sock, serializer=None):
+    """ Receives one length-prefixed frame and decodes it.
+
+    Args:
+        sock (socket): The socket to read from.
+        serializer: Decodes the frame; by default any frame is accepted, pickles included.
+
+    Returns:
+        The decoded object, or None if the peer closed the connection cleanly.
+    """
+    header = recv_exact(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+
+    (length,) = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+
+    payload = recv_exact(sock, length)
+    if payload is None:
+        raise ConnectionError("Connection closed before the frame payload arrived")
+    return (serializer or PERMISSIVE).decode(payload)
+
+class FrameDecoder:
+    """
+    Decodes frames from a byte stream incrementally, for readers that take
+    whatever a read returns: several frames at once, or part of one.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, serializer=None):
+        """
+        Args:
+            max_frame_size (int): Largest frame accepted.
+            serializer: Decodes the frames; by default any frame is accepted, pickles included.
+                Can be replaced between calls to feed, e.g. once a handshake is over.
+        """
+        self.max_frame_size = max_frame_size
+        self.serializer = serializer or PERMISSIVE
+        self.buffer = bytearray() # Bytes of a frame that is not complete yet
+
+    def feed(self, data):
+        """ Adds received bytes and decodes every frame they complete.
+
+        Args:
+            data (bytes): The bytes, as read from the stream.
+
+        Returns:
+            list: The decoded objects, in stream order.
+
+        Raises:
+            ValueError: If a frame exceeds max_frame_size or cannot be decoded.
+        """
+        if self.buffer:
+            self.buffer += data
+            data = self.buffer
+        objects = []
+        offset = 0
+        with memoryview(data) as view:
+            end = len(view)
+            while end - offset >= FRAME_HEADER.size:
+                (length,) = FRAME_HEADER.unpack_from(view, offset)
+                if length > self.max_frame_size:
+                    raise ValueError(f"Frame of {length} bytes exceeds the {self.max_frame_size} byte limit")
+                start = offset + FRAME_HEADER.size
+                if end - start < length:
+                    break
+                objects.append(self.serializer.decode(view[start:start + length]))
+                offset = start + length
+            if data is not self.buffer:
+                # Usually nothing is left over; only a partial frame is copied
+                self.buffer = bytearray(view[offset:])
+        if data is self.buffer:
+            del self.buffer[:offset]
+        return objects
+
+def send_body(sock, file, size, offset=None):
+    """ Streams size bytes of an open file to a socket.
+
+    socket.sendfile uses the zero-copy sendfile syscall where the platform
+    supports it and falls back to a chunked send loop otherwise.
+
+    Args:
+        sock (socket): The socket to write to.
+        file (file): File opened in binary mode, positioned at the start of the body.
+        size (int): Number of bytes to send.
+        offset (int): Optional file offset to start at instead of the current position.
+    """
+    if not size:
+        return
+    if offset is None:
+        offset = file.tell()
+    sent = sock.sendfile(file, offset, size)
+    if sent != size:
+        raise ConnectionError(f"Sent {sent} of {size} bytes")
+
+def recv_body(sock, file, size, buffer=None, digest=None):
+    """ Streams size bytes from a socket into an open file.
+
+    Data goes through one reused buffer, so memory use does not depend on
+    the size of the body.
+
+    Args:
+        sock (socket): The socket to read from.
+        file (file): File opened in binary mode for writing.
+        size (int): Number of bytes to receive.
+        buffer (bytearray): Optional buffer to reuse between calls.
+        digest (hashlib object): Optional hasher updated with every byte written.
+    """
+    if buffer is None:
+        buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    remaining = size
+    while remaining:
+        count = sock.recv_into(view, min(remaining, len(view)))
+        if count == 0:
+            raise ConnectionError(f"Connection closed with {remaining} of {size} bytes outstanding")
+        file.write(view[:count])
+        if digest is not None:
+            digest.update(view[:count])
+        remaining -= count
+
+def recv_body_at(sock, fd, offset, size, buffer=None, digest=None):
+    """ Streams size bytes from a socket to an offset of a file descriptor.
+
+    os.pwrite does not move a shared file position, so several threads can
+    fill different ranges of the same file at once.
+
+    Args:
+        sock (socket): The socket to read from.
+        fd (int): File descriptor opened for writing.
+        offset (int): File offset of the first byte.
+        size (int): Number of bytes to receive.
+        buffer (bytearray): Optional buffer to reuse between calls.
+        digest (hashlib object): Optional hasher updated with every byte written.
+    """
+    if buffer is None:
+        buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    remaining = size
+    while remaining:
+        count = sock.recv_into(view, min(remaining, len(view)))
+        if count == 0:
+            raise ConnectionError(f"Connection closed with {remaining} of {size} bytes outstanding")
+        written = 0
+        while written < count:
+            written += os.pwrite(fd, view[written:count], offset + written)
+        if digest is not None:
+            digest.update(view[:count])
+        offset += count
+        remaining -= count
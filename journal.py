@@ -0,0 +1,158 @@
+""" Append-only record journal.
+
+A record is a 21 byte header (kind, sequence number, a signed integer
+attribute and the payload length) followed by the payload. Records are only
+ever appended, so a crash can at worst cut the last record short; readers
+stop at such a torn record and the owner truncates it away.
+"""
+
+import os
+import struct
+import threading
+
+RECORD_HEADER = struct.Struct("!BQqI") # kind, sequence number, attribute, payload length
+
+class Journal:
+    """
+    An append-only file of records, written with positional I/O so readers
+    and the appender do not share a file position.
+    """
+
+    def __init__(self, path, fsync=False):
+        """
+        Opens or creates a journal.
+
+        Args:
+            path (str): The journal file.
+            fsync (bool): Flush every append to disk before returning.
+        """
+        self.path = path
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.size = os.fstat(self.fd).st_size
+
+    @property
+    def inode(self):
+        """
+        Identity of the journal file, which changes when it is rewritten.
+        """
+        return os.fstat(self.fd).st_ino
+
+    def append(self, records):
+        """
+        Appends records with a single write.
+
+        Args:
+            records (list): (kind, sequence, attribute, payload bytes) tuples.
+
+        Returns:
+            list: The file offset of each record.
+        """
+        offsets = []
+        parts = []
+        with self.lock:
+            position = self.size
+            for kind, sequence, attribute, payload in records:
+                offsets.append(position)
+                parts.append(RECORD_HEADER.pack(kind, sequence, attribute, len(payload)))
+                parts.append(payload)
+                position += RECORD_HEADER.size + len(payload)
+            data = b''.join(parts)
+            written = 0
+            while written < len(data):
+                written += os.pwrite(self.fd, data[written:], self.size + written)
+            self.size = position
+            if self.fsync:
+                os.fdatasync(self.fd)
+        return offsets
+
+    def read(self, offset):
+        """
+        Reads one record.
+
+        Args:
+            offset (int): File offset of the record.
+
+        Returns:
+            tuple: (kind, sequence, attribute, payload bytes).
+        """
+        header = os.pread(self.fd, RECORD_HEADER.size, offset)
+        kind, sequence, attribute, length = RECORD_HEADER.unpack(header)
+        payload = os.pread(self.fd, length, offset + RECORD_HEADER.size) if length else b''
+        if len(payload) != length:
+            raise ValueError(f"Record at offset {offset} of {self.path} is truncated")
+        return kind, sequence, attribute, payload
+
+    def scan(self, offset=0, payloads=False):
+        """
+        Iterates over the records from offset on, without reading their payloads
+        unless asked to.
+
+        The scan stops before a record that was cut short. Records appended
+        while it runs are not included, so it can run on another thread than
+        the writer.
+
+        Args:
+            offset (int): File offset of the first record.
+            payloads (bool): Read the payloads in the same sequential pass, instead of their lengths.
+
+        Yields:
+            tuple: (offset, kind, sequence, attribute, payload length or payload).
+        """
+        end = self.size
+        with open(self.path, 'rb') as file:
+            file.seek(offset)
+            while offset + RECORD_HEADER.size <= end:
+                kind, sequence, attribute, length = RECORD_HEADER.unpack(file.read(RECORD_HEADER.size))
+                if offset + RECORD_HEADER.size + length > end:
+                    break
+                if payloads:
+                    yield offset, kind, sequence, attribute, file.read(length)
+                else:
+                    yield offset, kind, sequence, attribute, length
+                offset += RECORD_HEADER.size + length
+                if length and not payloads:
+                    file.seek(offset)
+
+    def truncate(self, size):
+        """
+        Cuts the journal back to size bytes, e.g. to drop a torn record.
+
+        Args:
+            size (int): The new size.
+        """
+        with self.lock:
+            os.ftruncate(self.fd, size)
+            self.size = size
+
+    def rewrite(self, records):
+        """
+        Replaces the journal with the given records, e.g. to drop dead ones.
+
+        The new journal is written next to the old one and swapped in with
+        os.replace, so a crash leaves one or the other intact.
+
+        Args:
+            records (list): (kind, sequence, attribute, payload bytes) tuples.
+
+        Returns:
+            list: The file offset of each record in the new journal.
+        """
+        with self.lock:
+            temp_path = self.path + ".tmp"
+            replacement = Journal(temp_path, self.fsync)
+            replacement.truncate(0)
+            offsets = replacement.append(records)
+            os.fsync(replacement.fd)
+            os.replace(temp_path, self.path)
+            os.close(self.fd)
+            self.fd, self.size = replacement.fd, replacement.size
+        return offsets
+
+    def close(self):
+        """
+        Closes the journal file.
+        """
+        with self.lock:
+            os.close(self.fd)
@@ -0,0 +1,160 @@
+""" Persisted index of the files in a directory tree.
+
+Each entry records a file's size, modification time and content digest. A
+file is only hashed again when its size or modification time changes, so
+rescanning an unchanged tree costs one stat per file.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+MANIFEST_NAME = ".q1manifest.json" # Manifest file kept at the root of the indexed directory
+HASH_CHUNK_SIZE = 1024 * 1024 # Bytes read at a time while hashing
+
+def new_digest():
+    """ Creates the hash object used for file digests.
+
+    Returns:
+        hashlib object: A fresh sha256 hasher.
+    """
+    return hashlib.sha256()
+
+def is_manifest(name):
+    """ Tells whether a base name belongs to the manifest or its temporary copy.
+
+    Args:
+        name (str): Base name of a file.
+
+    Returns:
+        bool: True for the manifest's own files.
+    """
+    return name in (MANIFEST_NAME, MANIFEST_NAME + ".tmp")
+
+def file_digest(path):
+    """ Hashes a file's content.
+
+    Args:
+        path (str): Path of the file.
+
+    Returns:
+        str: Hex digest of the content.
+    """
+    digest = new_digest()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class Manifest:
+    """
+    Index of (path, size, mtime, content hash) for every file below a directory.
+
+    Args:
+        directory (str): Root of the indexed tree.
+        ignore (callable): Optional predicate on a file's '/' separated relative path; matching files
+            are not indexed.
+    """
+
+    def __init__(self, directory, ignore=None):
+        self.directory = directory
+        self.ignore = ignore
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """
+        Loads the persisted manifest, starting empty if it is missing or unreadable.
+        """
+        try:
+            with open(self.path, 'r') as file:
+                self.entries = json.load(file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        """
+        Writes the manifest next to the files it describes.
+
+        The file is replaced atomically so a crash never leaves a half written index.
+        """
+        with self.lock:
+            temp_path = self.path + ".tmp"
+            with open(temp_path, 'w') as file:
+                json.dump(self.entries, file, sort_keys=True)
+            os.replace(temp_path, self.path)
+
+    def scan(self):
+        """
+        Brings the manifest up to date with the directory tree.
+
+        Only files whose size or modification time changed are hashed again.
+        Manifest files are skipped in every directory, and so are files matching ignore.
+
+        Returns:
+            dict: The current entries, keyed by '/' separated relative path.
+        """
+        found = {}
+        pending = [(self.directory, "")]
+        while pending:
+            directory, prefix = pending.pop()
+            with os.scandir(directory) as iterator:
+                for entry in iterator:
+                    name = prefix + entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append((entry.path, name + "/"))
+                    elif entry.is_file() and not is_manifest(entry.name) \
+                            and not (self.ignore and self.ignore(name)):
+                        stat = entry.stat()
+                        found[name] = self.refresh(name, entry.path, stat)
+
+        with self.lock:
+            self.entries = found
+            return dict(found)
+
+    def refresh(self, name, path, stat):
+        """
+        Returns the entry for a file, hashing it only if it changed since the last scan.
+
+        Args:
+            name (str): Relative path of the file.
+            path (str): Path of the file on disk.
+            stat (os.stat_result): Current stat of the file.
+
+        Returns:
+            dict: Entry with size, mtime_ns and digest.
+        """
+        with self.lock:
+            known = self.entries.get(name)
+        if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': file_digest(path)}
+
+    def update(self, name, digest):
+        """
+        Records a file that was just written, using a digest computed while writing it.
+
+        Args:
+            name (str): Relative path of the file.
+            digest (str): Hex digest of the file's content.
+        """
+        stat = os.stat(os.path.join(self.directory, *name.split('/')))
+        with self.lock:
+            self.entries[name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest}
+
+    def changed(self, digests):
+        """
+        Compares another side's digests with this manifest.
+
+        Args:
+            digests (dict): Relative path -> hex digest.
+
+        Returns:
+            list: Paths that are missing here or whose content differs.
+        """
+        with self.lock:
+            return [name for name, digest in digests.items()
+                    if self.entries.get(name, {}).get('digest') != digest]
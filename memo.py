@@ -0,0 +1,109 @@
+""" Result memoization for pure tasks.
+
+A task is cached under its function's identity (module and qualified name)
+and a digest of its pickled arguments, so equal arguments map to the same
+entry without the arguments themselves being kept alive by the cache.
+"""
+
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+def task_key(function, args):
+    """ Builds the cache key of a task.
+
+    Args:
+        function (callable): The task function.
+        args (tuple): The positional arguments.
+
+    Returns:
+        tuple: (function identity, argument digest), or None if the arguments cannot be pickled.
+    """
+    try:
+        payload = pickle.dumps(args, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return None
+    identity = f"{getattr(function, '__module__', None)}.{getattr(function, '__qualname__', repr(function))}"
+    return identity, hashlib.blake2b(payload, digest_size=16).digest()
+
+class ResultCache:
+    """
+    A thread-safe LRU cache of task results with optional expiry.
+    """
+
+    def __init__(self, max_entries=4096, ttl=None):
+        """
+        Args:
+            max_entries (int): Most results kept; the least recently used one is evicted first.
+            ttl (float): Default seconds a result stays valid, None for no expiry.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (result, expiry time.monotonic() or None)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """
+        Looks up a result and counts the hit or miss.
+
+        Args:
+            key (tuple): Key from task_key.
+
+        Returns:
+            tuple: (True, result) on a hit, (False, None) on a miss.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, key, result, ttl=None):
+        """
+        Stores a result.
+
+        Args:
+            key (tuple): Key from task_key.
+            result: The result.
+            ttl (float): Seconds the result stays valid, overriding the cache's default.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            self.entries[key] = (result, time.monotonic() + ttl if ttl is not None else None)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Drops every result; the statistics are kept.
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Reports how well the cache is doing.
+
+        Returns:
+            dict: entries, hits, misses, hit_rate, evictions and expirations.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions, 'expirations': self.expirations}
@@ -0,0 +1,667 @@
+""" Resumable, chunk-verified file uploads.
+
+The file is split into fixed-size chunks and the client announces the digest
+of every chunk up front. The server answers with the chunks it does not hold
+yet, either from an interrupted upload or from an older copy of the same
+file, and the client sends only those. Chunks are verified as they arrive,
+written in place into a hidden partial file, and the finished file is moved
+into place atomically.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import socket
+import threading
+import time
+
+from framing import send_frame, recv_frame, send_body, recv_body_at
+from manifest import new_digest, HASH_CHUNK_SIZE
+from compression import send_compressed, recv_compressed, CompressionStats
+
+MIN_CHUNK_SIZE = 4 * 1024 * 1024 # Smallest chunk size (4 MiB)
+MAX_CHUNKS = 16384 # Chunk size doubles until a file fits in this many chunks
+MAX_ROUNDS = 3 # Commit attempts before giving up on chunks that fail verification
+STREAM_SIZE = 64 * 1024 * 1024 # Bytes per parallel stream when the count is picked automatically
+MAX_STREAMS = 8 # Upper bound for the automatic stream count
+PARTIAL_NAME = re.compile(r"\.[0-9a-f]{32}\.part(\.chunks)?") # Names of partial files and chunk records
+CHECKPOINT_CHUNKS = 16 # Verified chunks written before they are synced to disk and recorded
+
+def pick_chunk_size(size):
+    """ Picks the chunk size for a file.
+
+    Args:
+        size (int): File size in bytes.
+
+    Returns:
+        int: Chunk size in bytes.
+    """
+    chunk_size = MIN_CHUNK_SIZE
+    while size > chunk_size * MAX_CHUNKS:
+        chunk_size *= 2
+    return chunk_size
+
+def file_id_for(name):
+    """ Derives the upload ID of a file from the name it is saved under.
+
+    The ID does not depend on the content, so a changed file is sent as a
+    delta against whatever the server already has under that name.
+
+    Args:
+        name (str): Relative name of the file.
+
+    Returns:
+        str: The file ID.
+    """
+    return hashlib.sha256(name.encode('utf-8')).hexdigest()[:32]
+
+def is_partial(name):
+    """ Tells whether a name belongs to an upload in progress.
+
+    Only the names the server creates match: ".<file ID>.part" and
+    ".<file ID>.part.chunks", at the root of the save directory.
+
+    Args:
+        name (str): '/' separated name relative to the save directory.
+
+    Returns:
+        bool: True for partial files and their chunk records.
+    """
+    return PARTIAL_NAME.fullmatch(name) is not None
+
+def file_mode(header):
+    """ Gets the permissions to give a received file.
+
+    Args:
+        header (dict): The 'file' or 'begin' frame.
+
+    Returns:
+        int: The sender's permission bits; setuid, setgid and sticky bits are dropped.
+
+    Raises:
+        ValueError: If the mode is not an integer.
+    """
+    mode = header.get('mode', 0o644)
+    if type(mode) is not int:
+        raise ValueError(f"Invalid file mode: {mode!r}")
+    return mode & 0o777
+
+def chunk_digests(file, size, chunk_size):
+    """ Hashes every chunk of a file, and the whole file, in one pass.
+
+    Args:
+        file (file): File opened in binary mode.
+        size (int): Number of bytes to hash.
+        chunk_size (int): Chunk size in bytes.
+
+    Returns:
+        tuple: (list of chunk hex digests, whole-file hex digest)
+    """
+    digests = []
+    whole = new_digest()
+    file.seek(0)
+    offset = 0
+    while offset < size:
+        chunk = new_digest()
+        remaining = min(chunk_size, size - offset)
+        while remaining:
+            data = file.read(min(HASH_CHUNK_SIZE, remaining))
+            if not data:
+                raise ValueError("File shrank while it was being hashed")
+            chunk.update(data)
+            whole.update(data)
+            remaining -= len(data)
+        digests.append(chunk.hexdigest())
+        offset += chunk_size
+    return digests, whole.hexdigest()
+
+def pick_stream_count(size):
+    """ Picks how many parallel connections to use for a file.
+
+    Args:
+        size (int): File size in bytes.
+
+    Returns:
+        int: One stream per STREAM_SIZE bytes, between 1 and MAX_STREAMS.
+    """
+    return max(1, min(MAX_STREAMS, size // STREAM_SIZE))
+
+def send_chunks(client_socket, file, file_id, indexes, chunk_size, size, codec, stats, serializer=None):
+    """Streams chunks straight from their offsets in a file.
+
+    Args:
+        client_socket (socket): The socket to send on.
+        file (file): File opened in binary mode.
+        file_id (str): The file ID.
+        indexes (list): Chunk indexes to send.
+        chunk_size (int): Chunk size in bytes.
+        size (int): File size in bytes.
+        codec (str): Compression codec agreed with the server.
+        stats (CompressionStats): Updated with the bytes read and sent.
+        serializer: Serializer agreed with the server; pickle by default.
+    """
+    for index in indexes:
+        offset = index * chunk_size
+        length = min(chunk_size, size - offset)
+        send_frame(client_socket, {'type': 'chunk', 'file_id': file_id,
+                                   'index': index, 'size': length, 'codec': codec}, serializer)
+        if codec == 'none':
+            send_body(client_socket, file, length, offset)
+            stats.raw_bytes += length
+            stats.wire_bytes += length
+        else:
+            send_compressed(client_socket, file, offset, length, codec, stats)
+
+def send_stream(file_path, file_id, indexes, chunk_size, size, connect, codec, results, serializer=None):
+    """Sends a range of chunks over a connection of its own.
+
+    Runs on its own thread. Failures are only printed: chunks that did not
+    arrive are reported as missing when the file is committed and are sent
+    again over the main connection.
+
+    Args:
+        file_path (str): Path of the file.
+        file_id (str): The file ID.
+        indexes (list): Chunk indexes to send.
+        chunk_size (int): Chunk size in bytes.
+        size (int): File size in bytes.
+        connect (callable): Opens a new, greeted connection to the server.
+        codec (str): Compression codec agreed with the server.
+        results (list): List this stream's CompressionStats is appended to.
+        serializer: Serializer agreed with the server; pickle by default.
+    """
+    stats = CompressionStats()
+    results.append(stats)
+    try:
+        stream_socket = connect()
+        try:
+            with open(file_path, 'rb') as file:
+                send_chunks(stream_socket, file, file_id, indexes, chunk_size, size, codec, stats, serializer)
+
+            # The server closes its side once it has written every chunk sent on this connection
+            stream_socket.shutdown(socket.SHUT_WR)
+            while stream_socket.recv(64):
+                pass
+        finally:
+            stream_socket.close()
+    except Exception as e:
+        print(f"Error: stream for chunks {indexes[0]}-{indexes[-1]}: {e}")
+
+def send_file_resumable(client_socket, file_path, name=None, connect=None, streams=None, codec='none',
+                        serializer=None):
+    """Uploads a file, sending only the chunks the server does not already hold.
+
+    With a connect callable the missing chunks are split into contiguous
+    byte ranges and sent over several connections at once. Any chunk that
+    fails to arrive is sent again over client_socket.
+
+    Args:
+        client_socket (socket): The client socket, already greeted by the server.
+        file_path (str): Path of the file to send.
+        name (str): Name to save the file under. Defaults to the file name.
+        connect (callable): Opens a new, greeted connection for parallel streams.
+        streams (int): Number of parallel streams. Picked from the file size if not given.
+        codec (str): Compression codec agreed with the server.
+        serializer: Serializer agreed with the server; pickle by default.
+
+    Returns:
+        CompressionStats: Bytes read for the chunks that were sent, and bytes actually sent.
+    """
+    name = name or os.path.basename(file_path)
+    with open(file_path, 'rb') as file:
+        stat = os.fstat(file.fileno())
+        size = stat.st_size
+        chunk_size = pick_chunk_size(size)
+        digests, whole = chunk_digests(file, size, chunk_size)
+        file_id = file_id_for(name)
+
+        # Announce the file and learn which chunks the server is missing
+        send_frame(client_socket, {'type': 'begin', 'file_id': file_id, 'name': name,
+                                   'size': size, 'chunk_size': chunk_size, 'digests': digests,
+                                   'mtime': stat.st_mtime, 'mode': stat.st_mode & 0o777}, serializer)
+        reply = recv_frame(client_socket)
+        if not reply or reply.get('type') != 'missing':
+            raise ConnectionError(f"{name}: server did not answer the upload request")
+        indexes = reply['indexes']
+
+        streams = min(streams or pick_stream_count(size), len(indexes)) if connect else 1
+        stats = CompressionStats()
+        for attempt in range(MAX_ROUNDS):
+            if attempt == 0 and streams > 1:
+                # Split the missing chunks into contiguous ranges, one per connection
+                share = -(-len(indexes) // streams)
+                results = []
+                threads = [threading.Thread(target=send_stream,
+                                            args=(file_path, file_id, indexes[i:i + share],
+                                                  chunk_size, size, connect, codec, results, serializer))
+                           for i in range(0, len(indexes), share)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                for result in results:
+                    stats.add(result)
+            else:
+                send_chunks(client_socket, file, file_id, indexes, chunk_size, size, codec, stats, serializer)
+
+            # The server answers with the chunks that are still missing or corrupt, if any
+            send_frame(client_socket, {'type': 'commit', 'file_id': file_id, 'digest': whole}, serializer)
+            reply = recv_frame(client_socket)
+            if not reply:
+                raise ConnectionError(f"{name}: connection closed during commit")
+            if reply['type'] == 'committed':
+                return stats
+            indexes = reply['indexes']
+
+        raise ConnectionError(f"{name}: chunks still corrupt after {MAX_ROUNDS} attempts")
+
+def send_files_resumable(client_socket, files, reconnect, retries=5, streams=None, codec='none', serializer=None):
+    """Uploads files resumably, reconnecting and resuming after a dropped connection.
+
+    Args:
+        client_socket (socket): The client socket, already greeted by the server.
+        files (list): (file path, name) tuples.
+        reconnect (callable): Opens a new, greeted connection to the server.
+        retries (int): Number of reconnects allowed before giving up.
+        streams (int): Parallel streams per file. Picked from each file's size if not given.
+        codec (str): Compression codec agreed with the server.
+        serializer: Serializer agreed with the server; pickle by default.
+
+    Returns:
+        tuple: (the socket in use at the end, CompressionStats of everything sent)
+    """
+    stats = CompressionStats()
+    failures = 0
+    pending = list(files)
+    while pending:
+        file_path, name = pending[0]
+        try:
+            stats.add(send_file_resumable(client_socket, file_path, name, reconnect, streams, codec,
+                                          serializer))
+            pending.pop(0)
+        except OSError as e:
+            failures += 1
+            if failures > retries:
+                raise
+            print(f"Transfer interrupted ({e}); resuming, attempt {failures} of {retries}")
+            client_socket.close()
+            time.sleep(min(0.1 * 2 ** failures, 5.0))
+            client_socket = reconnect()
+    return client_socket, stats
+
+class PartialFile:
+    """
+    An upload in progress: a hidden partial file plus a record of its verified chunks.
+
+    The record starts with the chunk size and gains one "index digest" line
+    per chunk once that chunk is on disk, so a restarted upload knows what it
+    can skip without rereading the partial file. Chunks are synced and
+    recorded in batches of CHECKPOINT_CHUNKS, and when the upload is closed
+    or committed, so a crash loses at most one batch.
+
+    Args:
+        save_directory (str): The directory the file is saved in.
+        final_path (str): Where the finished file goes.
+        header (dict): The 'begin' frame.
+    """
+
+    def __init__(self, save_directory, final_path, header):
+        self.file_id = header['file_id']
+        self.path = os.path.join(save_directory, f".{self.file_id}.part")
+        self.record_path = self.path + ".chunks"
+        self.final_path = final_path
+        self.header = header
+        self.size = header['size']
+        self.mode = file_mode(header)
+        self.chunk_size = header['chunk_size']
+        self.expected = header['digests']
+        self.lock = threading.Lock()
+        self.users = 0
+        self.closing = False # Set by PartialRegistry.release while the last user closes the file
+        self.held = {}
+        self.unsynced = [] # Verified chunks not yet synced and recorded
+        self.stats = CompressionStats() # Wire and original bytes of the chunks received
+        self.body_seconds = 0.0 # Time spent receiving and writing chunks
+        self.open()
+
+    def open(self):
+        """
+        Opens the partial file, seeding it from an older copy of the file if there is one.
+        """
+        held = None
+        if os.path.exists(self.path):
+            held = self.load_record()
+        elif os.path.exists(self.final_path):
+            # Delta against the existing copy: its unchanged chunks need not be sent again
+            shutil.copyfile(self.final_path, self.path)
+
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if held is None:
+            held = self.hash_existing()
+        # Set the final size and reserve the blocks up front, so parallel streams can fill any range
+        os.ftruncate(self.fd, self.size)
+        if hasattr(os, 'posix_fallocate') and self.size:
+            try:
+                os.posix_fallocate(self.fd, 0, self.size)
+            except OSError:
+                pass # Not supported by this file system; the file stays sparse
+
+        # Keep only chunks that are still inside the file
+        self.held = {index: digest for index, digest in held.items() if index < len(self.expected)}
+        self.write_record()
+
+    def write_record(self):
+        """
+        Rewrites the record of verified chunks compactly.
+        """
+        with self.lock:
+            with open(self.record_path, 'w') as record:
+                record.write(f"chunk_size {self.chunk_size}\n")
+                record.writelines(f"{index} {digest}\n" for index, digest in sorted(self.held.items()))
+
+    def load_record(self):
+        """
+        Reads the record of verified chunks.
+
+        Returns:
+            dict: index -> hex digest, or None if the record is missing or uses another chunk size.
+        """
+        try:
+            with open(self.record_path, 'r') as record:
+                lines = record.read().splitlines()
+        except OSError:
+            return None
+        if not lines or lines[0] != f"chunk_size {self.chunk_size}":
+            return None
+
+        held = {}
+        for line in lines[1:]:
+            parts = line.split()
+            if len(parts) == 2: # Ignore a line torn by a crash
+                held[int(parts[0])] = parts[1]
+        return held
+
+    def hash_existing(self):
+        """
+        Hashes the chunks already present in the partial file.
+
+        Returns:
+            dict: index -> hex digest.
+        """
+        existing = os.fstat(self.fd).st_size
+        held = {}
+        with open(self.fd, 'rb', closefd=False) as file:
+            for index in range(min(len(self.expected), -(-existing // self.chunk_size))):
+                offset = index * self.chunk_size
+                remaining = min(self.chunk_size, existing - offset)
+                file.seek(offset)
+                digest = new_digest()
+                while remaining:
+                    data = file.read(min(HASH_CHUNK_SIZE, remaining))
+                    digest.update(data)
+                    remaining -= len(data)
+                held[index] = digest.hexdigest()
+        return held
+
+    def missing(self):
+        """
+        Lists the chunks that are not on disk with the expected content.
+
+        Returns:
+            list: Chunk indexes.
+        """
+        with self.lock:
+            return [index for index, digest in enumerate(self.expected)
+                    if self.held.get(index) != digest]
+
+    def receive_chunk(self, client_socket, index, length, buffer, codec='none'):
+        """
+        Writes one chunk at its offset and records it if its digest matches.
+
+        Args:
+            client_socket (socket): The client socket.
+            index (int): Chunk index.
+            length (int): Chunk length in bytes.
+            buffer (bytearray): Receive buffer.
+            codec (str): Compression codec of the chunk.
+
+        Returns:
+            bool: True if the chunk was verified.
+        """
+        offset = index * self.chunk_size
+        if not 0 <= index < len(self.expected) or length != min(self.chunk_size, self.size - offset):
+            raise ValueError(f"Chunk {index} of {length} bytes does not fit the file")
+
+        digest = new_digest()
+        stats = CompressionStats()
+        started = time.perf_counter()
+        if codec == 'none':
+            recv_body_at(client_socket, self.fd, offset, length, buffer, digest)
+            stats.raw_bytes = stats.wire_bytes = length
+        else:
+            position = offset
+            def write(data):
+                nonlocal position
+                view = memoryview(data)
+                while view:
+                    written = os.pwrite(self.fd, view, position)
+                    view = view[written:]
+                    position += written
+            recv_compressed(client_socket, write, length, codec, stats, digest)
+        with self.lock:
+            self.stats.add(stats)
+            self.body_seconds += time.perf_counter() - started
+
+        if digest.hexdigest() != self.expected[index]:
+            return False
+
+        with self.lock:
+            self.held[index] = self.expected[index]
+            self.unsynced.append(index)
+            due = len(self.unsynced) >= CHECKPOINT_CHUNKS
+        if due:
+            self.checkpoint()
+        return True
+
+    def checkpoint(self):
+        """
+        Syncs the chunks written so far and adds them to the record.
+
+        The data is made durable before it is recorded, so the record never
+        lists a chunk that a crash could lose.
+        """
+        with self.lock:
+            indexes, self.unsynced = self.unsynced, []
+        if not indexes:
+            return
+        os.fdatasync(self.fd)
+        with self.lock:
+            with open(self.record_path, 'a') as record:
+                record.writelines(f"{index} {self.expected[index]}\n" for index in indexes)
+
+    def verify(self, digest):
+        """
+        Checks the whole-file digest before the file is moved into place.
+
+        The check rereads the file once; the same pass rehashes every chunk,
+        so a chunk damaged on disk is found and requested again.
+
+        Args:
+            digest (str): The client's whole-file hex digest.
+
+        Returns:
+            list: Chunk indexes still missing; empty if the file is complete.
+        """
+        missing = self.missing()
+        if missing:
+            return missing
+
+        with self.lock:
+            self.unsynced = [] # Synced with the rest of the file just below
+        os.fsync(self.fd)
+        with open(self.fd, 'rb', closefd=False) as file:
+            on_disk, whole = chunk_digests(file, self.size, self.chunk_size)
+        if whole != digest:
+            with self.lock:
+                self.held = dict(enumerate(on_disk))
+            self.write_record()
+            missing = self.missing()
+            if not missing:
+                raise ValueError(f"{self.header['name']}: chunk digests do not add up to the file digest")
+            return missing
+        return []
+
+    def install(self):
+        """
+        Moves the verified file into place and removes its record.
+        """
+        os.close(self.fd)
+        self.fd = None
+
+        os.chmod(self.path, self.mode)
+        if 'mtime' in self.header:
+            os.utime(self.path, (self.header['mtime'], self.header['mtime']))
+        os.makedirs(os.path.dirname(self.final_path), exist_ok=True)
+        os.replace(self.path, self.final_path)
+        os.remove(self.record_path)
+
+    def close(self):
+        """
+        Closes the partial file, leaving it on disk so the upload can resume later.
+        """
+        if self.fd is not None:
+            self.checkpoint()
+            os.close(self.fd)
+            self.fd = None
+
+class PartialRegistry:
+    """
+    The uploads in progress on a server, shared by all of its connections.
+
+    An upload stays registered until its last user has closed it, and new
+    users of the same file wait for that, so two PartialFiles never write
+    the same partial file and chunk record.
+
+    Args:
+        save_directory (str): The directory files are saved in.
+    """
+
+    def __init__(self, save_directory):
+        self.save_directory = save_directory
+        self.partials = {}
+        self.lock = threading.Lock()
+        self.closed = threading.Condition(self.lock) # Notified when a closing upload is unregistered
+
+    def lookup(self, file_id):
+        """
+        Finds a registered upload, waiting for it to go if it is being closed. Called with the lock held.
+
+        Args:
+            file_id (str): The file ID.
+
+        Returns:
+            PartialFile: The upload, or None if there is none.
+        """
+        partial = self.partials.get(file_id)
+        while partial is not None and partial.closing:
+            self.closed.wait()
+            partial = self.partials.get(file_id)
+        return partial
+
+    def begin(self, header, final_path):
+        """
+        Starts or resumes an upload.
+
+        A client reconnecting after a failure may find its old upload still
+        registered by a connection the server has not noticed is dead; that
+        upload is reused if it describes the same content.
+
+        Args:
+            header (dict): The 'begin' frame.
+            final_path (str): Where the finished file goes.
+
+        Returns:
+            PartialFile: The upload, with one more user.
+
+        Raises:
+            ValueError: If the file ID is not the one derived from the name, or the
+                file is already being uploaded with other content.
+        """
+        # The ID names the partial file, so it must be one the server would pick itself
+        if header['file_id'] != file_id_for(header['name']):
+            raise ValueError(f"{header['name']}: file ID does not match the name")
+        with self.lock:
+            partial = self.lookup(header['file_id'])
+            if partial is None:
+                partial = PartialFile(self.save_directory, final_path, header)
+                self.partials[partial.file_id] = partial
+            elif (partial.size, partial.chunk_size, partial.expected) != \
+                    (header['size'], header['chunk_size'], header['digests']):
+                raise ValueError(f"{header['name']} is already being uploaded with other content")
+            partial.users += 1
+            return partial
+
+    def get(self, file_id):
+        """
+        Looks up an upload for another connection that sends its chunks.
+
+        Args:
+            file_id (str): The file ID.
+
+        Returns:
+            PartialFile: The upload, with one more user.
+        """
+        with self.lock:
+            partial = self.lookup(file_id)
+            if partial is None:
+                raise ValueError(f"No upload in progress for file ID {file_id}")
+            partial.users += 1
+            return partial
+
+    def release(self, partial):
+        """
+        Drops one user of an upload, closing it once nobody uses it.
+
+        Args:
+            partial (PartialFile): The upload.
+        """
+        with self.lock:
+            partial.users -= 1
+            if partial.users > 0:
+                return
+            partial.closing = True
+        # Syncing the last chunks can take a while; only users of this file wait for it
+        try:
+            partial.close()
+        finally:
+            with self.lock:
+                if self.partials.get(partial.file_id) is partial:
+                    del self.partials[partial.file_id]
+                self.closed.notify_all()
+
+    def commit(self, partial, digest):
+        """
+        Commits an upload and unregisters it once it is complete.
+
+        The file is verified without holding the registry lock, so other
+        uploads can begin and end meanwhile; the lock covers only the move
+        into place and the bookkeeping.
+
+        Args:
+            partial (PartialFile): The upload.
+            digest (str): The client's whole-file hex digest.
+
+        Returns:
+            list: Chunk indexes still missing; empty if the file was committed.
+        """
+        missing = partial.verify(digest)
+        if missing:
+            return missing
+        with self.lock:
+            if partial.fd is None:
+                raise ValueError(f"{partial.header['name']} was already committed")
+            partial.install()
+            if self.partials.get(partial.file_id) is partial:
+                del self.partials[partial.file_id]
+            return []
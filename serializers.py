@@ -0,0 +1,494 @@
+""" Pluggable serializers for the payloads of framed messages.
+
+Every frame payload says how it was encoded, so a receiver can decode any
+frame without knowing which serializer the sender picked:
+
+- A payload starting with byte 0x80 is a pickle; pickle has started every
+  stream with that opcode since protocol 2.
+- Any other payload starts with a tag byte. VALUE_TAG marks a generic,
+  self-describing encoding of None, bools, ints, floats, strings, bytes,
+  lists, tuples and dicts. The tags of SCHEMAS mark fixed message types,
+  encoded with one struct for their fixed-size fields followed by their
+  strings.
+
+Unpickling data from the network can run arbitrary code, so a serializer
+created with allow_pickle=False refuses pickled payloads, and never
+produces them. The schema format only ever builds the types listed above.
+
+The serializer is negotiated per connection: each side lists the
+serializers it accepts, and senders use negotiate_serializer to pick the
+best one the other side accepts.
+"""
+
+import pickle
+import struct
+
+PICKLE_OPCODE = 0x80 # First byte of every pickle since protocol 2
+VALUE_TAG = 0x01 # Payload is one generically encoded value
+TEXT_TAG = 0x02 # Payload is a str, encoded as UTF-8 without a length
+
+LENGTH = struct.Struct("!I")
+SHORT_LENGTH = struct.Struct("!B")
+INT = struct.Struct("!q")
+SMALL_INT = struct.Struct("!b")
+FLOAT = struct.Struct("!d")
+NONE_LENGTH = 0xFFFFFFFF # Length of an optional string that is None
+
+# Type bytes of the generic value encoding. Strings, bytes and containers
+# shorter than 256 take a one byte length, the rest a four byte one.
+V_NONE, V_TRUE, V_FALSE, V_SMALL_INT, V_INT, V_BIGINT, V_FLOAT = b"NTFbiId"
+V_STR, V_BYTES, V_LIST, V_TUPLE, V_DICT = b"sylt{" # Short forms
+V_LONG_STR, V_LONG_BYTES, V_LONG_LIST, V_LONG_TUPLE, V_LONG_DICT = b"SYLU}"
+V_PICKLE = ord('p')
+LONG_FORMS = {V_STR: V_LONG_STR, V_BYTES: V_LONG_BYTES, V_LIST: V_LONG_LIST, V_TUPLE: V_LONG_TUPLE,
+              V_DICT: V_LONG_DICT}
+SHORT_FORMS = {long: short for short, long in LONG_FORMS.items()}
+
+FIELD_TYPES = {'q': int, 'Q': int, 'I': int, 'H': int, 'B': int, 'd': float, '?': bool}
+
+class Schema:
+    """
+    The wire layout of one fixed message type: a dict with a 'type' key
+    (or, for type None, just the listed keys) and a fixed set of fields.
+
+    Fixed-size fields are packed with one struct, together with the length
+    of each variable field; the variable fields follow, in order.
+
+    These messages are encoded and decoded once per frame, so each schema
+    compiles its own encode and decode functions when it is created, the
+    way collections.namedtuple builds its classes: every field is looked
+    up, checked and converted by a line of its own, with one struct call
+    and no loops, instead of by generic code that walks the field list.
+
+    Args:
+        tag (int): Tag byte of the type, from 0x10 to 0x7F.
+        message_type (str): Value of the message's 'type' key, None for messages without one.
+        fields (list): (name, kind) pairs. A kind is a struct format character
+            ('q', 'Q', 'I', 'H', 'B', 'd' or '?'), 'str', 'str?' (a string or None),
+            'bytes', or 'value' (anything the generic encoding takes).
+    """
+
+    def __init__(self, tag, message_type, fields):
+        self.tag = tag
+        self.message_type = message_type
+        self.fixed = [(name, kind) for name, kind in fields if kind in FIELD_TYPES]
+        self.variable = [(name, kind) for name, kind in fields if kind not in FIELD_TYPES]
+        self.header = struct.Struct("!B" + ''.join(kind for _, kind in self.fixed) + "I" * len(self.variable))
+        self.encode, self.decode = self.compile()
+
+    def compile(self):
+        """
+        Builds the encode and decode functions of the schema.
+
+        encode(message, serializer) returns the payload, or None if the message
+        does not fit the schema: other keys, a field of another type, or an int
+        out of range for its field. decode(data, serializer) returns the message
+        and raises ValueError if the field lengths do not match the payload.
+        The serializer encodes and decodes 'value' fields.
+
+        Returns:
+            tuple: (encode function, decode function).
+        """
+        fixed = [f"f{index}" for index in range(len(self.fixed))]
+        variable = [f"v{index}" for index in range(len(self.variable))]
+        lengths = [f"n{index}" for index in range(len(self.variable))]
+        fields = list(zip(fixed, self.fixed)) + list(zip(variable, self.variable))
+
+        encode = [
+            "def encode(message, serializer):",
+            f"    if len(message) != {len(fields) + (self.message_type is not None)}:",
+            "        return None",
+            "    try:",
+            *[f"        {local} = message[{name!r}]" for local, (name, _) in fields],
+            "    except KeyError:",
+            "        return None",
+        ]
+        checks = [f"type({local}) is not {FIELD_TYPES[kind].__name__}" for local, (_, kind) in zip(fixed, self.fixed)]
+        checks += [f"type({local}) is not {'bytes' if kind == 'bytes' else 'str'}"
+                   for local, (_, kind) in zip(variable, self.variable) if kind in ('str', 'bytes')]
+        if checks:
+            encode += [f"    if {' or '.join(checks)}:", "        return None"]
+        for local, length, (_, kind) in zip(variable, lengths, self.variable):
+            if kind == 'str?':
+                encode += [f"    if {local} is None:",
+                           f"        {local}, {length} = b'', NONE_LENGTH",
+                           f"    elif type({local}) is str:",
+                           f"        {local} = {local}.encode()",
+                           f"        {length} = len({local})",
+                           "    else:",
+                           "        return None"]
+                continue
+            if kind == 'str':
+                encode.append(f"    {local} = {local}.encode()")
+            elif kind == 'value':
+                encode.append(f"    {local} = serializer.encode_value({local})")
+            encode.append(f"    {length} = len({local})")
+        encode += [
+            "    try:",
+            f"        return b''.join(({', '.join([f'pack({self.tag}, ' + ', '.join(fixed + lengths) + ')'] + variable)},))",
+            "    except struct.error: # An int out of range for its field",
+            "        return None",
+        ]
+
+        decode = [
+            "def decode(data, serializer):",
+            f"    {', '.join(['_'] + fixed + lengths)}, = unpack_from(data)",
+            "    if type(data) is not bytes:",
+            "        data = bytes(data) # Slicing bytes and decoding the slices beats decoding memoryview slices",
+            f"    offset = {self.header.size}",
+        ]
+        for local, length, (_, kind) in zip(variable, lengths, self.variable):
+            read = f"data[offset:offset + {length}]"
+            if kind in ('str', 'str?'):
+                read = f"{read}.decode()"
+            elif kind == 'value':
+                read = f"serializer.decode_value({read})"
+            if kind == 'str?':
+                decode += [f"    if {length} == NONE_LENGTH:",
+                           f"        {local} = None",
+                           "    else:",
+                           f"        {local} = {read}",
+                           f"        offset += {length}"]
+            else:
+                decode += [f"    {local} = {read}", f"    offset += {length}"]
+        items = [f"{name!r}: {local}" for local, (name, _) in fields]
+        if self.message_type is not None:
+            items.insert(0, f"'type': {self.message_type!r}")
+        decode += [
+            "    if offset != len(data):",
+            f"        raise ValueError({f'Field lengths do not match the size of the {self.tag:#x} payload'!r})",
+            f"    return {{{', '.join(items)}}}",
+        ]
+
+        namespace = {'pack': self.header.pack, 'unpack_from': self.header.unpack_from, 'struct': struct,
+                     'NONE_LENGTH': NONE_LENGTH}
+        self.source = '\n'.join(encode + [''] + decode)
+        exec(self.source, namespace)
+        return namespace['encode'], namespace['decode']
+
+# The message types of Q1, Q2 and Q3 that are common enough to deserve a fixed layout
+SCHEMAS = [
+    # Q1: file header and its acknowledgement, and a chunk of a resumable upload
+    Schema(0x10, 'file', [('size', 'Q'), ('mtime', 'd'), ('mode', 'H'), ('name', 'str'), ('codec', 'str')]),
+    Schema(0x11, 'ack', [('size', 'Q'), ('name', 'str'), ('status', 'str')]),
+    Schema(0x12, 'chunk', [('index', 'I'), ('size', 'Q'), ('file_id', 'str'), ('codec', 'str')]),
+    # Q2: a task request, and a batch of (task ID, succeeded, result or failure) outcomes
+    Schema(0x20, None, [('id', 'q'), ('executor', 'str?'), ('task', 'value')]),
+    Schema(0x21, 'results', [('results', 'value')]),
+    # Q3: chat messages
+    Schema(0x30, 'message', [('time', 'd'), ('room', 'str'), ('sender', 'str'), ('text', 'str')]),
+    Schema(0x31, 'direct', [('sender', 'str'), ('to', 'str'), ('text', 'str')]),
+    Schema(0x32, 'notice', [('room', 'str?'), ('text', 'str')]),
+]
+SCHEMAS_BY_TAG = {schema.tag: schema for schema in SCHEMAS}
+SCHEMAS_BY_TYPE = {schema.message_type: schema for schema in SCHEMAS}
+
+class PickleSerializer:
+    """
+    Encodes everything with pickle. Decodes pickles and schema payloads alike.
+    """
+
+    name = 'pickle'
+    allow_pickle = True
+
+    def encode(self, obj):
+        """
+        Args:
+            obj: The object.
+
+        Returns:
+            bytes: The payload.
+        """
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        """
+        Args:
+            data (bytes or memoryview): The payload.
+
+        Returns:
+            The object.
+        """
+        if data and data[0] == PICKLE_OPCODE:
+            return pickle.loads(data)
+        return PERMISSIVE.decode(data)
+
+class SchemaSerializer:
+    """
+    Encodes the message types of SCHEMAS with their fixed layout. Anything
+    else, including their 'value' fields, is pickled when pickle is allowed:
+    the other side accepts it then, and C pickle is faster than any encoding
+    written in Python. Without pickle it gets the generic value encoding.
+
+    Args:
+        allow_pickle (bool): Pickle what has no fixed layout and accept pickled payloads.
+            Without it functions, class instances and other objects the generic encoding
+            cannot represent raise TypeError on encoding, and pickled payloads ValueError
+            on decoding.
+    """
+
+    name = 'schema'
+
+    def __init__(self, allow_pickle=True):
+        self.allow_pickle = allow_pickle
+
+    def encode(self, obj):
+        """
+        Args:
+            obj: The object.
+
+        Returns:
+            bytes: The payload.
+
+        Raises:
+            TypeError: If the object holds something only pickle can encode and pickle is not allowed.
+        """
+        if type(obj) is dict:
+            schema = SCHEMAS_BY_TYPE.get(obj.get('type'))
+            if schema is not None:
+                payload = schema.encode(obj, self)
+                if payload is not None:
+                    return payload
+        elif type(obj) is str:
+            return bytes((TEXT_TAG,)) + obj.encode()
+        if self.allow_pickle:
+            return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        return bytes((VALUE_TAG,)) + self.encode_value(obj)
+
+    def decode(self, data):
+        """
+        Args:
+            data (bytes or memoryview): The payload.
+
+        Returns:
+            The object.
+
+        Raises:
+            ValueError: If the payload is malformed, or pickled and pickle is not allowed.
+        """
+        if not data:
+            raise ValueError("Empty payload")
+        tag = data[0]
+        if tag == PICKLE_OPCODE:
+            if not self.allow_pickle:
+                raise ValueError("Pickled payloads are not accepted")
+            return pickle.loads(data)
+        try:
+            schema = SCHEMAS_BY_TAG.get(tag)
+            if schema is not None:
+                return schema.decode(data, self)
+            view = memoryview(data)
+            if tag == TEXT_TAG:
+                return str(view[1:], 'utf-8')
+            if tag == VALUE_TAG:
+                value, offset = self.read_value(view, 1)
+                if offset != len(view):
+                    raise ValueError("Trailing bytes after value")
+                return value
+            raise ValueError(f"Unknown payload tag {tag:#x}")
+        except (struct.error, IndexError, UnicodeDecodeError, TypeError, RecursionError) as e:
+            raise ValueError(f"Malformed payload: {e}") from e
+
+    def encode_value(self, value):
+        """
+        Encodes one value with the generic encoding, as a single embedded pickle if pickle is allowed.
+
+        Args:
+            value: The value.
+
+        Returns:
+            bytes: The encoding.
+        """
+        if self.allow_pickle:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            return b'p' + LENGTH.pack(len(data)) + data
+        parts = []
+        self.write_value(value, parts)
+        return b''.join(parts)
+
+    def write_value(self, value, parts):
+        """
+        Appends the generic encoding of a value to a list of byte strings.
+
+        Args:
+            value: The value.
+            parts (list): The encoding so far.
+        """
+        kind = type(value)
+        if value is None:
+            parts.append(b'N')
+        elif kind is bool:
+            parts.append(b'T' if value else b'F')
+        elif kind is int:
+            if -128 <= value < 128:
+                parts.append(b'b' + SMALL_INT.pack(value))
+            elif -2 ** 63 <= value < 2 ** 63:
+                parts.append(b'i' + INT.pack(value))
+            else:
+                data = value.to_bytes((value.bit_length() + 8) // 8, 'big', signed=True)
+                parts.append(b'I' + LENGTH.pack(len(data)) + data)
+        elif kind is float:
+            parts.append(b'd' + FLOAT.pack(value))
+        elif kind is str:
+            data = value.encode()
+            parts.append(self.sized(V_STR, len(data)) + data)
+        elif kind is bytes:
+            parts.append(self.sized(V_BYTES, len(value)) + value)
+        elif kind is list or kind is tuple:
+            parts.append(self.sized(V_LIST if kind is list else V_TUPLE, len(value)))
+            for item in value:
+                self.write_value(item, parts)
+        elif kind is dict:
+            parts.append(self.sized(V_DICT, len(value)))
+            for key, item in value.items():
+                self.write_value(key, parts)
+                self.write_value(item, parts)
+        else:
+            raise TypeError(f"{kind.__name__} objects cannot be encoded without pickle")
+
+    @staticmethod
+    def sized(kind, length):
+        """
+        Encodes the type byte and length of a string, bytes or container value.
+
+        Args:
+            kind (int): Type byte of the short form.
+            length (int): Bytes or items in the value.
+
+        Returns:
+            bytes: The type byte and the length, in one byte if it fits.
+        """
+        if length < 256:
+            return bytes((kind, length))
+        return bytes((LONG_FORMS[kind],)) + LENGTH.pack(length)
+
+    def decode_value(self, data):
+        """
+        Decodes a value that fills data.
+
+        Args:
+            data (memoryview): The encoding.
+
+        Returns:
+            The value.
+        """
+        value, offset = self.read_value(data, 0)
+        if offset != len(data):
+            raise ValueError("Trailing bytes after value")
+        return value
+
+    def read_value(self, data, offset):
+        """
+        Decodes one value of the generic encoding.
+
+        Args:
+            data (memoryview): The encoding.
+            offset (int): Where the value starts.
+
+        Returns:
+            tuple: (value, offset just past it).
+        """
+        kind = data[offset]
+        offset += 1
+        if kind == V_NONE:
+            return None, offset
+        if kind == V_TRUE:
+            return True, offset
+        if kind == V_FALSE:
+            return False, offset
+        if kind == V_SMALL_INT:
+            return SMALL_INT.unpack_from(data, offset)[0], offset + SMALL_INT.size
+        if kind == V_INT:
+            return INT.unpack_from(data, offset)[0], offset + INT.size
+        if kind == V_FLOAT:
+            return FLOAT.unpack_from(data, offset)[0], offset + FLOAT.size
+
+        if kind in LONG_FORMS: # Short form, one byte length
+            count = data[offset]
+            offset += 1
+        elif kind in SHORT_FORMS: # Long form, four byte length; handled like the short one from here on
+            kind = SHORT_FORMS[kind]
+            count, = LENGTH.unpack_from(data, offset)
+            offset += LENGTH.size
+        else:
+            count, = LENGTH.unpack_from(data, offset) # Big ints and pickles always have a four byte length
+            offset += LENGTH.size
+
+        if kind in (V_LIST, V_TUPLE, V_DICT):
+            if count > len(data) - offset: # Every item takes at least one byte
+                raise ValueError("Container longer than its payload")
+            items = []
+            for _ in range(count * 2 if kind == V_DICT else count):
+                item, offset = self.read_value(data, offset)
+                items.append(item)
+            if kind == V_DICT:
+                return dict(zip(items[::2], items[1::2])), offset
+            return (items if kind == V_LIST else tuple(items)), offset
+
+        part = data[offset:offset + count]
+        if len(part) != count:
+            raise ValueError("Truncated value")
+        offset += count
+        if kind == V_STR:
+            return str(part, 'utf-8'), offset
+        if kind == V_BYTES:
+            return bytes(part), offset
+        if kind == V_BIGINT:
+            return int.from_bytes(part, 'big', signed=True), offset
+        if kind == V_PICKLE:
+            if not self.allow_pickle:
+                raise ValueError("Pickled values are not accepted")
+            return pickle.loads(part), offset
+        raise ValueError(f"Unknown value type {kind:#x}")
+
+PERMISSIVE = SchemaSerializer() # Decodes anything, pickles included
+STRICT = SchemaSerializer(allow_pickle=False) # Never runs pickle; for handshakes and untrusted peers
+
+# name -> serializer, in order of preference
+SERIALIZERS = {'schema': PERMISSIVE, 'pickle': PickleSerializer()}
+
+def available_serializers():
+    """ Lists the serializers this side supports.
+
+    Returns:
+        list: Serializer names in order of preference.
+    """
+    return list(SERIALIZERS)
+
+def get_serializer(name):
+    """ Looks up a serializer by name.
+
+    Args:
+        name (str): The name.
+
+    Returns:
+        The serializer.
+
+    Raises:
+        ValueError: If the name is unknown.
+    """
+    try:
+        return SERIALIZERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown serializer: {name!r}") from None
+
+def negotiate_serializer(accepted, preferred=None):
+    """ Picks the serializer to send with, given what the other side accepts.
+
+    Args:
+        accepted (list): Serializer names the other side accepts.
+        preferred (list): Names this side is willing to use, best first; all of them by default.
+
+    Returns:
+        The serializer; the schema serializer never pickles if the other side does not accept pickle.
+
+    Raises:
+        ValueError: If the two sides share no serializer.
+    """
+    for name in preferred if preferred is not None else available_serializers():
+        if name in accepted and name in SERIALIZERS:
+            if name == 'schema' and 'pickle' not in accepted:
+                return STRICT
+            return SERIALIZERS[name]
+    raise ValueError(f"No common serializer: this side uses {preferred or available_serializers()}, "
+                     f"the other accepts {accepted}")
@@ -0,0 +1,159 @@
+""" Same-host transport of large buffers through memory-mapped files.
+
+Objects are pickled with protocol 5. Buffers of at least SHARE_THRESHOLD
+bytes (NumPy arrays, bytearrays and large bytes objects) are written to a
+file in shared memory (/dev/shm where it exists) instead of into the pickle,
+and only a small SharedPayload descriptor goes over the socket. The receiver
+maps the file and rebuilds the object on top of the mapping, so NumPy arrays
+are not copied at all on that side.
+
+Files are used rather than multiprocessing.shared_memory segments because
+their lifetime is explicit: the owner unlinks the file and the memory is
+freed once the last mapping is gone, with no resource tracker involved.
+"""
+
+import mmap
+import os
+import pickle
+import socket
+import tempfile
+
+SHARE_THRESHOLD = 1024 * 1024 # Buffers smaller than this stay in the pickle (1 MiB)
+SHM_DIRECTORY = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+FILE_PREFIX = "q2-" # Prefix of the files, so leftovers of crashed processes are easy to find
+ALIGNMENT = 64 # Buffers start on cache line boundaries, which NumPy prefers
+
+def host_id():
+    """ Identifies this host and its shared memory directory.
+
+    Two processes can exchange SharedPayloads only if their host_id is equal.
+
+    Returns:
+        str: The identifier.
+    """
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as file:
+            boot_id = file.read().strip()
+    except OSError:
+        boot_id = ""
+    info = os.stat(SHM_DIRECTORY)
+    return f"{socket.gethostname()}/{boot_id}/{info.st_dev}/{info.st_ino}"
+
+def worth_sharing(values):
+    """ Checks cheaply whether any value is a buffer large enough to share.
+
+    Only the values themselves are inspected, not their contents, so the
+    check costs next to nothing for the usual small tasks.
+
+    Args:
+        values (iterable): Task arguments or results.
+
+    Returns:
+        bool: True if at least one value exposes a buffer of SHARE_THRESHOLD bytes or more.
+    """
+    for value in values:
+        try:
+            if memoryview(value).nbytes >= SHARE_THRESHOLD:
+                return True
+        except TypeError:
+            pass
+    return False
+
+class _OutOfBand:
+    """
+    Wraps a large bytes or bytearray object so that it is pickled out of
+    band; pickle otherwise always writes those in band.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __reduce_ex__(self, protocol):
+        return type(self.value), (pickle.PickleBuffer(self.value),)
+
+class SharedPayload:
+    """
+    Descriptor of an object pickled with its large buffers in a shared memory file.
+    """
+
+    def __init__(self, path, data, layout):
+        """
+        Args:
+            path (str): The shared memory file.
+            data (bytes): The pickle, without the large buffers.
+            layout (list): (offset, length) of each buffer in the file.
+        """
+        self.path = path
+        self.data = data
+        self.layout = layout
+
+    def load(self):
+        """
+        Rebuilds the object on top of a private, copy-on-write mapping of the file.
+
+        The mapping stays alive as long as the object uses it, even after
+        the file is unlinked.
+
+        Returns:
+            The object.
+        """
+        with open(self.path, 'rb') as file:
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+        view = memoryview(mapping)
+        return pickle.loads(self.data, buffers=[view[offset:offset + length] for offset, length in self.layout])
+
+    def unlink(self):
+        """
+        Removes the file. Safe to call more than once.
+        """
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+def share(obj):
+    """ Pickles an object with its large buffers in a new shared memory file.
+
+    Args:
+        obj: The object.
+
+    Returns:
+        SharedPayload: The descriptor, or None if the object has no buffer
+        large enough to be worth it.
+    """
+    def wrap(value):
+        if type(value) in (bytes, bytearray) and len(value) >= SHARE_THRESHOLD:
+            return _OutOfBand(value)
+        return value
+    # Like worth_sharing, only look at the object itself or the items of an argument tuple
+    obj = tuple(wrap(value) for value in obj) if type(obj) is tuple else wrap(obj)
+
+    buffers = []
+    def out_of_band(buffer):
+        if buffer.raw().nbytes < SHARE_THRESHOLD:
+            return True # Keep it in the pickle
+        buffers.append(buffer)
+        return False
+
+    data = pickle.dumps(obj, protocol=5, buffer_callback=out_of_band)
+    if not buffers:
+        return None
+
+    fd, path = tempfile.mkstemp(prefix=FILE_PREFIX, dir=SHM_DIRECTORY)
+    try:
+        layout = []
+        offset = 0
+        for buffer in buffers:
+            view = buffer.raw()
+            offset += -offset % ALIGNMENT
+            layout.append((offset, view.nbytes))
+            written = 0
+            while written < view.nbytes:
+                written += os.pwrite(fd, view[written:], offset + written)
+            offset += view.nbytes
+    except BaseException:
+        os.unlink(path)
+        raise
+    finally:
+        os.close(fd)
+    return SharedPayload(path, data, layout)
@@ -0,0 +1,156 @@
+""" Makes the modules at the root of the repository importable from the tests,
+and provides the servers that tests talk to over loopback. """
+
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def free_port():
+    """ Asks the OS for a free loopback port.
+
+    Returns:
+        int: The port number.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=5.0):
+    """ Waits until something listens on a loopback port.
+
+    Args:
+        port (int): The port.
+        timeout (float): Seconds to wait.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.02)
+
+def start_worker_node(**options):
+    """ Starts a Q2 worker node on its own thread.
+
+    Args:
+        **options: Keyword arguments for WorkerNode.
+
+    Returns:
+        tuple: (the WorkerNode, its port)
+    """
+    import Q2
+    options.setdefault('processes', 1)
+    options.setdefault('threads', 4)
+    options.setdefault('default_executor', 'thread')
+    port = free_port()
+    worker = Q2.WorkerNode('127.0.0.1', port, Q2.TaskQueue(), **options)
+    threading.Thread(target=worker.start, daemon=True).start()
+    wait_for_port(port)
+    return worker, port
+
+@pytest.fixture(scope='module')
+def worker_port():
+    """ Port of a Q2 worker node shared by the tests of a module. """
+    return start_worker_node()[1]
+
+@pytest.fixture
+def q1_server(tmp_path):
+    """ Runs a Q1 server on its own thread for one test.
+
+    Yields:
+        tuple: (a function that opens a greeted connection and returns (socket, serializer),
+        the server's save directory)
+    """
+    import Q1
+    from serializers import negotiate_serializer
+    save_directory = tmp_path / 'saved'
+    save_directory.mkdir()
+    port = free_port()
+    stop = threading.Event()
+    server = threading.Thread(target=Q1.run_server, args=('127.0.0.1', port),
+                              kwargs={'save_directory': str(save_directory), 'stop_event': stop})
+    server.start()
+    wait_for_port(port)
+
+    def connect():
+        sock = socket.create_connection(('127.0.0.1', port))
+        greeting = Q1.wait_until_ready(sock)
+        return sock, negotiate_serializer(greeting.get('serializers', ['pickle']))
+    try:
+        yield connect, save_directory
+    finally:
+        stop.set()
+        server.join()
+
+async def start_chat_server(**options):
+    """ Starts a Q3 AsyncChatServer on the running event loop.
+
+    Args:
+        **options: Keyword arguments for AsyncChatServer.
+
+    Returns:
+        tuple: (the server, the task serving it, which the caller cancels; its port)
+    """
+    import Q3
+    sock = socket.create_server(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    server = Q3.AsyncChatServer('127.0.0.1', port, sock=sock, **options)
+    return server, asyncio.create_task(server.serve()), port
+
+class ChatSession:
+    """
+    A Q3 AsyncChatClient whose received messages tests can wait for.
+    """
+
+    def __init__(self, port, username, **options):
+        import Q3
+        self.client = Q3.AsyncChatClient('127.0.0.1', port, username, **options)
+        self.received = asyncio.Queue()
+        self.receiver = None
+
+    async def connect(self):
+        await self.client.connect()
+        self.receiver = asyncio.create_task(self.client.receive_messages(self.received.put_nowait))
+        return self
+
+    async def say(self, text):
+        await self.client.send_message(text)
+
+    async def expect(self, predicate, timeout=5.0):
+        """ Waits for a message matching predicate, skipping the others.
+
+        Returns:
+            dict: The message.
+        """
+        async def find():
+            while True:
+                message = await self.received.get()
+                if predicate(message):
+                    return message
+        return await asyncio.wait_for(find(), timeout)
+
+    async def expect_text(self, text, timeout=5.0):
+        """ Waits for a room message, direct message or notice with the given text. """
+        return await self.expect(lambda message: message.get('text') == text, timeout)
+
+    async def silent(self, predicate, wait=0.2):
+        """ Checks that no message matching predicate arrives within wait seconds. """
+        try:
+            await self.expect(predicate, wait)
+        except asyncio.TimeoutError:
+            return True
+        return False
+
+    async def close(self):
+        await self.client.close()
+        await self.receiver
@@ -0,0 +1,76 @@
+""" Tests for the negotiated, block-wise compression of file bodies. """
+
+import hashlib
+import io
+import os
+import socket
+import threading
+
+import pytest
+
+import compression
+import resumable
+from compression import CompressionStats, negotiate, recv_compressed, send_compressed
+from framing import CHUNK_SIZE
+
+def transfer(data, codec, tmp_path):
+    """ Sends data compressed over a socket pair and receives it again.
+
+    Returns:
+        tuple: (the received bytes, the sender's CompressionStats, the receiver's CompressionStats)
+    """
+    source = tmp_path / 'body.bin'
+    source.write_bytes(data)
+    sent, received = CompressionStats(), CompressionStats()
+    output = io.BytesIO()
+    left, right = socket.socketpair()
+    with left, right, open(source, 'rb') as file:
+        sender = threading.Thread(target=send_compressed, args=(left, file, 0, len(data), codec, sent))
+        sender.start()
+        digest = hashlib.sha256()
+        recv_compressed(right, output.write, len(data), codec, received, digest)
+        sender.join()
+    assert digest.hexdigest() == hashlib.sha256(data).hexdigest()
+    return output.getvalue(), sent, received
+
+@pytest.mark.parametrize('codec', list(compression.CODECS))
+def test_bodies_round_trip_with_every_codec(codec, tmp_path):
+    data = b'a fairly repetitive line of text\n' * 20000
+    received, sent, stats = transfer(data, codec, tmp_path)
+    assert received == data
+    assert sent.raw_bytes == stats.raw_bytes == len(data)
+    assert sent.wire_bytes == stats.wire_bytes < len(data) // 10
+
+def test_incompressible_data_is_sent_raw_after_the_probe(tmp_path):
+    data = os.urandom(CHUNK_SIZE * (compression.PROBE_BLOCKS + 3))
+    received, sent, _ = transfer(data, 'zlib', tmp_path)
+    assert received == data
+    assert sent.probe_blocks == compression.PROBE_BLOCKS
+    # Every block went raw, with only its small header added
+    assert sent.wire_bytes == len(data) + (compression.PROBE_BLOCKS + 3) * compression.BLOCK_HEADER.size
+
+def test_a_block_that_expands_beyond_its_size_is_refused():
+    left, right = socket.socketpair()
+    with left, right:
+        payload = compression.CODECS['zlib'][0](b'\0' * 1000)
+        left.sendall(compression.BLOCK_HEADER.pack(compression.COMPRESSED, len(payload)) + payload)
+        with pytest.raises(ValueError):
+            recv_compressed(right, lambda data: None, 100, 'zlib', CompressionStats())
+
+def test_negotiation_falls_back_to_no_compression():
+    assert negotiate('auto', ['zlib', 'none']) == 'zlib'
+    assert negotiate('auto', ['brotli', 'none']) == 'none'
+    assert negotiate('brotli', ['brotli', 'none']) == 'none'
+    assert negotiate('zlib', ['none']) == 'none'
+
+def test_a_resumable_upload_is_compressed_on_the_wire(q1_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(resumable, 'MIN_CHUNK_SIZE', 64 * 1024)
+    connect, saved = q1_server
+    data = b'the same log line, over and over again\n' * 30000
+    (tmp_path / 'app.log').write_bytes(data)
+    sock, serializer = connect()
+    with sock:
+        stats = resumable.send_file_resumable(sock, str(tmp_path / 'app.log'), codec='zlib', serializer=serializer)
+    assert stats.raw_bytes == len(data)
+    assert stats.wire_bytes < len(data) // 10
+    assert (saved / 'app.log').read_bytes() == data
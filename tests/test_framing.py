@@ -0,0 +1,83 @@
+""" Tests for the length-prefixed frames and the raw bodies that follow them. """
+
+import hashlib
+import io
+import socket
+import threading
+
+import pytest
+
+from framing import FRAME_HEADER, MAX_FRAME_SIZE, FrameDecoder, encode_frame, recv_body, recv_frame, send_body, send_frame
+
+MESSAGES = [
+    {'type': 'file', 'name': 'logs/part-0001.log', 'size': 1048576, 'mtime': 1704067200.5, 'mode': 0o644},
+    {'type': 'ack', 'name': 'logs/part-0001.log', 'size': 1048576, 'status': 'ok'},
+    "plain text",
+]
+
+def test_frames_round_trip_over_a_socket():
+    left, right = socket.socketpair()
+    with left, right:
+        for message in MESSAGES:
+            send_frame(left, message)
+        left.shutdown(socket.SHUT_WR)
+        assert [recv_frame(right) for _ in MESSAGES] == MESSAGES
+        assert recv_frame(right) is None
+
+def test_a_frame_cut_short_is_an_error():
+    left, right = socket.socketpair()
+    with left, right:
+        left.sendall(FRAME_HEADER.pack(100) + b'x' * 10)
+        left.shutdown(socket.SHUT_WR)
+        with pytest.raises(ConnectionError):
+            recv_frame(right)
+
+def test_oversized_frames_are_refused_before_their_payload_is_read():
+    left, right = socket.socketpair()
+    with left, right:
+        left.sendall(FRAME_HEADER.pack(MAX_FRAME_SIZE + 1))
+        with pytest.raises(ValueError):
+            recv_frame(right)
+
+def test_bodies_stream_after_their_header(tmp_path):
+    data = bytes(range(256)) * 20000 # Several streaming chunks
+    source = tmp_path / 'body.bin'
+    source.write_bytes(data)
+    left, right = socket.socketpair()
+    with left, right, open(source, 'rb') as file:
+        def send():
+            send_frame(left, {'type': 'file', 'size': len(data)})
+            send_body(left, file, len(data))
+            send_frame(left, "next")
+        sender = threading.Thread(target=send)
+        sender.start()
+        header = recv_frame(right)
+        received = io.BytesIO()
+        digest = hashlib.sha256()
+        recv_body(right, received, header['size'], digest=digest)
+        assert recv_frame(right) == "next"
+        sender.join()
+    assert received.getvalue() == data
+    assert digest.hexdigest() == hashlib.sha256(data).hexdigest()
+
+def test_decoder_reassembles_frames_split_at_any_byte():
+    stream = b''.join(encode_frame(message) for message in MESSAGES)
+    decoder = FrameDecoder()
+    decoded = []
+    for index in range(len(stream)):
+        decoded += decoder.feed(stream[index:index + 1])
+    assert decoded == MESSAGES
+    assert not decoder.buffer
+
+def test_decoder_returns_every_frame_of_one_read():
+    assert FrameDecoder().feed(b''.join(encode_frame(message) for message in MESSAGES)) == MESSAGES
+
+def test_decoder_keeps_a_partial_frame_for_the_next_read():
+    first, second = encode_frame("first"), encode_frame("second")
+    decoder = FrameDecoder()
+    assert decoder.feed(first + second[:3]) == ["first"]
+    assert decoder.feed(second[3:]) == ["second"]
+
+def test_decoder_rejects_oversized_frames():
+    with pytest.raises(ValueError):
+        FrameDecoder(max_frame_size=16).feed(FRAME_HEADER.pack(17) + b'x' * 17)
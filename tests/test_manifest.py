@@ -0,0 +1,84 @@
+""" Tests for the persisted file index used by Q1's sync. """
+
+import os
+
+import pytest
+
+from manifest import MANIFEST_NAME, Manifest, file_digest
+from resumable import file_id_for
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(data)
+
+def test_changed_lists_missing_and_different_files(tmp_path):
+    write(tmp_path / 'same.txt', b'same')
+    write(tmp_path / 'dir' / 'old.txt', b'old')
+    manifest = Manifest(str(tmp_path))
+    manifest.scan()
+
+    write(tmp_path / 'other' / 'same.txt', b'same')
+    write(tmp_path / 'other' / 'old.txt', b'new')
+    theirs = {'same.txt': file_digest(tmp_path / 'other' / 'same.txt'),
+              'dir/old.txt': file_digest(tmp_path / 'other' / 'old.txt'),
+              'dir/added.txt': file_digest(tmp_path / 'other' / 'same.txt')}
+    assert sorted(manifest.changed(theirs)) == ['dir/added.txt', 'dir/old.txt']
+
+def test_changed_is_empty_for_an_identical_tree(tmp_path):
+    write(tmp_path / 'a' / 'b.txt', b'content')
+    manifest = Manifest(str(tmp_path))
+    entries = manifest.scan()
+    assert manifest.changed({name: entry['digest'] for name, entry in entries.items()}) == []
+
+def test_saved_manifest_is_reloaded_and_never_indexed(tmp_path):
+    write(tmp_path / 'a.txt', b'a')
+    write(tmp_path / 'sub' / MANIFEST_NAME, b'{}')
+    manifest = Manifest(str(tmp_path))
+    manifest.scan()
+    manifest.save()
+
+    reloaded = Manifest(str(tmp_path))
+    assert sorted(reloaded.entries) == ['a.txt']
+    assert sorted(reloaded.scan()) == ['a.txt']
+
+def test_only_the_servers_own_names_are_reserved():
+    import Q1
+    partial = '.' + file_id_for('big.bin') + '.part'
+    for name in ('.q1manifest.json', 'sub/.q1manifest.json.tmp', partial, partial + '.chunks'):
+        with pytest.raises(ValueError):
+            Q1.resolve_path('/save', name)
+    for name in ('.notes.part', 'sub/.notes.part', 'sub/' + partial, 'sub/.notes.part.chunks'):
+        assert Q1.resolve_path('/save', name) == os.path.join('/save', *name.split('/'))
+
+def test_scan_skips_partial_uploads_only_at_the_root(tmp_path):
+    import Q1
+    partial = '.' + file_id_for('big.bin') + '.part'
+    for name in (partial, partial + '.chunks', '.notes.part', 'sub/' + partial, 'sub/.notes.part'):
+        write(tmp_path / name, b'x')
+    assert sorted(Manifest(str(tmp_path), Q1.is_partial).scan()) == \
+        ['.notes.part', 'sub/' + partial, 'sub/.notes.part']
+    assert sorted(name for _, name in Q1.collect_files([str(tmp_path)])) == \
+        ['.notes.part', 'sub/' + partial, 'sub/.notes.part']
+
+def test_sync_sends_only_new_and_changed_files(q1_server, tmp_path):
+    import Q1
+    connect, saved = q1_server
+    source = tmp_path / 'source'
+    write(source / 'same.txt', b'same')
+    write(source / 'sub' / 'changed.txt', b'before')
+
+    sock, serializer = connect()
+    with sock:
+        first = Q1.plan_sync(sock, [str(source)], serializer)
+        Q1.send_files(sock, first, serializer=serializer)
+    assert sorted(name for _, name in first) == ['same.txt', 'sub/changed.txt']
+
+    write(source / 'sub' / 'changed.txt', b'after!')
+    write(source / 'added.txt', b'added')
+    sock, serializer = connect()
+    with sock:
+        second = Q1.plan_sync(sock, [str(source)], serializer)
+        Q1.send_files(sock, second, serializer=serializer)
+    assert sorted(name for _, name in second) == ['added.txt', 'sub/changed.txt']
+    assert (saved / 'sub' / 'changed.txt').read_bytes() == b'after!'
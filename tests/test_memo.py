@@ -0,0 +1,112 @@
+""" Tests for the result caches of pure Q2 tasks. """
+
+import collections
+import threading
+import time
+
+import pytest
+
+import Q2
+from conftest import start_worker_node
+from memo import ResultCache, task_key
+
+calls = collections.Counter() # Function name -> times it ran
+
+@Q2.pure
+def slow_square(value):
+    calls['slow_square'] += 1
+    time.sleep(0.1)
+    return value * value
+
+@Q2.pure(ttl=0.05)
+def fleeting(value):
+    calls['fleeting'] += 1
+    return value
+
+@Q2.pure
+def fail_once(value):
+    calls['fail_once'] += 1
+    if calls['fail_once'] == 1:
+        raise ValueError("first call fails")
+    return value
+
+def square(value):
+    calls['square'] += 1
+    return value * value
+
+@pytest.fixture(autouse=True)
+def count_calls():
+    """ Restarts the count of task calls for each test. """
+    calls.clear()
+
+def test_least_recently_used_results_are_evicted():
+    cache = ResultCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == (True, 1)
+    cache.put('c', 3)
+    assert cache.get('b') == (False, None)
+    assert cache.get('a') == (True, 1) and cache.get('c') == (True, 3)
+    assert cache.stats()['evictions'] == 1
+
+def test_results_expire_after_their_ttl():
+    cache = ResultCache(ttl=60)
+    cache.put('short', 1, ttl=0.01)
+    cache.put('long', 2)
+    time.sleep(0.02)
+    assert cache.get('short') == (False, None)
+    assert cache.get('long') == (True, 2)
+    assert cache.stats()['expirations'] == 1
+
+def test_keys_depend_on_the_function_and_the_arguments():
+    assert task_key(square, (2,)) == task_key(square, (2,))
+    assert task_key(square, (2,)) != task_key(square, (3,))
+    assert task_key(square, (2,)) != task_key(slow_square, (2,))
+    assert task_key(square, (threading.Lock(),)) is None
+
+def test_the_client_cache_answers_repeated_and_identical_in_flight_tasks(worker_port):
+    node = Q2.Node('127.0.0.1', worker_port)
+    client = Q2.Client([node], cache=ResultCache(), timeout=10)
+    try:
+        first, joined = client.submit((slow_square, (7,))), client.submit((slow_square, (7,)))
+        assert first.result() == joined.result() == 49
+        assert client.submit((slow_square, (7,))).result() == 49
+        assert calls['slow_square'] == 1
+        stats = client.cache_stats()
+        assert stats['joined'] == 1 and stats['hits'] == 1
+    finally:
+        node.close()
+
+def test_only_pure_tasks_that_succeeded_are_cached(worker_port):
+    node = Q2.Node('127.0.0.1', worker_port)
+    client = Q2.Client([node], cache=ResultCache(), timeout=10)
+    try:
+        assert client.distribute_tasks([(square, (3,)), (square, (3,))]) == [9, 9]
+        with pytest.raises(ValueError):
+            client.submit((fail_once, (5,))).result()
+        assert client.submit((fail_once, (5,))).result() == 5
+        assert calls == {'square': 2, 'fail_once': 2}
+    finally:
+        node.close()
+
+def test_a_ttl_from_the_decorator_overrides_the_cache_default(worker_port):
+    node = Q2.Node('127.0.0.1', worker_port)
+    client = Q2.Client([node], cache=ResultCache(), timeout=10)
+    try:
+        assert client.submit((fleeting, (1,))).result() == 1
+        time.sleep(0.1)
+        assert client.submit((fleeting, (1,))).result() == 1
+        assert calls['fleeting'] == 2
+    finally:
+        node.close()
+
+def test_the_worker_node_cache_is_shared_by_its_clients():
+    _, port = start_worker_node(cache=ResultCache())
+    nodes = [Q2.Node('127.0.0.1', port), Q2.Node('127.0.0.1', port)]
+    try:
+        for node in nodes:
+            assert Q2.Client([node], timeout=10).submit((slow_square, (4,))).result() == 16
+        assert calls['slow_square'] == 1
+    finally:
+        for node in nodes:
+            node.close()
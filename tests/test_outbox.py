@@ -0,0 +1,51 @@
+""" Tests for the per-client outbox of Q3 and its slow consumer policies. """
+
+import pytest
+
+from Q3 import Outbox, SlowConsumer
+
+def test_put_reports_when_the_writer_must_be_woken():
+    outbox = Outbox()
+    assert outbox.put(b'one') is True
+    assert outbox.put(b'two') is False
+    assert outbox.take() == [b'one', b'two']
+    assert outbox.size == 0
+
+def test_drop_policy_drops_new_messages():
+    outbox = Outbox('drop', max_messages=2)
+    for data in (b'1', b'2', b'3', b'4'):
+        outbox.put(data)
+    assert outbox.dropped == 2
+    assert outbox.take() == [b'1', b'2']
+
+def test_disconnect_policy_raises():
+    outbox = Outbox('disconnect', max_messages=2)
+    outbox.put(b'1')
+    outbox.put(b'2')
+    with pytest.raises(SlowConsumer):
+        outbox.put(b'3')
+
+def test_coalesce_policy_merges_the_backlog():
+    outbox = Outbox('coalesce', max_messages=2)
+    for data in (b'1', b'2', b'3', b'4'):
+        outbox.put(data)
+    assert outbox.dropped == 0
+    assert b''.join(outbox.take()) == b'1234'
+
+@pytest.mark.parametrize('policy', ['drop', 'disconnect', 'coalesce'])
+def test_byte_limit_disconnects_whatever_the_policy(policy):
+    outbox = Outbox(policy, max_bytes=10)
+    outbox.put(b'x' * 8)
+    with pytest.raises(SlowConsumer):
+        outbox.put(b'x' * 3)
+
+def test_closed_outbox_discards_messages():
+    outbox = Outbox()
+    outbox.put(b'queued')
+    outbox.close()
+    assert outbox.put(b'late') is False
+    assert outbox.get() == []
+
+def test_unknown_policy_is_refused():
+    with pytest.raises(ValueError):
+        Outbox('buffer')
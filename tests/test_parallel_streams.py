@@ -0,0 +1,56 @@
+""" Tests for uploading one file over several parallel connections. """
+
+import itertools
+
+import pytest
+
+import resumable
+from resumable import pick_stream_count, send_file_resumable
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    """ Uses 64 KiB chunks, so small files have many of them. """
+    monkeypatch.setattr(resumable, 'MIN_CHUNK_SIZE', 64 * 1024)
+
+def make_file(path, size):
+    data = bytes((index * 7) % 253 for index in range(size))
+    path.write_bytes(data)
+    return data
+
+def test_stream_count_grows_with_the_file():
+    assert pick_stream_count(0) == 1
+    assert pick_stream_count(resumable.STREAM_SIZE * 3) == 3
+    assert pick_stream_count(resumable.STREAM_SIZE * 100) == resumable.MAX_STREAMS
+
+def test_chunks_are_spread_over_several_connections(q1_server, tmp_path):
+    connect, saved = q1_server
+    data = make_file(tmp_path / 'wide.bin', 32 * 64 * 1024 + 5)
+    opened = []
+    def open_stream():
+        sock, _ = connect()
+        opened.append(sock)
+        return sock
+
+    sock, serializer = connect()
+    with sock:
+        stats = send_file_resumable(sock, str(tmp_path / 'wide.bin'), connect=open_stream, streams=4,
+                                    serializer=serializer)
+    assert len(opened) == 4
+    assert stats.raw_bytes == len(data)
+    assert (saved / 'wide.bin').read_bytes() == data
+
+def test_chunks_of_a_failed_stream_are_sent_again_over_the_main_connection(q1_server, tmp_path):
+    connect, saved = q1_server
+    data = make_file(tmp_path / 'flaky.bin', 16 * 64 * 1024)
+    attempts = itertools.count()
+    def flaky_stream():
+        if next(attempts) == 1:
+            raise ConnectionRefusedError("stream refused")
+        return connect()[0]
+
+    sock, serializer = connect()
+    with sock:
+        stats = send_file_resumable(sock, str(tmp_path / 'flaky.bin'), connect=flaky_stream, streams=4,
+                                    serializer=serializer)
+    assert stats.raw_bytes == len(data)
+    assert (saved / 'flaky.bin').read_bytes() == data
@@ -0,0 +1,43 @@
+""" Tests for receiving files on the Q1 server. """
+
+import socket
+
+import pytest
+
+import Q1
+from framing import recv_frame
+
+def test_received_files_never_get_special_permission_bits(tmp_path):
+    state = Q1.ServerState(str(tmp_path), 1)
+    left, right = socket.socketpair()
+    with left, right:
+        header = {'type': 'file', 'name': 'setuid.txt', 'size': 7, 'mode': 0o4755}
+        left.sendall(b'payload')
+        Q1.receive_file(right, state, header)
+        with pytest.raises(ValueError):
+            Q1.receive_file(right, state, dict(header, mode='0o4755'))
+    saved = tmp_path / 'setuid.txt'
+    assert saved.read_bytes() == b'payload'
+    assert saved.stat().st_mode & 0o7777 == 0o755
+
+def test_files_are_saved_under_their_relative_names(q1_server, tmp_path):
+    connect, saved = q1_server
+    source = tmp_path / 'source'
+    (source / 'sub').mkdir(parents=True)
+    (source / 'a.txt').write_bytes(b'a' * 1000)
+    (source / 'sub' / 'b.bin').write_bytes(bytes(range(256)) * 4096)
+    (source / 'empty').write_bytes(b'')
+
+    sock, serializer = connect()
+    with sock:
+        for file_path, name in Q1.collect_files([str(source)]):
+            Q1.send_file(sock, file_path, name, serializer=serializer)
+            reply = recv_frame(sock)
+            assert reply['status'] == 'ok' and reply['name'] == name
+    for name in ('a.txt', 'sub/b.bin', 'empty'):
+        assert (saved / name).read_bytes() == (source / name).read_bytes()
+
+def test_unsafe_names_are_refused():
+    for name in ('/etc/passwd', '../outside', 'a/../../b', 'a//b'):
+        with pytest.raises(ValueError):
+            Q1.resolve_path('/save', name)
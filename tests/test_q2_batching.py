@@ -0,0 +1,49 @@
+""" Tests for Q2's batched task submission. """
+
+import operator
+
+import pytest
+
+import Q2
+
+def test_full_and_partial_batches_resolve_in_order(worker_port):
+    node = Q2.Node('127.0.0.1', worker_port, batch_size=8, batch_window=0.01)
+    try:
+        full = [node.enqueue((operator.mul, (index, 2))) for index in range(8)]
+        partial = [node.enqueue((operator.add, (index, 1))) for index in range(3)]
+        assert [future.result(5) for future in full] == [index * 2 for index in range(8)]
+        assert [future.result(5) for future in partial] == [1, 2, 3]
+        assert node.outstanding == 0
+    finally:
+        node.close()
+
+def test_client_distributes_many_tasks(worker_port):
+    client = Q2.Client([Q2.Node('127.0.0.1', worker_port)], timeout=10)
+    tasks = [(operator.add, (index, index)) for index in range(500)]
+    assert client.distribute_tasks(tasks) == [index * 2 for index in range(500)]
+
+def test_a_task_that_cannot_be_sent_fails_alone(worker_port):
+    node = Q2.Node('127.0.0.1', worker_port, batch_size=8, batch_window=0.01)
+    client = Q2.Client([node], timeout=5)
+    try:
+        good = client.submit((operator.add, (1, 2)))
+        bad = client.submit((lambda: 1, ()))
+        with pytest.raises(Exception) as raised:
+            bad.result(5)
+        assert not isinstance(raised.value, TimeoutError)
+        assert good.result(5) == 3
+
+        # The node's flusher survived: later partial batches still go out
+        assert client.distribute_tasks([(operator.add, (1, 2)), (operator.mul, (2, 3))]) == [3, 6]
+        assert node.flusher.is_alive()
+        assert node.outstanding == 0
+    finally:
+        node.close()
+
+def test_a_batch_to_an_unreachable_node_fails_with_task_not_sent():
+    from conftest import free_port
+    node = Q2.Node('127.0.0.1', free_port(), batch_window=0.001)
+    future = node.enqueue((operator.add, (1, 2)))
+    with pytest.raises(Q2.TaskNotSent):
+        future.result(5)
+    assert node.outstanding == 0
@@ -0,0 +1,51 @@
+""" Tests for the process and thread pools of Q2 worker nodes. """
+
+import operator
+import os
+
+import pytest
+
+import Q2
+from conftest import start_worker_node
+
+@Q2.run_in('thread')
+def blocking_io():
+    return os.getpid()
+
+@pytest.fixture(scope='module')
+def process_port():
+    """ Port of a worker node that runs tasks in its process pool by default. """
+    return start_worker_node(processes=2, default_executor='process')[1]
+
+def test_tasks_run_in_the_pool_they_ask_for(process_port):
+    node = Q2.Node('127.0.0.1', process_port)
+    try:
+        assert node.submit((operator.add, (2, 3))).result(30) == 5
+        in_process = node.submit((os.getpid, ())).result(30)
+        in_thread = node.submit((os.getpid, ()), executor='thread').result(30)
+        assert in_thread == os.getpid() # The worker node runs on a thread of this process
+        assert in_process != os.getpid()
+        assert node.submit((blocking_io, ())).result(30) == os.getpid()
+    finally:
+        node.close()
+
+def test_run_in_hints_pick_the_pool():
+    worker = Q2.WorkerNode('127.0.0.1', 0, Q2.TaskQueue(), processes=1, threads=1)
+    assert worker.pick_executor((blocking_io, ())) == 'thread'
+    assert worker.pick_executor((operator.add, (1, 2))) == 'process'
+    assert worker.pick_executor((operator.add, (1, 2)), executor='thread') == 'thread'
+    assert worker.pick_executor((operator.add, (1, 2)), executor='gpu') == 'process'
+    with pytest.raises(ValueError):
+        Q2.WorkerNode('127.0.0.1', 0, Q2.TaskQueue(), default_executor='gpu')
+
+def test_a_dead_process_fails_only_its_task(process_port):
+    node = Q2.Node('127.0.0.1', process_port)
+    try:
+        crashed = node.submit((os._exit, (1,)))
+        with pytest.raises(Exception):
+            crashed.result(30)
+        # The broken pool was replaced, and the node still runs process tasks
+        assert node.submit((operator.mul, (6, 7))).result(30) == 42
+        assert node.submit((os.getpid, ())).result(30) != os.getpid()
+    finally:
+        node.close()
@@ -0,0 +1,56 @@
+""" Tests for the futures the Q2 client returns. """
+
+import operator
+import threading
+import time
+
+import pytest
+
+import Q2
+
+def nap(seconds, value):
+    time.sleep(seconds)
+    return value
+
+class Unpicklable(Exception):
+    def __init__(self):
+        super().__init__("holds a lock")
+        self.lock = threading.Lock()
+
+def fail_unpicklably():
+    raise Unpicklable()
+
+@pytest.fixture
+def client(worker_port):
+    node = Q2.Node('127.0.0.1', worker_port)
+    yield Q2.Client([node], timeout=10)
+    node.close()
+
+def test_map_yields_results_in_input_order(client):
+    delays = [0.2, 0.0, 0.1, 0.0]
+    assert list(client.map(nap, delays, range(4))) == [0, 1, 2, 3]
+
+def test_as_completed_yields_the_fastest_first(client):
+    slow = client.submit((nap, (0.5, 'slow')))
+    fast = client.submit((nap, (0.0, 'fast')))
+    assert [future.result() for future in client.as_completed([slow, fast], timeout=10)] == ['fast', 'slow']
+
+def test_a_remote_exception_is_raised_with_its_traceback(client):
+    future = client.submit((operator.truediv, (1, 0)))
+    with pytest.raises(ZeroDivisionError) as raised:
+        future.result(10)
+    assert isinstance(raised.value.__cause__, Q2.RemoteTraceback)
+    assert 'ZeroDivisionError' in str(raised.value.__cause__)
+
+def test_map_raises_when_it_reaches_a_failed_task(client):
+    results = client.map(operator.truediv, [4, 1, 9], [2, 0, 3])
+    assert next(results) == 2
+    with pytest.raises(ZeroDivisionError):
+        next(results)
+
+def test_exceptions_and_results_that_cannot_be_sent_become_task_errors(client):
+    with pytest.raises(Q2.TaskError, match='Unpicklable'):
+        client.submit((fail_unpicklably, ())).result(10)
+    with pytest.raises(Q2.TaskError, match='cannot be sent'):
+        client.submit((threading.Lock, ())).result(10)
+    assert client.submit((operator.add, (1, 1))).result(10) == 2
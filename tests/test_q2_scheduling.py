@@ -0,0 +1,54 @@
+""" Tests for the policies the Q2 client uses to pick a worker node. """
+
+import collections
+import operator
+
+import Q2
+
+def make_nodes(*loads):
+    """ Builds unconnected nodes with the given (outstanding, capacity, latency) figures. """
+    nodes = []
+    for index, (outstanding, capacity, latency) in enumerate(loads):
+        node = Q2.Node('127.0.0.1', 50000 + index)
+        node.outstanding, node.capacity, node.latency = outstanding, capacity, latency
+        nodes.append(node)
+    return nodes
+
+def test_round_robin_takes_the_nodes_in_turn():
+    nodes = make_nodes((0, 1, None), (0, 1, None), (0, 1, None))
+    policy = Q2.RoundRobinPolicy()
+    assert [policy.select(nodes) for _ in range(6)] == nodes + nodes
+
+def test_least_outstanding_weighs_the_load_by_capacity():
+    busy, big, idle_small = make_nodes((4, 1, None), (6, 8, None), (1, 1, None))
+    assert Q2.LeastOutstandingPolicy().select([busy, big, idle_small]) is big
+
+def test_power_of_two_choices_never_picks_the_slowest_of_two():
+    fast, slow = make_nodes((0, 1, 0.01), (0, 1, 1.0))
+    policy = Q2.PowerOfTwoChoicesPolicy()
+    assert all(policy.select([fast, slow]) is fast for _ in range(20))
+    assert policy.select([slow]) is slow
+
+def test_power_of_two_choices_spreads_load_over_equal_nodes():
+    nodes = make_nodes(*[(0, 1, 0.1)] * 4)
+    picks = collections.Counter(Q2.PowerOfTwoChoicesPolicy().select(nodes) for _ in range(400))
+    assert len(picks) == 4
+    assert min(picks.values()) > 50
+
+def test_saturated_and_dead_nodes_are_skipped():
+    saturated, down, free = make_nodes((1000, 1, None), (0, 1, None), (0, 1, None))
+    down.down_until = float('inf')
+    client = Q2.Client([saturated, down, free], policy=Q2.RoundRobinPolicy())
+    assert [client.get_available_node() for _ in range(3)] == [free] * 3
+    assert client.get_available_node(exclude=[free], wait=False) is None
+
+def test_every_policy_runs_tasks(worker_port):
+    for policy in (Q2.RoundRobinPolicy(), Q2.LeastOutstandingPolicy(), Q2.PowerOfTwoChoicesPolicy()):
+        nodes = [Q2.Node('127.0.0.1', worker_port), Q2.Node('127.0.0.1', worker_port)]
+        client = Q2.Client(nodes, policy=policy, timeout=10)
+        try:
+            assert client.distribute_tasks([(operator.add, (index, 1)) for index in range(50)]) == \
+                list(range(1, 51))
+        finally:
+            for node in nodes:
+                node.close()
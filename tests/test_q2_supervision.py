@@ -0,0 +1,97 @@
+""" Tests for the Q2 client's deadlines, retries and speculative duplicates. """
+
+import concurrent.futures
+import operator
+import socket
+import threading
+import time
+
+import pytest
+
+import Q2
+from conftest import start_worker_node
+from framing import recv_frame
+
+ran = set() # Keys of the straggle_once calls that already ran
+ran_lock = threading.Lock()
+
+def nap(seconds, value):
+    time.sleep(seconds)
+    return value
+
+@Q2.idempotent
+def straggle_once(key):
+    """ Takes long the first time it runs for a key, and no time after. """
+    with ran_lock:
+        first = key not in ran
+        ran.add(key)
+    if first and key.endswith('slow'):
+        time.sleep(5)
+    return key
+
+@Q2.idempotent
+def idempotent_add(a, b):
+    return a + b
+
+def dropping_worker():
+    """ Starts a fake worker node that drops each connection once it got a task.
+
+    Returns:
+        int: Its port.
+    """
+    listener = socket.create_server(('127.0.0.1', 0))
+    def serve():
+        while True:
+            conn, _ = listener.accept()
+            with conn:
+                recv_frame(conn) # hello
+                recv_frame(conn) # the task, which is never answered
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[1]
+
+def test_a_missed_deadline_fails_the_task_and_frees_the_slot(worker_port):
+    node = Q2.Node('127.0.0.1', worker_port)
+    client = Q2.Client([node])
+    try:
+        late = client.submit((nap, (1.0, 'late')), timeout=0.1)
+        with pytest.raises(concurrent.futures.TimeoutError):
+            late.result(5)
+        assert node.outstanding == 0 # Without waiting for the worker node to finish
+        assert client.submit((nap, (0.0, 'next'))).result(5) == 'next'
+    finally:
+        node.close()
+
+def test_idempotent_tasks_are_sent_again_after_a_lost_connection(worker_port):
+    lost, good = Q2.Node('127.0.0.1', dropping_worker()), Q2.Node('127.0.0.1', worker_port)
+    client = Q2.Client([lost, good], policy=Q2.RoundRobinPolicy(), timeout=10)
+    try:
+        assert client.submit((idempotent_add, (2, 3))).result() == 5
+    finally:
+        lost.close()
+        good.close()
+
+def test_other_tasks_fail_when_their_connection_is_lost(worker_port):
+    lost, good = Q2.Node('127.0.0.1', dropping_worker()), Q2.Node('127.0.0.1', worker_port)
+    client = Q2.Client([lost, good], policy=Q2.RoundRobinPolicy(), timeout=10)
+    try:
+        with pytest.raises(ConnectionError):
+            client.submit((operator.add, (2, 3))).result()
+        # Unless they are marked idempotent when submitted
+        client = Q2.Client([lost, good], policy=Q2.RoundRobinPolicy(), timeout=10)
+        assert client.submit((operator.add, (2, 3)), idempotent=True).result() == 5
+    finally:
+        lost.close()
+        good.close()
+
+def test_stragglers_are_duplicated_on_another_node(worker_port):
+    _, other_port = start_worker_node()
+    nodes = [Q2.Node('127.0.0.1', worker_port), Q2.Node('127.0.0.1', other_port)]
+    client = Q2.Client(nodes, timeout=10, speculate=True)
+    try:
+        keys = [f'{index}' for index in range(19)] + ['19-slow']
+        started = time.monotonic()
+        assert list(client.map(straggle_once, keys)) == keys
+        assert time.monotonic() - started < 3
+    finally:
+        for node in nodes:
+            node.close()
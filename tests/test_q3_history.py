@@ -0,0 +1,128 @@
+""" Tests for Q3's room history: the recent messages kept in memory and the message log. """
+
+import asyncio
+import time
+
+import pytest
+
+import Q3
+from conftest import ChatSession, start_chat_server
+from framing import FrameDecoder, encode_frame
+from serializers import STRICT
+
+def frame(room, text, sent):
+    return encode_frame({'type': 'message', 'room': room, 'sender': 'alice', 'text': text, 'time': sent}, STRICT)
+
+def texts(data):
+    return [message['text'] for message in FrameDecoder(serializer=STRICT).feed(data)]
+
+@pytest.fixture
+def log_path(tmp_path, monkeypatch):
+    """ Path of a message log indexed every 4 records, so small logs have several index entries. """
+    monkeypatch.setattr(Q3, 'LOG_INDEX_INTERVAL', 4)
+    return str(tmp_path / 'messages.log')
+
+def fill(history, room, count, start=1000.0):
+    for index in range(count):
+        history.record(room, start + index, frame(room, f"{room} {index}", start + index))
+
+def test_only_the_last_messages_of_a_room_are_kept():
+    history = Q3.MessageHistory(size=3)
+    fill(history, 'dev', 5)
+    fill(history, 'ops', 1)
+    assert texts(history.recent('dev')) == ['dev 2', 'dev 3', 'dev 4']
+    assert texts(history.recent('ops')) == ['ops 0']
+    assert history.recent('empty') == b''
+
+def test_the_least_recently_used_rooms_are_forgotten(monkeypatch):
+    monkeypatch.setattr(Q3, 'HISTORY_ROOMS', 2)
+    history = Q3.MessageHistory()
+    for room in ('a', 'b', 'a', 'c'):
+        fill(history, room, 1)
+    assert list(history.rooms) == ['a', 'c']
+
+def test_since_reads_the_log_when_memory_does_not_reach_back(log_path):
+    history = Q3.MessageHistory(size=3, log=Q3.MessageLog(log_path, flush_interval=0))
+    fill(history, 'dev', 20)
+    fill(history, 'ops', 20)
+    assert texts(history.since('dev', 1017.5)) == ['dev 18', 'dev 19'] # From memory
+    assert texts(history.since('dev', 1009.5)) == [f'dev {index}' for index in range(10, 20)] # From the log
+    assert history.since('dev', 1019.0) == b''
+    history.close()
+
+def test_the_log_survives_a_restart_and_restores_recent_messages(log_path):
+    history = Q3.MessageHistory(log=Q3.MessageLog(log_path, flush_interval=0))
+    fill(history, 'dev', 10)
+    history.close()
+
+    log = Q3.MessageLog(log_path)
+    assert len(log.index) == 3 # Records 0, 4 and 8
+    assert [sent for sent, _ in log.since('dev', 1004.5)] == [1005.0 + index for index in range(5)]
+    restored = Q3.MessageHistory(size=4, log=log)
+    assert texts(restored.recent('dev')) == ['dev 6', 'dev 7', 'dev 8', 'dev 9']
+    log.close()
+
+def test_since_includes_messages_not_written_yet(log_path):
+    log = Q3.MessageLog(log_path, flush_interval=60)
+    log.append('dev', 1000.0, frame('dev', 'queued', 1000.0))
+    assert texts(b''.join(data for _, data in log.since('dev', 999.0))) == ['queued']
+    log.close() # Writes the queued message
+    log = Q3.MessageLog(log_path)
+    assert len(log.since('dev', 999.0)) == 1
+    log.close()
+
+def test_since_reads_a_bounded_number_of_records(log_path):
+    log = Q3.MessageLog(log_path, flush_interval=0)
+    for index in range(30):
+        log.append('busy', 1000.0 + index, frame('busy', 'x', 1000.0 + index))
+    log.append('quiet', 1031.0, frame('quiet', 'late', 1031.0))
+    log.close()
+    log = Q3.MessageLog(log_path)
+    assert log.since('quiet', 0.0, max_records=10) == []
+    assert len(log.since('quiet', 0.0)) == 1
+    assert len(log.since('busy', 0.0, limit=5)) == 5
+    log.close()
+
+def test_a_torn_last_record_is_dropped(log_path):
+    log = Q3.MessageLog(log_path, flush_interval=0)
+    for index in range(6):
+        log.append('dev', 1000.0 + index, frame('dev', f'dev {index}', 1000.0 + index))
+    log.close()
+    with open(log_path, 'r+b') as file:
+        file.truncate(file.seek(0, 2) - 3)
+    log = Q3.MessageLog(log_path)
+    assert [sent for sent, _ in log.since('dev', 0.0)] == [1000.0 + index for index in range(5)]
+    log.close()
+
+def test_clients_get_the_recent_messages_when_they_join_and_on_since(log_path):
+    async def run():
+        history = Q3.MessageHistory(size=2, log=Q3.MessageLog(log_path, flush_interval=0))
+        _, serving, port = await start_chat_server(history=history)
+        alice = await ChatSession(port, 'alice').connect()
+        bob = None
+        try:
+            await alice.expect_text("alice has joined the chat.")
+            started = time.time()
+            for text in ("one", "two", "three"):
+                await alice.say(text)
+            while texts(history.recent(Q3.DEFAULT_ROOM)) != ["two", "three"]:
+                await asyncio.sleep(0.01)
+            bob = await ChatSession(port, 'bob').connect()
+            replayed = [(await bob.expect(lambda message: message.get('type') == 'message'))['text']
+                        for _ in range(2)]
+            assert replayed == ["two", "three"]
+
+            await bob.say(f'/since {started - 1}')
+            for text in ("one", "two", "three"):
+                await bob.expect_text(text)
+            await bob.say(f'/since {time.time() + 60} dev')
+            await bob.expect(lambda message: str(message.get('text', '')).startswith("No messages in dev since"))
+            await bob.say('/since yesterday')
+            await bob.expect(lambda message: str(message.get('text', '')).startswith("Usage: /since"))
+        finally:
+            for session in (alice, bob):
+                if session is not None:
+                    await session.close()
+            serving.cancel()
+        history.close()
+    asyncio.run(asyncio.wait_for(run(), 20))
@@ -0,0 +1,98 @@
+""" Tests for Q3's chat rooms, subscriptions and direct messages. """
+
+import asyncio
+import socket
+
+from conftest import ChatSession, start_chat_server
+from framing import encode_frame, recv_frame
+from serializers import STRICT
+
+def chat(scenario, **options):
+    """ Runs an async scenario against a fresh AsyncChatServer.
+
+    Args:
+        scenario (callable): Coroutine function called with a function that connects a ChatSession by username.
+        **options: Keyword arguments for AsyncChatServer.
+    """
+    async def run():
+        server, serving, port = await start_chat_server(**options)
+        sessions = []
+        async def join(username):
+            session = await ChatSession(port, username).connect()
+            sessions.append(session)
+            await session.expect_text(f"{username} has joined the chat.")
+            return session
+        try:
+            await scenario(join)
+        finally:
+            for session in sessions:
+                await session.close()
+            serving.cancel()
+    asyncio.run(run())
+
+def from_sender(text):
+    return lambda message: message.get('type') == 'message' and message['text'] == text
+
+def test_messages_reach_only_the_subscribers_of_the_room():
+    async def scenario(join):
+        alice, bob, carol = await join('alice'), await join('bob'), await join('carol')
+        for session in (alice, bob):
+            await session.say('/join dev')
+            await session.expect_text(f"{session.client.username} has joined the chat.")
+
+        await alice.say("builds are green")
+        message = await bob.expect(from_sender("builds are green"))
+        assert (message['room'], message['sender']) == ('dev', 'alice')
+        assert await carol.silent(from_sender("builds are green"))
+        assert await alice.silent(from_sender("builds are green")) # The sender does not get it back
+
+        await carol.say("anyone here?")
+        assert (await alice.expect(from_sender("anyone here?")))['room'] == 'lobby'
+    chat(scenario)
+
+def test_leaving_a_room_stops_its_messages():
+    async def scenario(join):
+        alice, bob = await join('alice'), await join('bob')
+        await bob.say('/switch dev')
+        await bob.expect_text("Talking in dev.")
+        await alice.say('/join dev')
+        await bob.expect_text("alice has joined the chat.")
+        await alice.say('/leave dev')
+        await bob.expect_text("alice has left the chat.")
+
+        await bob.say("still there?")
+        assert await alice.silent(from_sender("still there?"))
+        await alice.say('/rooms')
+        await alice.expect_text("Your rooms: lobby; talking in lobby.")
+        await alice.say('/leave dev')
+        await alice.expect_text("You are not in dev.")
+    chat(scenario)
+
+def test_direct_messages_reach_only_their_recipient():
+    async def scenario(join):
+        alice, bob, carol = await join('alice'), await join('bob'), await join('carol')
+        await alice.say('/msg bob lunch?')
+        message = await bob.expect(lambda message: message.get('type') == 'direct')
+        assert (message['sender'], message['to'], message['text']) == ('alice', 'bob', 'lunch?')
+        assert await carol.silent(lambda message: message.get('type') == 'direct')
+
+        await alice.say('/msg dave hello')
+        await alice.expect_text("No user named dave is connected.")
+    chat(scenario)
+
+def test_every_connection_of_a_user_gets_its_direct_messages():
+    async def scenario(join):
+        alice, phone, laptop = await join('alice'), await join('bob'), await join('bob')
+        await alice.say('/msg bob ping')
+        for session in (phone, laptop):
+            assert (await session.expect(lambda message: message.get('type') == 'direct'))['text'] == 'ping'
+    chat(scenario)
+
+def test_a_client_that_does_not_say_hello_is_refused():
+    async def scenario(join):
+        port = (await join('alice')).client.port
+        loop = asyncio.get_running_loop()
+        with socket.create_connection(('127.0.0.1', port)) as sock:
+            sock.sendall(encode_frame("no hello", STRICT))
+            assert await loop.run_in_executor(None, recv_frame, sock) is None
+    chat(scenario)
@@ -0,0 +1,115 @@
+""" Tests for the bus that connects the shards of a sharded Q3 server. """
+
+import asyncio
+
+import pytest
+
+import Q3
+from conftest import ChatSession, start_chat_server
+
+class FakeTransport:
+    def __init__(self, buffered):
+        self.buffered = buffered
+        self.aborted = False
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+    def abort(self):
+        self.aborted = True
+
+class FakeWriter:
+    """ A connection to a shard whose kernel buffer holds some bytes already. """
+
+    def __init__(self, buffered):
+        self.transport = FakeTransport(buffered)
+
+    def is_closing(self):
+        return False
+
+    def writelines(self, frames):
+        pass
+
+def run_bus(scenario, policy, buffered):
+    """ Calls scenario with a bus of shard 0 of 3 whose connection to shard 1 is backed up by buffered bytes. """
+    async def run():
+        bus = Q3.ShardBus('/nonexistent', 0, 3, policy)
+        bus.loop = asyncio.get_running_loop()
+        writer = bus.peers[1] = FakeWriter(buffered)
+        bus.connect = lambda shard: asyncio.sleep(0) # Reconnecting is not part of these tests
+        try:
+            scenario(bus, writer)
+        finally:
+            await asyncio.gather(*bus.connect_tasks.values())
+    asyncio.run(run())
+
+MESSAGE = ('room', 'dev', b'frame', 1.0)
+
+@pytest.mark.parametrize('policy', Q3.SLOW_CONSUMER_POLICIES)
+def test_a_shard_keeping_up_gets_everything(policy):
+    def scenario(bus, writer):
+        bus.send([1, 2], MESSAGE) # Shard 2 is not connected: nothing is queued for it
+        assert len(bus.pending[1]) == 1 and bus.pending[2] == []
+        assert bus.dropped == 0 and not writer.transport.aborted
+    run_bus(scenario, policy, 0)
+
+def test_drop_policy_drops_messages_but_not_announcements():
+    def scenario(bus, writer):
+        bus.send([1], MESSAGE)
+        bus.send([1], ('subscribe', 'dev'))
+        assert bus.dropped == 1
+        assert [Q3.STRICT.decode(frame[Q3.FRAME_HEADER.size:]) for frame in bus.pending[1]] == [('subscribe', 'dev')]
+        assert not writer.transport.aborted
+    run_bus(scenario, 'drop', Q3.BUS_BUFFER_BYTES + 1)
+
+def test_disconnect_policy_disconnects_a_shard_past_the_buffer_limit():
+    def scenario(bus, writer):
+        bus.send([1], MESSAGE)
+        assert writer.transport.aborted
+        assert 1 not in bus.peers and bus.pending[1] == []
+        assert 1 in bus.connect_tasks # It is connected to again
+    run_bus(scenario, 'disconnect', Q3.BUS_BUFFER_BYTES + 1)
+
+@pytest.mark.parametrize('buffered, disconnected', [(Q3.BUS_BUFFER_BYTES + 1, False), (Q3.BUS_MAX_BYTES + 1, True)])
+def test_coalesce_policy_only_disconnects_past_the_hard_limit(buffered, disconnected):
+    def scenario(bus, writer):
+        bus.send([1], MESSAGE)
+        assert writer.transport.aborted == disconnected
+        assert len(bus.pending[1]) == (0 if disconnected else 1)
+    run_bus(scenario, 'coalesce', buffered)
+
+def test_clients_on_different_shards_share_rooms_and_direct_messages(tmp_path):
+    async def run():
+        shards = [await start_chat_server(bus=Q3.ShardBus(str(tmp_path), shard, 2)) for shard in range(2)]
+        sessions = []
+        try:
+            alice = await ChatSession(shards[0][2], 'alice').connect()
+            bob = await ChatSession(shards[1][2], 'bob').connect()
+            sessions += [alice, bob]
+            await alice.expect_text("alice has joined the chat.")
+            await bob.expect_text("bob has joined the chat.")
+            # Announcements reach the other shard a moment later
+            for server, other in ((shards[0][0], 'bob'), (shards[1][0], 'alice')):
+                while other not in server.bus.user_shards or Q3.DEFAULT_ROOM not in server.bus.room_shards:
+                    await asyncio.sleep(0.01)
+
+            await alice.say("hello from shard 0")
+            message = await bob.expect(lambda message: message.get('text') == "hello from shard 0")
+            assert (message['room'], message['sender']) == (Q3.DEFAULT_ROOM, 'alice')
+            await bob.say('/msg alice hello from shard 1')
+            message = await alice.expect(lambda message: message.get('type') == 'direct')
+            assert (message['sender'], message['text']) == ('bob', 'hello from shard 1')
+
+            await bob.close()
+            sessions.remove(bob)
+            await alice.expect_text("bob has left the chat.")
+            while 'bob' in shards[0][0].bus.user_shards:
+                await asyncio.sleep(0.01)
+            await alice.say('/msg bob are you there?')
+            await alice.expect_text("No user named bob is connected.")
+        finally:
+            for session in sessions:
+                await session.close()
+            for _, serving, _ in shards:
+                serving.cancel()
+    asyncio.run(asyncio.wait_for(run(), 20))
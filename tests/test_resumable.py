@@ -0,0 +1,158 @@
+""" Tests for Q1's resumable, chunk-verified uploads. """
+
+import io
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import resumable
+from compression import CompressionStats
+from framing import recv_frame, send_frame
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    """ Uses 64 KiB chunks, so small files have many of them. """
+    monkeypatch.setattr(resumable, 'MIN_CHUNK_SIZE', 64 * 1024)
+
+def begin_header(data, name, **fields):
+    """ Builds the 'begin' frame a client would send for some data. """
+    chunk_size = resumable.pick_chunk_size(len(data))
+    digests, whole = resumable.chunk_digests(io.BytesIO(data), len(data), chunk_size)
+    header = {'type': 'begin', 'file_id': resumable.file_id_for(name), 'name': name, 'size': len(data),
+              'chunk_size': chunk_size, 'digests': digests, 'mode': 0o644}
+    header.update(fields)
+    return header, whole
+
+def receive_chunks(partial, data, indexes):
+    """ Feeds chunks to a PartialFile through a socket pair. """
+    left, right = socket.socketpair()
+    with left, right:
+        buffer = bytearray(partial.chunk_size)
+        for index in indexes:
+            chunk = data[index * partial.chunk_size:(index + 1) * partial.chunk_size]
+            left.sendall(chunk)
+            assert partial.receive_chunk(right, index, len(chunk), buffer)
+
+def test_uploaded_files_never_get_special_permission_bits(tmp_path):
+    data = bytes(range(256)) * 1000
+    header, whole = begin_header(data, 'setuid.bin', mode=0o4755)
+    registry = resumable.PartialRegistry(str(tmp_path))
+    partial = registry.begin(header, str(tmp_path / 'setuid.bin'))
+    receive_chunks(partial, data, partial.missing())
+    assert registry.commit(partial, whole) == []
+    registry.release(partial)
+    assert (tmp_path / 'setuid.bin').read_bytes() == data
+    assert (tmp_path / 'setuid.bin').stat().st_mode & 0o7777 == 0o755
+
+    with pytest.raises(ValueError):
+        registry.begin(dict(header, mode='4755'), str(tmp_path / 'setuid.bin'))
+
+def test_a_new_user_waits_until_the_last_one_has_closed_the_upload(tmp_path, monkeypatch):
+    data = bytes(range(256)) * 1000
+    header, _ = begin_header(data, 'slow.bin')
+    registry = resumable.PartialRegistry(str(tmp_path))
+    first = registry.begin(header, str(tmp_path / 'slow.bin'))
+    receive_chunks(first, data, [0, 1])
+
+    closing = threading.Event()
+    checkpoint = resumable.PartialFile.checkpoint
+    def slow_checkpoint(partial):
+        closing.set()
+        time.sleep(0.2)
+        checkpoint(partial)
+    monkeypatch.setattr(resumable.PartialFile, 'checkpoint', slow_checkpoint)
+    releaser = threading.Thread(target=registry.release, args=(first,))
+    releaser.start()
+    closing.wait(5)
+
+    second = registry.begin(header, str(tmp_path / 'slow.bin'))
+    assert first.fd is None # Closed before the new user got the upload
+    assert second is not first
+    assert 0 not in second.missing() and 1 not in second.missing()
+    releaser.join()
+    registry.release(second)
+
+def make_file(path, size, seed=0):
+    data = bytes((index * 31 + seed) % 251 for index in range(size))
+    path.write_bytes(data)
+    return data
+
+def upload(connect, path, **options):
+    """ Uploads a file resumably over a new connection.
+
+    Returns:
+        CompressionStats: What was sent.
+    """
+    sock, serializer = connect()
+    with sock:
+        return resumable.send_file_resumable(sock, str(path), serializer=serializer, **options)
+
+def leftovers(directory):
+    return [name for name in os.listdir(directory) if resumable.is_partial(name)]
+
+def wait_until_recorded(record_path, chunks):
+    """ Waits until the server has recorded some chunks of an interrupted upload. """
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        if os.path.exists(record_path):
+            with open(record_path) as record:
+                if len(record.read().splitlines()) - 1 >= chunks:
+                    return
+        time.sleep(0.01)
+    raise AssertionError(f"{record_path} never recorded {chunks} chunks")
+
+def test_upload_sends_every_chunk_once(q1_server, tmp_path):
+    connect, saved = q1_server
+    data = make_file(tmp_path / 'whole.bin', 20 * 64 * 1024 + 123)
+    stats = upload(connect, tmp_path / 'whole.bin')
+    assert stats.raw_bytes == len(data)
+    assert (saved / 'whole.bin').read_bytes() == data
+    assert leftovers(saved) == []
+
+def test_an_interrupted_upload_resumes_with_the_missing_chunks(q1_server, tmp_path):
+    connect, saved = q1_server
+    data = make_file(tmp_path / 'big.bin', 20 * 64 * 1024)
+    chunk_size = resumable.pick_chunk_size(len(data))
+    header, _ = begin_header(data, 'big.bin')
+
+    # Send the first half of the chunks, then drop the connection
+    sock, serializer = connect()
+    with sock, open(tmp_path / 'big.bin', 'rb') as file:
+        send_frame(sock, header, serializer)
+        assert recv_frame(sock)['indexes'] == list(range(20))
+        resumable.send_chunks(sock, file, header['file_id'], list(range(10)), chunk_size, len(data), 'none',
+                              CompressionStats(), serializer)
+    wait_until_recorded(saved / f".{header['file_id']}.part.chunks", 10)
+
+    stats = upload(connect, tmp_path / 'big.bin')
+    assert stats.raw_bytes == 10 * chunk_size
+    assert (saved / 'big.bin').read_bytes() == data
+    assert leftovers(saved) == []
+
+def test_a_changed_file_sends_only_its_changed_chunks(q1_server, tmp_path):
+    connect, saved = q1_server
+    path = tmp_path / 'delta.bin'
+    data = bytearray(make_file(path, 16 * 64 * 1024))
+    upload(connect, path)
+
+    data[5 * 64 * 1024 + 7] ^= 0xff
+    path.write_bytes(data)
+    stats = upload(connect, path)
+    assert stats.raw_bytes == 64 * 1024
+    assert (saved / 'delta.bin').read_bytes() == data
+
+def test_a_corrupt_chunk_is_not_recorded(tmp_path):
+    data = bytes(range(256)) * 1000
+    header, whole = begin_header(data, 'corrupt.bin')
+    registry = resumable.PartialRegistry(str(tmp_path))
+    partial = registry.begin(header, str(tmp_path / 'corrupt.bin'))
+    left, right = socket.socketpair()
+    with left, right:
+        left.sendall(b'\0' * partial.chunk_size)
+        assert not partial.receive_chunk(right, 0, partial.chunk_size, bytearray(partial.chunk_size))
+    assert 0 in partial.missing()
+    assert registry.commit(partial, whole) == partial.missing()
+    registry.release(partial)
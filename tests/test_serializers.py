@@ -0,0 +1,96 @@
+""" Tests for the frame serializers and the schema codec. """
+
+import operator
+import pickle
+import socket
+
+import pytest
+
+from framing import FRAME_HEADER, FrameDecoder, encode_frame, recv_frame, send_frame
+from serializers import PERMISSIVE, SCHEMAS, SERIALIZERS, STRICT, negotiate_serializer
+
+MESSAGES = [
+    {'type': 'message', 'room': 'lobby', 'sender': 'alice', 'text': "hello", 'time': 1704067200.5},
+    {'type': 'direct', 'sender': 'alice', 'to': 'bob', 'text': "lunch? \N{FORK AND KNIFE}"},
+    {'type': 'notice', 'room': None, 'text': "bob has joined the chat."},
+    {'type': 'file', 'name': 'logs/part-0001.log', 'size': 1048576, 'mtime': 1704067200.25, 'mode': 0o644,
+     'codec': 'none'},
+    {'type': 'ack', 'name': 'logs/part-0001.log', 'size': 1048576, 'status': 'ok'},
+    {'type': 'chunk', 'file_id': 'ab' * 16, 'index': 3, 'size': 65536, 'codec': 'zlib'},
+    {'id': 7, 'executor': None, 'task': ('add', [1, 2.5])},
+    {'type': 'results', 'results': [(1, True, 3), (2, False, ('error', 'text'))]},
+    {'type': 'sync', 'digests': {'a.txt': '00' * 32, 'dir/b.txt': 'ff' * 32}},
+    {'unknown': [1, -200, 2 ** 70, 2.5, None, True, False, b'bytes', ('a', 'tuple'), 'x' * 300, list(range(300))]},
+    "plain text",
+]
+
+SERIALIZER_IDS = lambda serializer: 'strict' if serializer is STRICT else serializer.name
+
+@pytest.mark.parametrize('serializer', list(SERIALIZERS.values()) + [STRICT], ids=SERIALIZER_IDS)
+def test_messages_round_trip_through_the_decoder(serializer):
+    stream = b''.join(encode_frame(message, serializer) for message in MESSAGES)
+    assert FrameDecoder(serializer=PERMISSIVE).feed(stream) == MESSAGES
+
+@pytest.mark.parametrize('serializer', [PERMISSIVE, STRICT], ids=SERIALIZER_IDS)
+def test_schema_messages_are_smaller_than_pickles(serializer):
+    for message in MESSAGES[:6]:
+        payload = serializer.encode(message)
+        assert payload[0] in {schema.tag for schema in SCHEMAS}
+        assert len(payload) < len(pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL))
+
+@pytest.mark.parametrize('message', [
+    {'type': 'message', 'room': 'lobby', 'sender': 'alice', 'text': "hi", 'time': 1.0, 'extra': 1},
+    {'type': 'message', 'room': 'lobby', 'sender': 'alice', 'text': "hi"},
+    {'type': 'message', 'room': 'lobby', 'sender': 'alice', 'text': 5, 'time': 1.0},
+    {'type': 'message', 'room': 'lobby', 'sender': 'alice', 'text': "hi", 'time': 1},
+    {'type': 'notice', 'room': 5, 'text': "hi"},
+    {'type': 'ack', 'name': 'a', 'size': -1, 'status': 'ok'},
+    {'type': 'file', 'name': 'a', 'size': 1, 'mtime': 1.0, 'mode': True, 'codec': 'none'},
+    {'type': 'file', 'name': 'a', 'size': 1, 'mtime': 1.0, 'mode': 2 ** 16, 'codec': 'none'},
+])
+@pytest.mark.parametrize('serializer', [PERMISSIVE, STRICT], ids=SERIALIZER_IDS)
+def test_messages_that_do_not_fit_their_schema_still_round_trip(serializer, message):
+    assert serializer.decode(serializer.encode(message)) == message
+
+@pytest.mark.parametrize('message', MESSAGES[:8])
+def test_truncated_payloads_are_errors(message):
+    payload = STRICT.encode(message)
+    for length in range(len(payload)):
+        try:
+            decoded = STRICT.decode(payload[:length])
+        except ValueError:
+            continue
+        assert decoded != message
+
+def test_send_and_receive_over_a_socket():
+    left, right = socket.socketpair()
+    with left, right:
+        for message in MESSAGES:
+            send_frame(left, message, STRICT)
+        left.shutdown(socket.SHUT_WR)
+        assert [recv_frame(right) for _ in MESSAGES] == MESSAGES
+        assert recv_frame(right) is None
+
+def test_strict_rejects_pickled_frames():
+    frame = encode_frame({'task': (operator.add, (1, 2))}) # Pickled by default
+    with pytest.raises(ValueError):
+        FrameDecoder(serializer=STRICT).feed(frame)
+    with pytest.raises(ValueError):
+        STRICT.decode(frame[FRAME_HEADER.size:])
+    embedded = PERMISSIVE.encode({'id': 1, 'executor': None, 'task': (operator.add, (1, 2))})
+    with pytest.raises(ValueError):
+        STRICT.decode(embedded)
+
+def test_strict_never_produces_pickles():
+    payload = STRICT.encode({'type': 'result', 'value': [1, 2, 3]})
+    assert STRICT.decode(payload) == {'type': 'result', 'value': [1, 2, 3]}
+    with pytest.raises(TypeError):
+        STRICT.encode({'task': (operator.add, (1, 2))})
+
+def test_negotiation_only_pickles_for_peers_that_accept_pickle():
+    assert negotiate_serializer(['schema', 'pickle']) is PERMISSIVE
+    assert negotiate_serializer(['schema']) is STRICT
+    assert negotiate_serializer(['pickle']) is SERIALIZERS['pickle']
+    assert negotiate_serializer(['schema', 'pickle'], ['pickle']) is SERIALIZERS['pickle']
+    with pytest.raises(ValueError):
+        negotiate_serializer(['msgpack'])
@@ -0,0 +1,88 @@
+""" Tests for passing large task arguments and results through shared memory. """
+
+import os
+import time
+
+import pytest
+
+import Q2
+import shm
+from shm import SHARE_THRESHOLD, SharedPayload, share, worth_sharing
+
+def leftover_files():
+    return {name for name in os.listdir(shm.SHM_DIRECTORY) if name.startswith(shm.FILE_PREFIX)}
+
+def wait_until_same_host(node):
+    """ Connects to a node and waits until its heartbeats show it runs on this host. """
+    node.get_connection()
+    deadline = time.monotonic() + 5
+    while not node.same_host and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert node.same_host
+
+def checksum(data):
+    return sum(data[::4096]), len(data)
+
+def test_large_buffers_go_to_a_file_and_small_ones_stay_in_the_pickle():
+    big = bytes(range(256)) * (SHARE_THRESHOLD // 256 + 1)
+    assert share(('small', b'x' * 100)) is None
+    payload = share((big, 'label'))
+    try:
+        assert len(payload.data) < 1024
+        assert payload.load() == (big, 'label')
+    finally:
+        payload.unlink()
+        payload.unlink()
+    assert not os.path.exists(payload.path)
+
+def test_worth_sharing_only_looks_at_the_values_themselves():
+    assert worth_sharing([bytearray(SHARE_THRESHOLD)])
+    assert not worth_sharing([bytearray(SHARE_THRESHOLD - 1), 'text', 5])
+    assert not worth_sharing([[bytes(SHARE_THRESHOLD)]])
+
+def test_numpy_arrays_are_mapped_without_a_copy():
+    numpy = pytest.importorskip('numpy')
+    array = numpy.arange(SHARE_THRESHOLD // 8 + 1, dtype=numpy.float64)
+    payload = share(array)
+    try:
+        loaded = payload.load()
+        assert not loaded.flags.owndata
+        assert (loaded == array).all()
+    finally:
+        payload.unlink()
+
+def test_large_tasks_and_results_use_shared_memory_on_the_same_host(worker_port, monkeypatch):
+    shared = []
+    def spy(obj):
+        payload = share(obj)
+        shared.append(payload)
+        return payload
+    monkeypatch.setattr(Q2, 'share', spy)
+    before = leftover_files()
+
+    node = Q2.Node('127.0.0.1', worker_port)
+    try:
+        wait_until_same_host(node)
+
+        data = os.urandom(SHARE_THRESHOLD * 2)
+        assert node.submit((checksum, (data,))).result(10) == checksum(data)
+        assert node.submit((bytes, (SHARE_THRESHOLD * 3,))).result(10) == bytes(SHARE_THRESHOLD * 3)
+        assert [type(payload) for payload in shared] == [SharedPayload, SharedPayload]
+    finally:
+        node.close()
+    # Files are removed by done callbacks, which may run just after result() returns
+    deadline = time.monotonic() + 5
+    while not leftover_files() <= before and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert leftover_files() <= before
+
+def test_shared_memory_can_be_turned_off(worker_port, monkeypatch):
+    monkeypatch.setattr(Q2, 'share', lambda obj: pytest.fail("shared memory was used"))
+    node = Q2.Node('127.0.0.1', worker_port, shared_memory=False)
+    try:
+        wait_until_same_host(node)
+        data = os.urandom(SHARE_THRESHOLD * 2)
+        assert node.submit((checksum, (data,))).result(10) == checksum(data)
+        assert node.submit((bytes, (SHARE_THRESHOLD * 2,))).result(10) == bytes(SHARE_THRESHOLD * 2)
+    finally:
+        node.close()
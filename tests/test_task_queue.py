@@ -0,0 +1,75 @@
+""" Tests for Q2's journal-backed task queue. """
+
+import operator
+import os
+import threading
+
+import Q2
+from Q2 import TaskQueue
+
+def test_tasks_leave_by_priority_then_insertion_order():
+    queue = TaskQueue()
+    queue.add_tasks(['b1', 'b2'], priority=1)
+    queue.add_task('a', priority=0)
+    assert queue.get_tasks(10) == ['a', 'b1', 'b2']
+    assert queue.get_task() is None
+
+def test_queued_tasks_survive_a_restart(tmp_path):
+    path = str(tmp_path / 'queue.journal')
+    queue = TaskQueue(path)
+    queue.add_tasks([(operator.add, (index, 1)) for index in range(5)])
+    queue.add_task('urgent', priority=-1)
+    assert queue.get_tasks(2) == ['urgent', (operator.add, (0, 1))]
+    # No close(): the queue is rebuilt from the journal alone, as after a crash
+
+    recovered = TaskQueue(path)
+    assert len(recovered) == 4
+    assert recovered.get_tasks(10) == [(operator.add, (index, 1)) for index in range(1, 5)]
+    recovered.close()
+
+def test_recovery_replays_the_journal_after_the_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(Q2, 'INDEX_INTERVAL', 3)
+    path = str(tmp_path / 'queue.journal')
+    queue = TaskQueue(path)
+    queue.add_tasks(list(range(4))) # Checkpoints the index
+    queue.get_task()
+    queue.add_task(4)
+
+    recovered = TaskQueue(path)
+    assert recovered.get_tasks(10) == [1, 2, 3, 4]
+    recovered.add_task(5) # Sequence numbers carry on after the recovered ones
+    assert recovered.get_task() == 5
+    recovered.close()
+
+def test_a_torn_last_record_is_dropped(tmp_path):
+    path = str(tmp_path / 'queue.journal')
+    queue = TaskQueue(path)
+    queue.add_tasks(['kept', 'torn'])
+    queue.close()
+    with open(path, 'r+b') as file:
+        file.truncate(file.seek(0, 2) - 1)
+
+    recovered = TaskQueue(path)
+    assert recovered.get_tasks(10) == ['kept']
+    recovered.close()
+
+def test_compaction_keeps_only_queued_tasks(tmp_path, monkeypatch):
+    monkeypatch.setattr(Q2, 'COMPACT_MIN_RECORDS', 8)
+    path = str(tmp_path / 'queue.journal')
+    queue = TaskQueue(path)
+    queue.add_tasks(['x' * 1000] * 10)
+    queue.get_tasks(3)
+    grown = os.path.getsize(path)
+    queue.get_task() # Eight dead records now outnumber the six queued tasks
+    assert os.path.getsize(path) < grown
+    queue.add_task('last')
+
+    recovered = TaskQueue(path)
+    assert recovered.get_tasks(10) == ['x' * 1000] * 6 + ['last']
+    recovered.close()
+
+def test_a_blocking_get_waits_for_a_task():
+    queue = TaskQueue()
+    assert queue.get_tasks(1, block=True, timeout=0.05) == []
+    threading.Timer(0.05, queue.add_task, args=('late',)).start()
+    assert queue.get_task(block=True, timeout=5) == 'late'